@@ -0,0 +1,202 @@
+"""
+Columnar storage for large numbers of activities (backfills and exports).
+
+A list of Activity namedtuples repeats the child's name, the date and the
+activity type as separate strings on every row. ActivityBatch keeps one copy
+of each name and activity type with integer codes per row, and dates and
+times as integers in arrays:
+
+    batch = ActivityBatch.from_activities(activities)
+    batch[0]                 # Activity, made when asked for
+    batch.item_names()       # same as activity_item_names(activities)
+    batch.to_numpy()         # views of the arrays, no copies
+    batch.to_pandas()        # needs the dashboard requirements
+"""
+import sys
+from array import array
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from note_parse import Activity, format_iso_time, parse_iso_time
+
+# epoch value of activities without a time
+MISSING_TIME = -2 ** 63
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class _Categories:
+    """
+    Distinct values and the code of each
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+
+class ActivityBatch:
+    """
+    Columns of many activities
+
+    Appending to a batch while arrays from to_numpy are still in use raises
+    BufferError (the arrays share memory with the batch).
+    """
+    def __init__(self):
+        self._names = _Categories()
+        self._activities = _Categories()
+        self.name_codes = array('I')
+        self.activity_codes = array('H')
+        # days since 1970-01-01
+        self.dates = array('l')
+        self.epoch_s = array('q')
+        self.microseconds = array('l')
+        self.utc_offsets = array('h')
+        self.results = []
+        self.notes = []
+
+    @classmethod
+    def from_activities(cls, activities: Iterable[Activity]
+                        ) -> 'ActivityBatch':
+        batch = cls()
+        batch.extend(activities)
+        return batch
+
+    @property
+    def first_names(self) -> List[str]:
+        """
+        Distinct first names, indexed by name_codes
+        """
+        return self._names.values
+
+    @property
+    def activity_types(self) -> List[str]:
+        """
+        Distinct activity types, indexed by activity_codes
+        """
+        return self._activities.values
+
+    def append(self, act: Activity) -> None:
+        self.name_codes.append(self._names.code(act.first_name))
+        self.activity_codes.append(self._activities.code(act.activity))
+        self.dates.append(date(*[int(x) for x in act.date.split('-')])
+                          .toordinal() - _EPOCH_ORDINAL)
+        if act.datetime:
+            epoch_s, micros, offset = parse_iso_time(act.datetime)
+        else:
+            epoch_s, micros, offset = MISSING_TIME, 0, 0
+        self.epoch_s.append(epoch_s)
+        self.microseconds.append(micros)
+        self.utc_offsets.append(offset)
+        # results repeat a lot (e.g., "Wet diaper"), so keep one copy of each
+        self.results.append(sys.intern(act.result) if act.result is not None
+                            else None)
+        self.notes.append(act.notes)
+
+    def extend(self, activities: Iterable[Activity]) -> None:
+        for act in activities:
+            self.append(act)
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def __getitem__(self, i: int) -> Activity:
+        if i < 0:
+            i += len(self)
+        epoch_s = self.epoch_s[i]
+        return Activity(
+            first_name=self._names.values[self.name_codes[i]],
+            date=date.fromordinal(self.dates[i] + _EPOCH_ORDINAL).isoformat(),
+            activity=self._activities.values[self.activity_codes[i]],
+            datetime=None if epoch_s == MISSING_TIME else format_iso_time(
+                epoch_s, self.microseconds[i], self.utc_offsets[i]),
+            result=self.results[i],
+            notes=self.notes[i]
+        )
+
+    def __iter__(self) -> Iterator[Activity]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def item_names(self) -> List[str]:
+        """
+        SimpleDB item names, see lambda_function.activity_item_names
+        """
+        counts = {}
+        date_strs = {}
+        names = []
+        for name_code, day, act_code, result in zip(
+                self.name_codes, self.dates, self.activity_codes,
+                self.results):
+            activity = self._activities.values[act_code]
+            # media is named after its file
+            owner = result if activity == 'Media' else \
+                self._names.values[name_code]
+            key = (owner, day, act_code)
+            count = counts[key] = counts.get(key, -1) + 1
+            if day not in date_strs:
+                date_strs[day] = date.fromordinal(
+                    day + _EPOCH_ORDINAL).isoformat()
+            act_id = '-'.join([owner, date_strs[day], activity])
+            if count > 99:
+                e_str = 'Activity count over 99 for id {}, zero padding ' \
+                        'will fail'
+                raise ValueError(e_str.format(act_id))
+            names.append('{}-{:03d}'.format(act_id, count))
+        return names
+
+    def to_numpy(self) -> Dict:
+        """
+        NumPy views of the integer columns (no copies)
+        """
+        import numpy as np
+
+        def view(column: array):
+            # through a memoryview, so older numpy also locks the array size.
+            # numpy type codes are the same C types as array's
+            return np.frombuffer(memoryview(column), dtype=column.typecode)
+        return {
+            'name_codes': view(self.name_codes),
+            'activity_codes': view(self.activity_codes),
+            'dates': view(self.dates),
+            'epoch_s': view(self.epoch_s),
+            'microseconds': view(self.microseconds),
+            'utc_offsets': view(self.utc_offsets)
+        }
+
+    def to_pandas(self, time_zone: Optional[str]=None):
+        """
+        DataFrame with the Activity columns: first_name and activity as
+        categoricals, date as datetime64 and datetime as UTC timestamps (NaT
+        if missing)
+
+        :param time_zone: convert datetime to this time zone
+        """
+        import numpy as np
+        import pandas as pd
+        columns = self.to_numpy()
+        epoch_s = columns['epoch_s']
+        missing = epoch_s == MISSING_TIME
+        micros = np.where(missing, 0, epoch_s) * 1000000 + \
+            columns['microseconds']
+        times = pd.to_datetime(micros, unit='us', utc=True)
+        times = times.where(~missing)
+        if time_zone:
+            times = times.tz_convert(time_zone)
+        return pd.DataFrame({
+            'first_name': pd.Categorical.from_codes(
+                columns['name_codes'].astype(np.int64), self.first_names),
+            'date': pd.to_datetime(columns['dates'].astype(np.int64),
+                                   unit='D'),
+            'activity': pd.Categorical.from_codes(
+                columns['activity_codes'].astype(np.int64),
+                self.activity_types),
+            'datetime': times,
+            'result': self.results,
+            'notes': self.notes
+        })
@@ -0,0 +1,324 @@
+"""
+Long running asyncio ingest worker.
+
+Takes emails off a queue (an SQS queue of S3 event notifications, or S3 keys
+from the command line or a file) and runs the lambda_function steps for many
+emails at once. boto3 and requests block, so their calls run on a shared
+thread pool, with a semaphore per service (S3, SimpleDB, Kaymbu, SQS and the
+local notes index) capping the calls in flight. Messages are only taken off
+SQS for workers that are free to start on them, so none sit received (and
+their visibility timeout running) behind slow downloads.
+
+    python async_worker.py --queue-url https://sqs.us-east-1.amazonaws.com/1234/kaymbu-emails
+    python async_worker.py --bucket gretchens-house-emails --keys keys.txt
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import sys
+import urllib.parse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Dict, Iterable, List, \
+    Optional, Tuple
+
+import boto3
+
+from lambda_function import (
+    _update_notes_index,
+    cache_parse,
+    decode_email_body,
+    email_family,
+    fetch_email,
+    get_cached_parse,
+    known_media,
+    store_media,
+    update_media_manifest,
+    write_sdb_activities
+)
+from metrics import timer
+from note_parse import (
+    Activity,
+    Nap,
+    parse_gretchens_notes,
+    parse_gretchens_picture
+)
+from parse_cache import MEDIA, NOTES, ParsedEmail, is_email_key
+from profiling import profiled, thread_profiled
+
+# calls in flight per service. sqlite takes one writer at a time, so index
+# updates go one by one instead of waiting on its lock
+SERVICE_LIMITS = {'s3': 32, 'sdb': 16, 'kaymbu': 4, 'sqs': 2, 'index': 1}
+# emails processed at once, also the size of the work queue
+WORKERS = 64
+SQS_BATCH = 10
+SQS_WAIT_S = 20
+
+# one queue message: (bucket, key) pairs and a function that removes the
+# message from its queue (None for sources without acknowledgement)
+QueueItem = namedtuple('QueueItem', ['records', 'ack'])
+# run_worker sends sources the number of free workers (None on the first
+# item), which they may ignore
+QueueSource = AsyncGenerator[QueueItem, Optional[int]]
+
+
+def get_logger():
+    return logging.getLogger("async_worker")
+
+
+def s3_event_records(body: str) -> List[Tuple[str, str]]:
+    """
+    (bucket, key) of every object in an S3 event notification, empty for
+    other messages (e.g., the s3:TestEvent sent when notifications are set up)
+    """
+    event = json.loads(body)
+    return [
+        (x['s3']['bucket']['name'],
+         urllib.parse.unquote_plus(x['s3']['object']['key'],
+                                   encoding='utf-8'))
+        for x in event.get('Records', []) if 's3' in x
+    ]
+
+
+async def keys_source(bucket: str,
+                      keys: Iterable[str]) -> QueueSource:
+    for key in keys:
+        yield QueueItem([(bucket, key)], None)
+
+
+async def sqs_source(sqs: boto3.client, queue_url: str,
+                     drain: bool=False) -> QueueSource:
+    """
+    Messages from an SQS queue that S3 sends email notifications to
+
+    Each receive asks for at most as many messages as there are free
+    workers, which run_worker sends in (one for the first receive)
+
+    :param sqs: SQS client
+    :param queue_url: queue url
+    :param drain: stop once the queue is empty, instead of polling forever
+    """
+    loop = asyncio.get_event_loop()
+    receive = functools.partial(
+        sqs.receive_message, QueueUrl=queue_url,
+        WaitTimeSeconds=0 if drain else SQS_WAIT_S
+    )
+    free = 1
+    while True:
+        response = await loop.run_in_executor(None, functools.partial(
+            receive, MaxNumberOfMessages=max(1, min(SQS_BATCH, free))))
+        messages = response.get('Messages', [])
+        if not messages and drain:
+            return
+        for message in messages:
+            ack = functools.partial(sqs.delete_message, QueueUrl=queue_url,
+                                    ReceiptHandle=message['ReceiptHandle'])
+            try:
+                records = [x for x in s3_event_records(message['Body'])
+                           if is_email_key(x[1])]
+            except ValueError:
+                get_logger().warning('Ignoring message that is not an S3 '
+                                     'event: {}'.format(message['Body']))
+                records = []
+            free = (yield QueueItem(records, ack)) or 1
+
+
+class AsyncIngest:
+    """
+    Ingest steps for one email as coroutines, sharing a thread pool and
+    per-service limits with every other email in flight
+
+    Make it inside a running event loop.
+
+    :param limits: calls in flight per service, defaults to SERVICE_LIMITS
+    :param reprocess: see put_sdb_activities
+    """
+    def __init__(self, limits: Optional[Dict[str, int]]=None,
+                 reprocess: bool=False):
+        self.limits = dict(SERVICE_LIMITS, **(limits or {}))
+        self.reprocess = reprocess
+        self.semaphores = {name: asyncio.Semaphore(limit)
+                           for name, limit in self.limits.items()}
+        self.executor = ThreadPoolExecutor(sum(self.limits.values()))
+
+    async def call(self, service: str, func: Callable, *args):
+        """
+        Run a blocking call on the thread pool once the service has room
+        """
+        async with self.semaphores[service]:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor,
+                functools.partial(thread_profiled(func), *args))
+
+    async def process(self, bucket: str,
+                      key: str) -> Tuple[List[Activity], List[Nap]]:
+        """
+        Same as lambda_worker
+        """
+        if self.reprocess:
+            parsed = await self.call('s3', get_cached_parse, bucket, key)
+            if parsed:
+                await self.call('sdb', write_sdb_activities, bucket,
+                                parsed.activities, parsed.naps,
+                                self.reprocess, parsed.family)
+                if parsed.kind == NOTES:
+                    await self.call('index', _update_notes_index,
+                                    parsed.activities, parsed.family)
+                return parsed.activities, parsed.naps
+
+        raw_email, etag = await self.call('s3', fetch_email, bucket, key)
+        with timer('mime_decode'):
+            body = decode_email_body(raw_email)
+        family = email_family(raw_email)
+
+        activities, naps = None, None
+        try:
+            with timer('parse'):
+                activities, naps = parse_gretchens_notes(body)
+        except Exception as e:
+            get_logger().info(
+                'Error parsing activities out of email: {}'.format(e))
+
+        if activities and naps:
+            await self.call('sdb', write_sdb_activities, bucket, activities,
+                            naps, self.reprocess, family)
+            await self.call('index', _update_notes_index, activities,
+                            family)
+            await self.call('s3', cache_parse, bucket, key, etag,
+                            ParsedEmail(NOTES, activities, naps, family))
+            return activities, naps
+
+        media_out = await self.call(
+            'kaymbu', parse_gretchens_picture, body,
+            functools.partial(known_media, bucket))
+        activities = await asyncio.gather(*[
+            self._store_media(bucket, media, act, family)
+            for media, act in media_out])
+        activities = list(activities)
+        await self.call('s3', cache_parse, bucket, key, etag,
+                        ParsedEmail(MEDIA, activities, [], family))
+        return activities, []
+
+    async def _store_media(self, bucket: str, media: Optional[bytes],
+                           act: Activity, family: str) -> Activity:
+        act = await self.call('s3', store_media, media, bucket, act)
+        await self.call('sdb', write_sdb_activities, bucket, [act], [],
+                        self.reprocess, family)
+        await self.call('s3', update_media_manifest, bucket, family, act,
+                        media)
+        return act
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+async def run_worker(source: QueueSource, workers: int=WORKERS,
+                     limits: Optional[Dict[str, int]]=None,
+                     reprocess: bool=False) -> Dict[str, int]:
+    """
+    Process every email from a source
+
+    A message is acknowledged (deleted from SQS) only if all of its emails
+    were processed, so failures are retried by the queue.
+
+    :param source: keys_source or sqs_source
+    :param workers: emails processed at once
+    :param limits: calls in flight per service, defaults to SERVICE_LIMITS
+    :param reprocess: see put_sdb_activities
+    :return: counts of emails processed and failed, and activities stored
+    """
+    ingest = AsyncIngest(limits, reprocess)
+    slots = asyncio.Semaphore(workers)
+    idle = workers
+    tasks = set()
+    counts = {'processed': 0, 'failed': 0, 'activities': 0}
+
+    async def consume(item: QueueItem):
+        nonlocal idle
+        try:
+            ok = True
+            for bucket, key in item.records:
+                try:
+                    activities, naps = await ingest.process(bucket, key)
+                except Exception as e:
+                    get_logger().error('Failed {}/{}: {}'.format(bucket, key,
+                                                                  e))
+                    counts['failed'] += 1
+                    ok = False
+                else:
+                    counts['processed'] += 1
+                    counts['activities'] += len(activities) + len(naps)
+            if ok and item.ack:
+                await ingest.call('sqs', item.ack)
+        finally:
+            idle += 1
+            slots.release()
+
+    started = False
+    try:
+        while True:
+            # waits here when every worker is busy, so nothing is taken off
+            # the queue that no worker can start on
+            await slots.acquire()
+            try:
+                # a generator that has not started can only be sent None
+                item = await source.asend(idle if started else None)
+            except StopAsyncIteration:
+                break
+            started = True
+            idle -= 1
+            task = asyncio.ensure_future(consume(item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        ingest.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Ingest emails from an SQS queue or a list of S3 keys'
+    )
+    parser.add_argument('--queue-url',
+                        help='SQS queue receiving S3 email notifications')
+    parser.add_argument('--drain', action='store_true',
+                        help='Stop when the queue is empty')
+    parser.add_argument('--bucket', default='gretchens-house-emails',
+                        help='Bucket of the keys in --keys')
+    parser.add_argument('--keys', metavar='FILE',
+                        help='File with one email key per line (- for stdin)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Emails processed at once')
+    for service, limit in sorted(SERVICE_LIMITS.items()):
+        parser.add_argument('--{}-limit'.format(service), type=int,
+                            default=limit,
+                            help='{} calls in flight'.format(service))
+    parser.add_argument('--reprocess', action='store_true',
+                        help='Mark items as reprocessed')
+    parser.add_argument('--profile', metavar='DEST',
+                        help='Profile the run, writing stats to a directory '
+                             'or s3://bucket/prefix')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.queue_url:
+        email_source = sqs_source(boto3.client('sqs'), args.queue_url,
+                                  args.drain)
+    elif args.keys:
+        key_file = sys.stdin if args.keys == '-' else open(args.keys, 'r')
+        email_source = keys_source(
+            args.bucket, [x.strip() for x in key_file if x.strip()])
+    else:
+        parser.error('one of --queue-url or --keys is required')
+    service_limits = {x: getattr(args, x + '_limit') for x in SERVICE_LIMITS}
+
+    with profiled('async_worker', args.profile):
+        result = asyncio.get_event_loop().run_until_complete(run_worker(
+            email_source, args.workers, service_limits, args.reprocess))
+    print(result)
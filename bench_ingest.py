@@ -0,0 +1,153 @@
+"""
+Offline end to end ingest benchmark.
+
+Runs lambda_worker (or the asyncio worker, with --async) over generated daily
+note and picture emails against the in-memory S3/SimpleDB fakes and a local
+Kaymbu server (see local_fakes.py), then reads every week back with
+get_week_data.
+
+    python bench_ingest.py --notes 500 --pictures 50 --workers 8
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import metrics
+from async_worker import keys_source, run_worker
+from lambda_function import lambda_worker
+from local_fakes import (
+    FakeKaymbuServer,
+    FakeS3,
+    FakeSimpleDB,
+    installed_fakes,
+    make_note_email,
+    make_picture_email
+)
+from sdb_modify_domain import shard_domains
+from test import _load_email
+
+BUCKET = 'gretchens-house-emails'
+
+
+def weekdays(start: datetime, n_days: int):
+    day = start
+    while n_days > 0:
+        if day.weekday() < 5:
+            yield day
+            n_days -= 1
+        day += timedelta(days=1)
+
+
+def make_emails(s3: FakeS3, kaymbu: FakeKaymbuServer, n_notes: int,
+                n_pictures: int, media_bytes: int):
+    """
+    Put generated emails in the fake bucket
+
+    :return: keys of the emails
+    """
+    template = _load_email('test_message')
+    days = list(weekdays(datetime(2018, 9, 3), n_notes))
+    keys = []
+    for i, day in enumerate(days):
+        key = 'emails/note-{:05d}'.format(i)
+        s3.put_object(Bucket=BUCKET, Key=key,
+                      Body=make_note_email(template, day))
+        keys.append(key)
+
+    for i in range(n_pictures):
+        day = days[i * len(days) // max(n_pictures, 1)]
+        media_id = 'media{:05d}'.format(i)
+        url = kaymbu.add_media('page{:05d}'.format(i), media_id,
+                               media_id + '.jpg', os.urandom(media_bytes))
+        key = 'emails/picture-{:05d}'.format(i)
+        s3.put_object(Bucket=BUCKET, Key=key,
+                      Body=make_picture_email(url, day))
+        keys.append(key)
+    return keys, days
+
+
+def run(args) -> None:
+    s3 = FakeS3(latency_s=args.aws_latency_ms / 1000)
+    sdb = FakeSimpleDB(latency_s=args.aws_latency_ms / 1000)
+    metrics_path = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+    metrics.METRICS_SINK = metrics_path
+
+    with FakeKaymbuServer(latency_s=args.kaymbu_latency_ms / 1000) as kaymbu, \
+            installed_fakes(s3, sdb, kaymbu.url):
+        keys, days = make_emails(s3, kaymbu, args.notes, args.pictures,
+                                 args.media_kb * 1024)
+        first, last = days[0].strftime('%Y-%m-%d'), \
+            days[-1].strftime('%Y-%m-%d')
+        for domain in shard_domains(first, last):
+            sdb.create_domain(DomainName=domain)
+
+        start = time.perf_counter()
+        failures = 0
+        if args.use_async:
+            counts = asyncio.get_event_loop().run_until_complete(
+                run_worker(keys_source(BUCKET, keys), args.workers))
+            failures = counts['failed']
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                futures = [pool.submit(lambda_worker, BUCKET, x)
+                           for x in keys]
+                for future in futures:
+                    if future.exception():
+                        failures += 1
+                        print('Failed: {}'.format(future.exception()))
+        ingest_s = time.perf_counter() - start
+
+        from dash_app.get_data import get_week_data
+        week_starts = sorted(set(
+            (x - timedelta(days=x.weekday())).strftime('%Y-%m-%d')
+            for x in days))
+        start = time.perf_counter()
+        n_items = 0
+        for week_start in week_starts:
+            n_items += len(get_week_data(week_start)['Items'])
+        query_s = time.perf_counter() - start
+
+    print('Ingested {} emails ({} failed) in {:.2f} s: {:.1f} emails/s'.format(
+        len(keys), failures, ingest_s, len(keys) / ingest_s))
+    print('Queried {} weeks ({} items) in {:.2f} s: {:.1f} ms/week'.format(
+        len(week_starts), n_items, query_s,
+        1000 * query_s / max(len(week_starts), 1)))
+    print('SimpleDB calls: {}'.format(sdb.calls))
+    print('S3 calls: {}'.format(s3.calls))
+    print('')
+    with open(metrics_path, 'r') as metrics_file:
+        summary = metrics.summarize(metrics_file)
+    print('{:<16}{:>8}{:>12}{:>12}'.format('stage', 'n', 'p50 ms', 'p99 ms'))
+    for stage in metrics.STAGES:
+        if stage in summary:
+            print('{:<16}{:>8d}{:>12.1f}{:>12.1f}'.format(
+                stage, summary[stage]['n'], summary[stage]['p50'],
+                summary[stage]['p99']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--notes', type=int, default=200,
+                        help='Number of daily note emails')
+    parser.add_argument('--pictures', type=int, default=20,
+                        help='Number of picture emails')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Emails processed in parallel')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Ingest with the asyncio worker '
+                             '(async_worker.py)')
+    parser.add_argument('--aws-latency-ms', type=float, default=5,
+                        help='Latency of each fake S3/SimpleDB call')
+    parser.add_argument('--kaymbu-latency-ms', type=float, default=20,
+                        help='Latency of each fake Kaymbu request')
+    parser.add_argument('--media-kb', type=int, default=256,
+                        help='Size of each media file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    run(args)
@@ -1,27 +1,75 @@
 import base64
 from datetime import datetime as dt
 from datetime import timedelta
+import json
+import logging
 import os
-from typing import Any, Dict, Tuple
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from flask_caching import Cache
+import flask
+from plotly.utils import PlotlyJSONEncoder
 
+from note_parse import is_video, poster_name
+
+from notes_index import IndexMissing, index_items, open_index, search
+from .cache import SharedCache
 from .get_data import (
     compute_nap_times,
+    expand_notes,
+    filter_items,
     get_activty_table,
+    get_search_table,
     get_week_data,
     get_media_keys,
-    download_media
+    get_media_manifest,
+    download_media,
+    presigned_media_url,
+    stream_media
+)
+from .history import (
+    PERIODS,
+    activity_counts,
+    child_history,
+    children,
+    get_history,
+    hourly_heatmap,
+    items_to_frame,
+    nap_trend,
+    recent_children
 )
-from .test.test_get_data import get_test_week_data
+from .snapshot import Snapshot
+from .test.test_get_data import get_test_snapshot
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 DATE_FMT = "%Y-%m-%d"
 
+# seconds before cached week data is refreshed with an incremental query
+WEEK_REFRESH_S = 300
+# same, for the full history used by the trend graphs
+HISTORY_REFRESH_S = 600
+# seconds rendered graphs and tables are kept. Entries are keyed by the data
+# version, so this only clears out old versions
+RENDER_CACHE_S = 7 * 24 * 3600
+# redirect video requests to presigned s3 urls instead of proxying bytes
+MEDIA_PRESIGNED = os.environ.get('MEDIA_PRESIGNED', '') == '1'
+# the layout renders the first week, so dash versions that can skip the
+# callbacks on page load (1.19 and later) do
+SKIP_INITIAL_CALL = ({'prevent_initial_call': True}
+                     if tuple(int(x) for x in dash.__version__.split('.')[:2])
+                     >= (1, 19) else {})
+# family shown by the dashboard (the address its emails are sent to, see
+# lambda_function.email_family), '' for all items
+DASH_FAMILY = os.environ.get('DASH_FAMILY', '').lower()
+
+
+def get_logger():
+    return logging.getLogger("application")
+
 
 def compute_week_start(date):
     day = dt.strptime(date, DATE_FMT)
@@ -29,80 +77,167 @@ def compute_week_start(date):
     return start_week.strftime(DATE_FMT)
 
 
-def create_app(is_test: bool=False):
+def cached_render(cache: SharedCache, key: str, data: Dict,
+                  render: Callable[[Dict], Any]) -> Any:
+    """
+    Panel of a week, rendered and serialized once per version of the week's
+    data (its HighWaterMark, which every ingest moves)
+
+    :param key: panel, family, child and week
+    :param data: the week's data, from cache_week_data
+    """
+    output_json = cache.get_or_fill(
+        'render-{}-{}'.format(key, data.get('HighWaterMark', '')),
+        lambda _: json.dumps(render(data), cls=PlotlyJSONEncoder),
+        timeout=RENDER_CACHE_S
+    )
+    return json.loads(output_json)
+
+
+def manifest_media(entry: Dict[str, Any], width: int):
+    """
+    Image or video element of a media manifest entry, sized from the manifest
+    so the layout does not wait for the media
+
+    :param entry: see media_manifest.MediaEntry
+    :param width: width to show it at
+    """
+    media_key = entry['media_name']
+    # a video's dimensions are those of its poster frame
+    sized = [entry] + entry['derivatives']
+    sized = [x for x in sized if x['width'] and x['height']]
+    size = {}
+    if sized:
+        size['height'] = '{:d}'.format(
+            int(width * sized[0]['height'] / sized[0]['width']))
+    if is_video(media_key):
+        return html.Video(
+            src='/media/{}'.format(media_key),
+            poster='/media/{}'.format(poster_name(media_key)),
+            controls=True,
+            preload='metadata',
+            width='{:d}'.format(width),
+            **size
+        )
+    return html.Img(src='/media/{}'.format(media_key),
+                    width='{:d}'.format(width), **size)
+
+
+def create_app(is_test: bool=False, snapshot_path: Optional[str]=None,
+               family: Optional[str]=None):
+    """
+    :param is_test: show the test data instead of querying SimpleDB
+    :param snapshot_path: show the data in a snapshot file (see snapshot.py)
+        instead of querying SimpleDB
+    :param family: family to show, defaults to DASH_FAMILY
+    """
+    family = DASH_FAMILY if family is None else family
     app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
     app.title = 'Daycare Activity Log'
     app.config['TESTING'] = is_test
+    if snapshot_path:
+        snapshot = Snapshot(snapshot_path)
+    elif is_test:
+        snapshot = get_test_snapshot()
+    else:
+        snapshot = None
     # required if callbacks are in a different file
     # app.config.suppress_callback_exceptions = True
 
-    # set up a cache for memory.
-    # Simple is in memory pickle, redis is suggested for higher performance...
-    cache_config = {
-        'CACHE_TYPE': 'simple'
-    }
-    cache = Cache()
-    cache.init_app(app.server, config=cache_config)
+    # in process by default, set DASH_CACHE to share it between workers
+    cache = SharedCache(app.server)
+    app.shared_cache = cache
 
-    if is_test:
-        start_date = dt(2018, 10, 1)
+    if snapshot:
+        start_date = dt(2018, 10, 1).strftime(DATE_FMT)
+        notes_index = open_index(':memory:')
+        index_items(notes_index, snapshot.all_items())
     else:
         start_date = dt.today().strftime(DATE_FMT)
+        try:
+            notes_index = open_index(create=False)
+        except IndexMissing as e:
+            # searches show the error instead of an empty result
+            get_logger().error(str(e))
+            notes_index = None
+            index_error = str(e)
 
-    app.layout = html.Div(children=[
-        html.H1(children="Emilia's Gretchen's House Activities"),
-        html.H2(children="Naps"),
-        html.Div([
-            html.Div(children="Week Date:",
-                     className="two columns"),
-            html.Div([
-                dcc.DatePickerSingle(
-                    id='date-picker-week',
-                    date=start_date,
-                    min_date_allowed=dt(2018, 9, 1),
-                    max_date_allowed=dt.today(),
-                    initial_visible_month=start_date
-                )],
-                className="two columns"
-            )
-        ], className="row"),
-        dcc.Graph(id='nap-time-bar-graph'),
-        html.H2(children="Activity Notes"),
-        html.Table(id='activity-table'),
-        html.H2(children="Media"),
-        html.Div(id="media-div"),
-        html.Div(id="data-div", style={"display": "none"})
-    ])
-
-    # cache for events data
     @cache.memoize()
-    def cache_week_data(date) -> Dict:
-        if app.config['TESTING']:
-            return get_test_week_data()
-        else:
-            return get_week_data(date)
+    def cache_snapshot_history():
+        return items_to_frame(filter_items(snapshot.all_items(), family))
 
-    @app.callback(
-        dash.dependencies.Output('data-div', 'children'),
-        [dash.dependencies.Input('date-picker-week', 'date')]
-    )
-    def compute_week_data(date):
-        week_start = compute_week_start(date)
-        cache_week_data(week_start)
-        return week_start
+    def cache_history():
+        """
+        The family's full activity history, refreshed incrementally like
+        cache_week_data
+        """
+        if snapshot:
+            return cache_snapshot_history()
 
-    @app.callback(
-        dash.dependencies.Output('nap-time-bar-graph', 'figure'),
-        [dash.dependencies.Input('data-div', 'children')]
-    )
-    def update_nap_graph(date) -> Dict[str, Any]:
+        cached = cache.get_or_fill(
+            'history-{}'.format(family),
+            lambda x: (time.time(),
+                       get_history(x[1] if x else None, family)),
+            lambda x: time.time() - x[0] < HISTORY_REFRESH_S
+        )
+        return cached[1]
+
+    def cache_children() -> List[str]:
         """
-        Plot sleep time
+        Children to list, from a query of recent naps kept for
+        HISTORY_REFRESH_S; the history (which the trends load anyway) if
+        nobody napped lately
         """
-        data = cache_week_data(date)
+        if snapshot:
+            return children(cache_snapshot_history())
+        cached = cache.get_or_fill(
+            'children-{}'.format(family),
+            lambda _: (time.time(), recent_children(family)),
+            lambda x: time.time() - x[0] < HISTORY_REFRESH_S
+        )
+        return cached[1] or children(cache_history())
+
+    def cache_week_data(date: str, child: str) -> Dict:
+        """
+        A child's week data, kept without expiring. Once it is older than
+        WEEK_REFRESH_S, only the newly ingested items are queried and merged in
+        """
+        if snapshot:
+            # a binary search in the snapshot, no need to cache
+            week_end = dt.strptime(date, DATE_FMT) + timedelta(days=6)
+            return {'Items': filter_items(
+                snapshot.items_between(date, week_end.strftime(DATE_FMT)),
+                family, child)}
+
+        def fill(cached):
+            data = get_week_data(date, cached, family, child)
+            data['FetchedAt'] = time.time()
+            return data
 
+        return cache.get_or_fill(
+            'week-data-{}-{}-{}'.format(family, child, date), fill,
+            lambda x: time.time() - x['FetchedAt'] < WEEK_REFRESH_S,
+            as_json=True, kind='week-data'
+        )
+
+    def week_render(name: str, week_start: str, child: str, data: Dict,
+                    render: Callable[[Dict], Any]) -> Any:
+        return cached_render(
+            cache, '{}-{}-{}-{}'.format(name, family, child, week_start),
+            data, render)
+
+    def title(child: str) -> str:
+        if child:
+            return "{}'s Gretchen's House Activities".format(child)
+        return "Gretchen's House Activities"
+
+    def nap_figure(data: Dict) -> Dict[str, Any]:
         # parse out nap times
         naps = compute_nap_times(data['Items'])
+        if not naps:
+            # e.g., the current week on a Monday morning, which the layout
+            # renders too
+            return {'data': [], 'layout': {'title': 'Naps'}}
         nap_start, nap_length_s = zip(*naps)
 
         # compute average, convert to minutes
@@ -130,13 +265,167 @@ def create_app(is_test: bool=False):
             }
         }
 
+    def week_panels(week_start: str, child: str) -> List:
+        """
+        Nap graph and activity table of a week, from one read of its data
+        """
+        data = cache_week_data(week_start, child)
+        return [
+            dcc.Graph(id='nap-time-bar-graph',
+                      figure=week_render('nap-graph', week_start, child,
+                                         data, nap_figure)),
+            html.H2(children="Activity Notes"),
+            html.Table(id='activity-table',
+                       children=week_render(
+                           'activity-table', week_start, child, data,
+                           lambda x: get_activty_table(
+                               expand_notes(x['Items']))))
+        ]
+
+    def serve_layout():
+        """
+        Layout for each page load, so newly enrolled children are listed
+        """
+        child_names = cache_children()
+        child = child_names[0] if child_names else ''
+        try:
+            first_week = week_panels(compute_week_start(start_date), child)
+        except Exception as e:
+            # the page still loads, picking a date renders the week
+            get_logger().error('Error rendering first week: {}'.format(e))
+            first_week = []
+        return html.Div(children=[
+            html.H1(id='title', children=title(child)),
+            html.Div([
+                html.Div(children="Child:",
+                         className="two columns"),
+                html.Div([
+                    dcc.Dropdown(
+                        id='child-select',
+                        options=[{'label': x, 'value': x}
+                                 for x in child_names],
+                        value=child,
+                        clearable=False
+                    )],
+                    className="two columns"
+                )
+            ], className="row"),
+            html.H2(children="Naps"),
+            html.Div([
+                html.Div(children="Week Date:",
+                         className="two columns"),
+                html.Div([
+                    dcc.DatePickerSingle(
+                        id='date-picker-week',
+                        date=start_date,
+                        min_date_allowed=dt(2018, 9, 1),
+                        max_date_allowed=dt.today(),
+                        initial_visible_month=start_date
+                    )],
+                    className="two columns"
+                )
+            ], className="row"),
+            html.Div(id='week-div', children=first_week),
+            html.H2(children="Search Notes"),
+            dcc.Input(id='search-input', type='text', value='',
+                      placeholder='Search all notes'),
+            html.Table(id='search-table'),
+            html.H2(children="Trends"),
+            dcc.RadioItems(
+                id='trend-period',
+                options=[{'label': x.title(), 'value': x} for x in PERIODS],
+                value='month',
+                labelStyle={'display': 'inline-block'}
+            ),
+            dcc.Graph(id='nap-trend-graph'),
+            dcc.Graph(id='meal-heatmap'),
+            dcc.Graph(id='diaper-heatmap'),
+            dcc.Graph(id='activity-count-graph'),
+            html.H2(children="Media"),
+            html.Div(id="media-div")
+        ])
+
+    app.layout = serve_layout
+
     @app.callback(
-        dash.dependencies.Output('activity-table', 'children'),
-        [dash.dependencies.Input('data-div', 'children')]
+        dash.dependencies.Output('title', 'children'),
+        [dash.dependencies.Input('child-select', 'value')],
+        **SKIP_INITIAL_CALL
     )
-    def update_activity_table(date):
-        data = cache_week_data(date)
-        return get_activty_table(data['Items'])
+    def update_title(child):
+        return title(child)
+
+    @app.callback(
+        dash.dependencies.Output('week-div', 'children'),
+        [dash.dependencies.Input('date-picker-week', 'date'),
+         dash.dependencies.Input('child-select', 'value')],
+        **SKIP_INITIAL_CALL
+    )
+    def update_week(date, child):
+        """
+        Every panel of the week in one request (dash before 0.39 has no
+        callbacks with several outputs, so they share a container)
+        """
+        return week_panels(compute_week_start(date), child or '')
+
+    @app.callback(
+        dash.dependencies.Output('search-table', 'children'),
+        [dash.dependencies.Input('search-input', 'value'),
+         dash.dependencies.Input('child-select', 'value')]
+    )
+    def update_search(query, child):
+        if notes_index is None:
+            return [html.Tr([html.Td(index_error)])] if query else []
+        return get_search_table(search(notes_index, query or '',
+                                       first_name=child or None,
+                                       family=family))
+
+    @app.callback(
+        dash.dependencies.Output('nap-trend-graph', 'figure'),
+        [dash.dependencies.Input('trend-period', 'value'),
+         dash.dependencies.Input('child-select', 'value')]
+    )
+    def update_nap_trend(period, child):
+        return nap_trend(child_history(cache_history(), child), period)
+
+    @app.callback(
+        dash.dependencies.Output('meal-heatmap', 'figure'),
+        [dash.dependencies.Input('trend-period', 'value'),
+         dash.dependencies.Input('child-select', 'value')]
+    )
+    def update_meal_heatmap(period, child):
+        return hourly_heatmap(child_history(cache_history(), child), 'Meal',
+                              period)
+
+    @app.callback(
+        dash.dependencies.Output('diaper-heatmap', 'figure'),
+        [dash.dependencies.Input('trend-period', 'value'),
+         dash.dependencies.Input('child-select', 'value')]
+    )
+    def update_diaper_heatmap(period, child):
+        return hourly_heatmap(child_history(cache_history(), child),
+                              'Diaper', period)
+
+    @app.callback(
+        dash.dependencies.Output('activity-count-graph', 'figure'),
+        [dash.dependencies.Input('trend-period', 'value'),
+         dash.dependencies.Input('child-select', 'value')]
+    )
+    def update_activity_counts(period, child):
+        return activity_counts(child_history(cache_history(), child),
+                               period)
+
+    @app.server.route('/media/<path:media_key>')
+    def serve_media(media_key):
+        """
+        Media straight from s3, honoring Range requests so <video> can seek
+        """
+        if MEDIA_PRESIGNED:
+            return flask.redirect(presigned_media_url(media_key))
+        status, headers, body = stream_media(
+            media_key, flask.request.headers.get('Range'))
+        return flask.Response(body, status=status, headers=headers,
+                              direct_passthrough=True)
 
     # cache for images
     @cache.memoize()
@@ -149,19 +438,37 @@ def create_app(is_test: bool=False):
 
     @app.callback(
         dash.dependencies.Output('media-div', 'children'),
-        [dash.dependencies.Input('data-div', 'children')]
+        [dash.dependencies.Input('date-picker-week', 'date'),
+         dash.dependencies.Input('child-select', 'value')]
     )
-    def update_media(date):
-        week_start = compute_week_start(date)
-        data = cache_week_data(week_start)
+    def update_media(date, child):
+        """
+        Media of the week, a request of its own so the other panels do not
+        wait for it
+        """
+        week_start, child = compute_week_start(date), child or ''
+        img_width = 700
+        manifest = None
+        if family and not (is_test or snapshot):
+            manifest = get_media_manifest(family, week_start)
+        if manifest:
+            # sizes are known, so the browser fetches the images
+            return [manifest_media(x, img_width) for x in manifest['media']]
+
+        data = cache_week_data(week_start, child)
         media_keys = get_media_keys(data)
         img_out = []
         src_fstr = 'data:image/{};base64,{}'
-        img_width = 700
         for media_key in media_keys:
             _, ext = os.path.splitext(media_key)
-            if ext.upper() == '.MP4':
-                print('Skipping download of video {}'.format(media_key))
+            if is_video(media_key):
+                img_out.append(html.Video(
+                    src='/media/{}'.format(media_key),
+                    poster='/media/{}'.format(poster_name(media_key)),
+                    controls=True,
+                    preload='metadata',
+                    width='{:d}'.format(img_width)
+                ))
                 continue
             img_base64, img_size = cache_images(media_key)
             img_aspect = img_size[0] / img_size[1]
@@ -172,5 +479,4 @@ def create_app(is_test: bool=False):
                                     height='{:d}'.format(img_height)))
         return img_out
 
-
     return app
@@ -0,0 +1,252 @@
+"""
+Cache shared by every worker process of the dashboard.
+
+The backend is set with environment variables:
+
+- DASH_CACHE: 'simple' (default, in process), 'filesystem' or 'redis'
+- DASH_CACHE_DIR: directory for 'filesystem'
+- DASH_CACHE_REDIS_URL: url for 'redis', e.g., redis://localhost:6379/0
+
+get_or_fill lets only one worker (process or thread) fill a missing or stale
+key while the others wait for its result, so a cold week is queried from
+SimpleDB once instead of once per worker.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import flask
+from flask_caching import Cache, backends
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # windows, where only the in process lock is used
+    fcntl = None
+
+DASH_CACHE = os.environ.get('DASH_CACHE', 'simple')
+DASH_CACHE_DIR = os.environ.get(
+    'DASH_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'kaymbu-dash-cache'))
+DASH_CACHE_REDIS_URL = os.environ.get('DASH_CACHE_REDIS_URL',
+                                      'redis://localhost:6379/0')
+# entries kept by the filesystem cache before it starts deleting
+CACHE_THRESHOLD = 5000
+# seconds a worker waits for another one to fill a key before filling it too
+LOCK_TIMEOUT_S = 30
+LOCK_POLL_S = 0.05
+# seconds between reports of the hit and miss counts to metrics
+STATS_REPORT_S = 60
+_STAT_METRICS = {'hits': 'cache_hit', 'misses': 'cache_miss'}
+
+
+# Flask-Caching 2 names backends by class
+_BACKEND_CLASSES = {'simple': 'SimpleCache',
+                    'filesystem': 'FileSystemCache',
+                    'redis': 'RedisCache'}
+
+
+def cache_config(cache_type: Optional[str]=None,
+                 cache_dir: Optional[str]=None) -> Dict[str, Any]:
+    """
+    Flask-Caching config for a backend, defaults from the environment
+    """
+    cache_type = cache_type or DASH_CACHE
+    if cache_type == 'simple':
+        config = {}
+    elif cache_type == 'filesystem':
+        config = {'CACHE_DIR': cache_dir or DASH_CACHE_DIR,
+                  'CACHE_THRESHOLD': CACHE_THRESHOLD}
+    elif cache_type == 'redis':
+        config = {'CACHE_REDIS_URL': DASH_CACHE_REDIS_URL}
+    else:
+        raise ValueError('Unknown cache type {}'.format(cache_type))
+    if hasattr(backends, 'SimpleCache'):
+        config['CACHE_TYPE'] = _BACKEND_CLASSES[cache_type]
+    else:
+        config['CACHE_TYPE'] = cache_type
+    return config
+
+
+class SharedCache:
+    """
+    Flask-Caching cache with single-flight fills and hit/miss counts
+
+    :param server: flask app
+    :param config: Flask-Caching config, see cache_config
+    """
+    def __init__(self, server: flask.Flask,
+                 config: Optional[Dict[str, Any]]=None):
+        self.config = config or cache_config()
+        self.cache = Cache()
+        self.cache.init_app(server, config=self.config)
+        self.memoize = self.cache.memoize
+        self.stats = {'hits': 0, 'misses': 0, 'fills': 0, 'waits': 0}
+        # same, per kind of key (see get_or_fill)
+        self.kind_stats = {}
+        self._stats_lock = threading.Lock()
+        self._reported = dict(self.stats)
+        self._reported_at = time.time()
+        # key: [thread lock, threads holding or waiting for it]
+        self._key_locks = {}
+
+    def _count(self, stat: str, kind: str='') -> None:
+        with self._stats_lock:
+            self.stats[stat] += 1
+            if kind:
+                kind_stats = self.kind_stats.setdefault(
+                    kind, dict.fromkeys(self.stats, 0))
+                kind_stats[stat] += 1
+        if time.time() - self._reported_at >= STATS_REPORT_S:
+            self.report_stats()
+
+    def report_stats(self) -> None:
+        """
+        Emit the hits and misses since the last report as one metric each
+        """
+        with self._stats_lock:
+            counts = {x: self.stats[x] - self._reported[x]
+                      for x in _STAT_METRICS}
+            self._reported = dict(self.stats)
+            self._reported_at = time.time()
+        for stat, count in sorted(counts.items()):
+            if count:
+                metrics.emit(_STAT_METRICS[stat], 0, count)
+
+    def get(self, key: str) -> Any:
+        return self.cache.get(key)
+
+    def set(self, key: str, value: Any, timeout: int=0) -> None:
+        self.cache.set(key, value, timeout=timeout)
+
+    def get_json(self, key: str) -> Any:
+        """
+        Values stored as JSON text: backends pickle what they store, and
+        pickling a string is much cheaper than pickling a large dict
+        """
+        data = self.cache.get(key)
+        return None if data is None else json.loads(data)
+
+    def set_json(self, key: str, value: Any, timeout: int=0) -> None:
+        self.cache.set(key, json.dumps(value, separators=(',', ':')),
+                       timeout=timeout)
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """
+        Hold a key against other threads and (for the filesystem and redis
+        backends) other processes
+        """
+        with self._stats_lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                cache_type = self.config['CACHE_TYPE']
+                if cache_type in ['filesystem', 'FileSystemCache'] and fcntl:
+                    with self._file_lock(key):
+                        yield
+                elif cache_type in ['redis', 'RedisCache']:
+                    with self._redis_lock(key):
+                        yield
+                else:
+                    yield
+        finally:
+            with self._stats_lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    @contextmanager
+    def _file_lock(self, key: str) -> Iterator[None]:
+        """
+        flock on a file per key, removed when it is released
+        """
+        lock_dir = self.config['CACHE_DIR'].rstrip('/\\') + '.locks'
+        os.makedirs(lock_dir, exist_ok=True)
+        lock_path = os.path.join(
+            lock_dir, hashlib.md5(key.encode('utf-8')).hexdigest())
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # the worker before may have removed it while this one waited
+                if os.stat(lock_path).st_ino == \
+                        os.fstat(lock_file.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        try:
+            yield
+        finally:
+            # removed while held, so waiters on it open a new file
+            os.remove(lock_path)
+            lock_file.close()
+
+    @contextmanager
+    def _redis_lock(self, key: str) -> Iterator[None]:
+        """
+        Lock entry holding a token, which expires after LOCK_TIMEOUT_S
+        """
+        lock_key = 'lock-{}'.format(key)
+        token = uuid.uuid4().hex
+        deadline = time.time() + LOCK_TIMEOUT_S
+        # add only sets a key that does not exist
+        while not self.cache.add(lock_key, token, timeout=LOCK_TIMEOUT_S):
+            if time.time() > deadline:
+                break
+            time.sleep(LOCK_POLL_S)
+        try:
+            yield
+        finally:
+            # once it expired, the lock can belong to another worker
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def get_or_fill(self, key: str, fill: Callable[[Any], Any],
+                    is_fresh: Optional[Callable[[Any], bool]]=None,
+                    timeout: int=0, as_json: bool=False,
+                    kind: str='') -> Any:
+        """
+        Cached value of a key, filled by one worker at a time when it is
+        missing or stale
+
+        :param key: cache key
+        :param fill: function(stale value or None) -> new value
+        :param is_fresh: function(value) -> False if it should be refilled
+        :param timeout: seconds to keep the value, 0 for no expiry
+        :param as_json: store the value as JSON text, see get_json
+        :param kind: kind of key (e.g., 'week-data') to count in kind_stats
+        """
+        get = self.get_json if as_json else self.get
+        put = self.set_json if as_json else self.set
+
+        def usable(value):
+            return value is not None and (is_fresh is None or is_fresh(value))
+
+        value = get(key)
+        if usable(value):
+            self._count('hits', kind)
+            return value
+
+        self._count('misses', kind)
+        with self.lock(key):
+            # another worker may have filled it while this one waited
+            latest = get(key)
+            if usable(latest):
+                self._count('waits', kind)
+                return latest
+            start = time.perf_counter()
+            value = fill(latest)
+            put(key, value, timeout)
+            self._count('fills', kind)
+            metrics.emit('cache_fill', (time.perf_counter() - start) * 1000)
+            return value
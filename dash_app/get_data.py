@@ -4,7 +4,7 @@ import logging
 import os
 import re
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import boto3
 import botocore
@@ -13,10 +13,31 @@ import dateutil.parser
 import pandas as pd
 from PIL import Image
 
+from long_notes import get_notes
+from media_manifest import get_manifest
+from note_parse import is_video
+from sdb_modify_domain import (
+    EPOCH_ATTRIBUTE,
+    epoch_range,
+    missing_epochs,
+    read_domains,
+    select_shards,
+    sortable_epoch,
+    unique_items
+)
+
 
 s3 = boto3.resource('s3')
 sdb = boto3.client('sdb')
 
+# ingest stamps an email's items with one ingest_datetime before writing
+# them, so an item can be stored after items with later stamps were read.
+# Incremental queries look back this far (the longest an ingest runs) past
+# the high water mark
+INGEST_WINDOW_S = 900
+# domains whose items all have EPOCH_ATTRIBUTE, see _missing_epochs
+_EPOCH_DOMAINS = set()
+
 
 def get_logger():
     return logging.getLogger("get_data")
@@ -121,71 +142,249 @@ def html_table_from_df(df: pd.DataFrame) -> html.Table:
 
 
 def get_activty_table(items: List[Dict]) -> html.Table:
+    columns = ['Date', 'Topic', 'Description']
     df = df_from_items(_get_item_by_activity(items,
                                              'Activity'))
+    if df.empty:
+        # e.g., a week with only naps and meals
+        return html_table_from_df(pd.DataFrame(columns=columns))
     df['Date'] = df['start_datetime'].apply(
         lambda x: dateutil.parser.parse(x).strftime('%Y-%m-%d %H:%M %p')
     )
     df['Topic'] = df['result']
     df['Description'] = df['notes'].apply(lambda x: py_html.unescape(x))
-    return html_table_from_df(df.loc[:, ['Date', 'Topic', 'Description']])
+    return html_table_from_df(df.loc[:, columns])
+
+
+def expand_notes(items: List[Dict]) -> List[Dict]:
+    """
+    Activity items with the full text of long notes (see long_notes.py) in
+    place of their previews, fetched in parallel
+    """
+    activities = _get_item_by_activity(items, 'Activity')
+    keys = [_get_attribute(x, 'notes_key') for x in activities]
+    texts = get_notes(s3.meta.client, MEDIA_BUCKET, [x for x in keys if x])
+    expanded = []
+    for item, key in zip(activities, keys):
+        if key:
+            item = dict(item, Attributes=[
+                dict(x, Value=texts[key]) if x['Name'] == 'notes' else x
+                for x in item['Attributes']])
+        expanded.append(item)
+    return expanded
+
+
+def get_search_table(hits: List[Dict]) -> html.Table:
+    """
+    Table of note search hits (see notes_index.search)
+    """
+    df = pd.DataFrame(hits, columns=['date', 'activity', 'result', 'snippet'])
+    df.columns = ['Date', 'Activity', 'Topic', 'Description']
+    return html_table_from_df(df)
+
+
+def _get_attribute(item: Dict, name: str, default: Any=None) -> Any:
+    for atrib in item['Attributes']:
+        if atrib['Name'] == name:
+            return atrib['Value']
+    return default
+
+
+def _quote(value: str) -> str:
+    """
+    SimpleDB string literal
+    """
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def partition_filter(family: str='', first_name: str='') -> str:
+    """
+    Conditions (' and ...') for a select_shards query format, keeping one
+    family's and/or one child's items. Media is for the whole family, so
+    every child keeps it
+
+    :param family: family attribute, '' for all families
+    :param first_name: child, '' for all children
+    """
+    conditions = []
+    if family:
+        conditions.append('`family` = {}'.format(_quote(family)))
+    if first_name:
+        conditions.append('(`first_name` = {} or `activity` = "Media")'.format(
+            _quote(first_name)))
+    # braces would be taken as format fields by select_shards
+    return ''.join(' and ' + x for x in conditions).replace(
+        '{', '{{').replace('}', '}}')
+
+
+def filter_items(items: List[Dict], family: str='',
+                 first_name: str='') -> List[Dict]:
+    """
+    Same as partition_filter, for items that are already loaded
+    """
+    return [
+        x for x in items
+        if (not family or _get_attribute(x, 'family') == family) and
+        (not first_name or _get_attribute(x, 'first_name') == first_name or
+         _get_attribute(x, 'activity') == 'Media')
+    ]
+
+
+def high_water_mark(items: List[Dict], start: str='') -> str:
+    """
+    Latest ingest time of items (or start if no item is newer)
+    """
+    ingest_times = [_get_attribute(x, 'ingest_datetime', '') for x in items]
+    return max([start] + ingest_times)
+
+
+def incremental_since(mark: str) -> str:
+    """
+    ingest_datetime an incremental query starts from: INGEST_WINDOW_S before
+    a high water mark
+    """
+    if not mark:
+        return mark
+    since = dateutil.parser.parse(mark) - timedelta(seconds=INGEST_WINDOW_S)
+    return since.isoformat()
+
+
+def merge_week_items(items: List[Dict],
+                     new_items: List[Dict]) -> List[Dict]:
+    """
+    Replace/add items by item name
+    """
+    new_names = set(x['Name'] for x in new_items)
+    return [x for x in items if x['Name'] not in new_names] + new_items
+
+
+def _item_epoch(item: Dict) -> str:
+    epoch = _get_attribute(item, EPOCH_ATTRIBUTE)
+    return epoch or sortable_epoch(_get_attribute(item, 'start_datetime'))
+
+
+def _missing_epochs(domain: str) -> bool:
+    """
+    sdb_modify_domain.missing_epochs, remembering domains without: ingest
+    and migrate_legacy always write EPOCH_ATTRIBUTE, so they stay that way
+    """
+    if domain in _EPOCH_DOMAINS:
+        return False
+    if missing_epochs(sdb, domain):
+        return True
+    _EPOCH_DOMAINS.add(domain)
+    return False
 
 
-def get_week_data(date: str) -> Dict:
+def get_week_data(date: str, cached: Optional[Dict]=None, family: str='',
+                  first_name: str='') -> Dict:
     """
     Query the weeks worth of data from SimpleDB
+
+    Only the shard domains that overlap the week are queried (in parallel).
+    Items are selected by their EPOCH_ATTRIBUTE, and in domains where some
+    items do not have it yet (see sdb_modify_domain.backfill_epochs) also by
+    their start_datetime.
+
+    :param date: a date in the week, YYYY-MM-DD
+    :param cached: previous result for this week. If given, only items
+        ingested since its high water mark are queried and merged in, unless
+        one of those items was reprocessed, then the week is fully re-queried
+    :param family: only this family's items, see partition_filter
+    :param first_name: only this child's items (and the family's media)
+    :return: {'Items': items, 'HighWaterMark': latest ingest time}
     """
     date_fmt = "%Y-%m-%d"
     day = datetime.strptime(date, date_fmt)
-    select_cols = ['result', 'activity', 'start_datetime', 'end_datetime',
-                   'notes']
+    select_cols = ['first_name', 'family', 'result', 'activity',
+                   'start_datetime', 'end_datetime', 'notes', 'notes_key',
+                   'ingest_datetime', 'ingest_mode', EPOCH_ATTRIBUTE]
     week_start = day - timedelta(days=day.weekday())
     week_end = week_start + timedelta(days=6)
-    query_str = 'select {} from `gretchens-notes-db` where ' + \
-        '`start_datetime` >= "{}" and `start_datetime` <= "{}"'
+    # start_datetime strings have UTC offsets, so compare the UTC epochs
+    query_str = 'select {} from `{{domain}}` where ' + \
+        '`{}` >= "{}" and `{}` < "{}"'
+    epoch_start, epoch_end = epoch_range(week_start.strftime(date_fmt),
+                                         week_end.strftime(date_fmt))
     query_str = query_str.format(','.join(select_cols),
-                                 week_start.strftime(date_fmt),
-                                 week_end.strftime(date_fmt))
-    out_data = None
-    next_token = ''
-    while True:
-        res = sdb.select(
-            SelectExpression=query_str,
-            NextToken=next_token
-        )
-
-        if not out_data:
-            out_data = res
-        else:
-            out_data['Items'].extend(res['Items'])
-
-        if 'NextToken' not in res:
-            break
-        else:
-            next_token = res['NextToken']
-
-    if 'NextToken' in out_data:
-        del out_data['NextToken']
-
-    return out_data
+                                 EPOCH_ATTRIBUTE, epoch_start,
+                                 EPOCH_ATTRIBUTE, epoch_end)
+    query_str += partition_filter(family, first_name)
+    # order by needs its attribute in the where clause, which it is
+    order_by = ' order by `{}`'.format(EPOCH_ATTRIBUTE)
+    domains = read_domains(week_start.strftime(date_fmt),
+                           week_end.strftime(date_fmt))
+    # items stored before EPOCH_ATTRIBUTE, by their start_datetime strings a
+    # day wider on each side (for the UTC offsets), then by their epochs
+    legacy_domains = [x for x in domains if _missing_epochs(x)]
+    legacy_query_str = 'select {} from `{{domain}}` where `{}` is null and ' \
+        '`start_datetime` >= "{}" and `start_datetime` < "{}"'.format(
+            ','.join(select_cols), EPOCH_ATTRIBUTE,
+            (week_start - timedelta(days=1)).strftime(date_fmt),
+            (week_end + timedelta(days=2)).strftime(date_fmt))
+    legacy_query_str += partition_filter(family, first_name)
+
+    def select_week(condition: str='', consistent: bool=False) -> List[Dict]:
+        items = select_shards(sdb, query_str + condition + order_by, domains,
+                              consistent)
+        if not legacy_domains:
+            return items
+        legacy = select_shards(sdb, legacy_query_str + condition,
+                               legacy_domains, consistent)
+        legacy = [x for x in legacy
+                  if epoch_start <= _item_epoch(x) < epoch_end]
+        # a reprocessed legacy item has a shard copy with EPOCH_ATTRIBUTE
+        return sorted(unique_items(legacy + items), key=_item_epoch)
+
+    if cached and 'HighWaterMark' in cached:
+        last_mark = cached['HighWaterMark']
+        # consistent, so no item written before the mark is still invisible
+        new_items = select_week(' and `ingest_datetime` >= "{}"'.format(
+            incremental_since(last_mark)), consistent=True)
+        seen = set((x['Name'], _get_attribute(x, 'ingest_datetime', ''))
+                   for x in cached['Items'])
+        reprocessed = [
+            x for x in new_items
+            if (x['Name'], _get_attribute(x, 'ingest_datetime', ''))
+            not in seen and _get_attribute(x, 'ingest_mode') == 'reprocess'
+        ]
+        if not reprocessed:
+            return {
+                'Items': merge_week_items(cached['Items'], new_items),
+                'HighWaterMark': high_water_mark(new_items, last_mark)
+            }
+        get_logger().info('Week {} was reprocessed, doing full refresh'.format(
+            week_start.strftime(date_fmt)))
+
+    items = select_week()
+    return {'Items': items, 'HighWaterMark': high_water_mark(items)}
 
 
 def get_media_keys(data: Dict[str, Any]) -> List[str]:
     """
-    Parse data for media keys
+    Parse data for media keys, once each (items of media sent again point
+    to the same stored file)
     """
     media_data = _get_item_by_activity(data['Items'], 'Media')
     media_keys = []
     for media_item in media_data:
         for atrib in media_item['Attributes']:
             if atrib['Name'] == 'result':
-                media_keys.append(atrib['Value'])
+                if atrib['Value'] not in media_keys:
+                    media_keys.append(atrib['Value'])
                 break
     return media_keys
 
 
+MEDIA_BUCKET = "gretchens-house-emails"
+# bytes per chunk when streaming media out of s3
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+
 def download_media(media_key: str):
-    bucket = "gretchens-house-emails"
+    if is_video(media_key):
+        raise ValueError('Use stream_media for video {}'.format(media_key))
+    bucket = MEDIA_BUCKET
     key = '/'.join(['media', media_key])
     try:
         data = s3.Object(bucket, key).get()['Body'].read()
@@ -224,3 +423,57 @@ def download_media(media_key: str):
     return img_out_stream.getvalue(), img.size
 
 
+def get_media_manifest(family: str, week_start: str) -> Optional[Dict]:
+    """
+    Media manifest of a family's week (see media_manifest.py), None if
+    ingest has not made one
+    """
+    return get_manifest(s3.meta.client, MEDIA_BUCKET, family, week_start)
+
+
+def presigned_media_url(media_key: str, expires_s: int=300) -> str:
+    """
+    Short lived url so the browser can get media straight from s3
+    """
+    return s3.meta.client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': MEDIA_BUCKET,
+                'Key': '/'.join(['media', media_key])},
+        ExpiresIn=expires_s
+    )
+
+
+def stream_media(media_key: str,
+                 byte_range: Optional[str]=None
+                 ) -> Tuple[int, Dict[str, str], Iterator[bytes]]:
+    """
+    Stream (part of) a media object from s3 without holding it in memory
+
+    :param media_key: key under media/
+    :param byte_range: HTTP Range header value, e.g., 'bytes=0-1023'
+    :return: HTTP status, headers, and an iterator over the body
+    """
+    kwargs = {'Bucket': MEDIA_BUCKET,
+              'Key': '/'.join(['media', media_key])}
+    if byte_range:
+        kwargs['Range'] = byte_range
+    try:
+        obj = s3.meta.client.get_object(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ['404', 'NoSuchKey']:
+            return 404, {}, iter([])
+        elif code == 'InvalidRange':
+            return 416, {}, iter([])
+        raise(e)
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(obj['ContentLength']),
+        'Content-Type': obj.get('ContentType', 'application/octet-stream')
+    }
+    status = 200
+    if 'ContentRange' in obj:
+        headers['Content-Range'] = obj['ContentRange']
+        status = 206
+    return status, headers, obj['Body'].iter_chunks(MEDIA_CHUNK_SIZE)
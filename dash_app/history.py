@@ -0,0 +1,273 @@
+"""
+Columnar activity history and long range (month, quarter, year) trends.
+
+The history is a DataFrame with one row per SimpleDB item. Trends are binned
+with NumPy on integer period codes, so cost does not depend on the number of
+Python objects per item.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from sdb_modify_domain import (
+    EPOCH_ATTRIBUTE,
+    epoch_range,
+    list_shard_domains,
+    read_domains,
+    select_shards
+)
+
+from . import get_data
+
+TIME_ZONE = 'US/Eastern'
+PERIODS = ['month', 'quarter', 'year']
+# days of naps recent_children looks at
+CHILDREN_LOOKBACK_DAYS = 90
+HISTORY_COLUMNS = ['name', 'first_name', 'family', 'activity', 'result',
+                   'start', 'end', 'ingest_datetime', 'ingest_mode']
+
+
+def get_logger():
+    return logging.getLogger("history")
+
+
+def items_to_frame(items: List[Dict]) -> pd.DataFrame:
+    """
+    History frame from SimpleDB items. Times are converted to local time
+    """
+    cols = {x: [] for x in HISTORY_COLUMNS}
+    atrib_cols = {'first_name': 'first_name', 'family': 'family',
+                  'activity': 'activity',
+                  'result': 'result', 'start_datetime': 'start',
+                  'end_datetime': 'end', 'ingest_datetime': 'ingest_datetime',
+                  'ingest_mode': 'ingest_mode'}
+    for item in items:
+        row = dict.fromkeys(HISTORY_COLUMNS)
+        row['name'] = item['Name']
+        for atrib in item['Attributes']:
+            if atrib['Name'] in atrib_cols:
+                row[atrib_cols[atrib['Name']]] = atrib['Value']
+        for col in HISTORY_COLUMNS:
+            cols[col].append(row[col])
+
+    frame = pd.DataFrame(cols, columns=HISTORY_COLUMNS, dtype=object)
+    for col in ['start', 'end']:
+        # media times have fractional seconds, drop them so one format fits
+        times = frame[col].str.replace(r'\.[0-9]+', '', regex=True)
+        frame[col] = pd.to_datetime(times, utc=True).dt.tz_convert(TIME_ZONE)
+    frame['activity'] = frame['activity'].astype('category')
+    frame['ingest_datetime'] = frame['ingest_datetime'].fillna('')
+    return frame
+
+
+def get_history(cached: Optional[pd.DataFrame]=None,
+                family: str='') -> pd.DataFrame:
+    """
+    Load the full activity history from all shards
+
+    :param cached: previous history. If given, only items ingested since its
+        latest ingest time are queried and merged in, unless one of them was
+        reprocessed (then everything is re-queried)
+    :param family: only this family's items, '' for all families
+    :return: history frame
+    """
+    sdb = get_data.sdb
+    domains = list_shard_domains(sdb)
+    select_cols = ['first_name', 'family', 'activity', 'result',
+                   'start_datetime', 'end_datetime', 'ingest_datetime',
+                   'ingest_mode']
+    query_str = 'select {} from `{{domain}}` where `start_datetime` > ""'
+    query_str = query_str.format(','.join(select_cols))
+    query_str += get_data.partition_filter(family)
+
+    if cached is not None and len(cached):
+        last_mark = cached['ingest_datetime'].max()
+        # see get_data.INGEST_WINDOW_S
+        new = items_to_frame(select_shards(
+            sdb,
+            query_str + ' and `ingest_datetime` >= "{}"'.format(
+                get_data.incremental_since(last_mark)),
+            domains,
+            consistent=True
+        ))
+        seen = set(zip(cached['name'], cached['ingest_datetime']))
+        is_new = np.array([x not in seen for x in zip(
+            new['name'], new['ingest_datetime'])], dtype=bool)
+        if not (new.loc[is_new, 'ingest_mode'] == 'reprocess').any():
+            merged = pd.concat([cached[~cached['name'].isin(new['name'])],
+                                new],
+                               ignore_index=True)
+            merged['activity'] = merged['activity'].astype('category')
+            return merged
+        get_logger().info('Items were reprocessed, reloading history')
+
+    return items_to_frame(select_shards(sdb, query_str, domains))
+
+
+def children(history: pd.DataFrame) -> List[str]:
+    """
+    First names of the children in a history, sorted
+    """
+    names = history.loc[history['activity'].astype(str) != 'Media',
+                        'first_name']
+    return sorted(x for x in names.dropna().unique() if x)
+
+
+def recent_children(family: str='',
+                    days: int=CHILDREN_LOOKBACK_DAYS) -> List[str]:
+    """
+    First names of the children who napped in the last days, sorted. Reads
+    one attribute of the recent naps instead of the whole history
+
+    :param family: only this family's children, '' for all families
+    :param days: days to look back
+    """
+    today = datetime.now(pytz.timezone(TIME_ZONE))
+    start = (today - timedelta(days=days)).strftime('%Y-%m-%d')
+    end = today.strftime('%Y-%m-%d')
+    query_str = 'select first_name from `{{domain}}` where ' \
+        '`activity` = "NapTimes" and `{0}` >= "{1}" and `{0}` < "{2}"'.format(
+            EPOCH_ATTRIBUTE, *epoch_range(start, end))
+    query_str += get_data.partition_filter(family)
+    items = select_shards(get_data.sdb, query_str, read_domains(start, end))
+    return sorted(set(x['Attributes'][0]['Value'] for x in items
+                      if x.get('Attributes')))
+
+
+def child_history(history: pd.DataFrame, first_name: str) -> pd.DataFrame:
+    """
+    One child's part of a history (with the family's media), all of it if
+    first_name is ''
+    """
+    if not first_name:
+        return history
+    return history[(history['first_name'] == first_name) |
+                   (history['activity'].astype(str) == 'Media')]
+
+
+def _period_bins(times: pd.Series, period: str) -> Tuple[np.ndarray,
+                                                         List[str]]:
+    """
+    Integer bin for each time (0 is the first period) and a label per bin
+    """
+    years = times.dt.year.values.astype(np.int64)
+    if period == 'year':
+        codes = years
+    elif period == 'quarter':
+        codes = years * 4 + (times.dt.month.values - 1) // 3
+    elif period == 'month':
+        codes = years * 12 + times.dt.month.values - 1
+    else:
+        raise ValueError('Unknown period "{}"'.format(period))
+
+    if not len(codes):
+        return codes, []
+    first = codes.min()
+    codes = codes - first
+    labels = []
+    for code in range(first, first + codes.max() + 1):
+        if period == 'year':
+            labels.append('{:d}'.format(code))
+        elif period == 'quarter':
+            labels.append('{:d}Q{:d}'.format(code // 4, code % 4 + 1))
+        else:
+            labels.append('{:d}-{:02d}'.format(code // 12, code % 12 + 1))
+    return codes, labels
+
+
+def _select_activity(history: pd.DataFrame, activity: str) -> pd.DataFrame:
+    mask = history['activity'].astype(str).str.upper() == activity.upper()
+    return history[mask & history['start'].notnull()]
+
+
+def nap_trend(history: pd.DataFrame, period: str) -> Dict:
+    """
+    Average nap length (minutes) per period, as a plotly bar figure
+    """
+    naps = _select_activity(history, 'NapTimes')
+    naps = naps[naps['end'].notnull()]
+    codes, labels = _period_bins(naps['start'], period)
+    minutes = (naps['end'] - naps['start']).dt.total_seconds().values / 60
+    counts = np.bincount(codes, minlength=len(labels))
+    totals = np.bincount(codes, weights=minutes, minlength=len(labels))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = totals / counts
+    has_naps = counts > 0
+    return {
+        'data': [
+            {'x': [x for x, y in zip(labels, has_naps) if y],
+             'y': averages[has_naps].round(1).tolist(),
+             'type': 'bar',
+             'name': 'average nap (min)'}
+        ],
+        'layout': {
+            'title': 'Average Nap Length by {}'.format(period.title())
+        }
+    }
+
+
+def hourly_heatmap(history: pd.DataFrame,
+                   activity: str,
+                   period: str) -> Dict:
+    """
+    Average number of activities per day, by period and hour of day, as a
+    plotly heatmap
+    """
+    acts = _select_activity(history, activity)
+    codes, labels = _period_bins(acts['start'], period)
+    hours = acts['start'].dt.hour.values
+    counts = np.bincount(codes * 24 + hours,
+                         minlength=len(labels) * 24).reshape(-1, 24)
+
+    # days that had any activity logged, per period
+    days = history.loc[history['start'].notnull(), 'start']
+    day_codes, day_labels = _period_bins(days, period)
+    day_keys = pd.Series(days.dt.normalize().values)
+    n_days = dict(zip(day_labels, np.bincount(
+        day_codes[~day_keys.duplicated().values],
+        minlength=len(day_labels))))
+    per_day = counts / np.maximum([n_days.get(x, 1) for x in labels],
+                                  1)[:, None]
+    return {
+        'data': [
+            {'z': per_day.round(2).tolist(),
+             'x': list(range(24)),
+             'y': labels,
+             'type': 'heatmap',
+             'colorscale': 'Viridis'}
+        ],
+        'layout': {
+            'title': '{} per Day by Hour'.format(activity),
+            'xaxis': {'title': 'hour of day'}
+        }
+    }
+
+
+def activity_counts(history: pd.DataFrame, period: str) -> Dict:
+    """
+    Number of each activity type per period, as a stacked bar plotly figure
+    """
+    acts = history[history['start'].notnull()]
+    codes, labels = _period_bins(acts['start'], period)
+    act_names, act_codes = np.unique(acts['activity'].astype(str).values,
+                                     return_inverse=True)
+    counts = np.bincount(act_codes * len(labels) + codes,
+                         minlength=len(act_names) * len(labels)
+                         ).reshape(len(act_names), len(labels))
+    return {
+        'data': [
+            {'x': labels,
+             'y': counts[i].tolist(),
+             'type': 'bar',
+             'name': name}
+            for i, name in enumerate(act_names)
+        ],
+        'layout': {
+            'title': 'Activities by {}'.format(period.title()),
+            'barmode': 'stack'
+        }
+    }
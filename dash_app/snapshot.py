@@ -0,0 +1,195 @@
+"""
+Binary, columnar snapshot of SimpleDB items for the offline (test) dashboard.
+
+Items are sorted by date and stored as arrays: per item its date, name and
+first attribute; per attribute its name and value. Names and values are ids
+in a table of distinct strings, so the activity names and attribute names
+repeated on every item are stored once. The file is memory mapped, so
+finding a week is a binary search on the dates, and loading it slices the
+arrays and decodes the strings it uses, however many years the snapshot
+covers.
+
+Layout (little endian, every array padded to 8 bytes):
+
+    magic (8 bytes) | item count | attribute count | string count (uint64)
+    item dates (int32 days since 1970-01-01)
+    item names (uint32 string ids)
+    item first attributes (uint64, one per item plus the end)
+    attribute names (uint32 string ids)
+    attribute values (uint32 string ids)
+    string offsets (uint64, one per string plus the end)
+    strings (UTF-8)
+
+Make one from a data export (see test/get_all_data.py) with
+
+    python -m dash_app.snapshot 2018-10-29-data.json data.snap
+"""
+import argparse
+import bisect
+import json
+import mmap
+import re
+import struct
+from datetime import date, datetime
+from typing import BinaryIO, Dict, Iterable, List
+
+MAGIC = b'KAYSNAP2'
+_HEADER = struct.Struct('<8sQQQ')
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# item names are <first name>-<date>-<activity>-<count>
+_RE_NAME_DATE = re.compile('-([0-9]{4}-[0-9]{2}-[0-9]{2})-')
+# (struct format, item size) of each array, in file order
+_ARRAYS = [('i', 4), ('I', 4), ('Q', 8), ('I', 4), ('I', 4), ('Q', 8)]
+
+
+def _day(date_str: str) -> int:
+    return datetime.strptime(date_str[:10], '%Y-%m-%d').toordinal() - \
+        _EPOCH_ORDINAL
+
+
+def item_date(item: Dict) -> str:
+    """
+    Date of a SimpleDB item, from its name or else its start time
+    """
+    name_date = _RE_NAME_DATE.search(item['Name'])
+    if name_date:
+        return name_date.group(1)
+    for attribute in item['Attributes']:
+        if attribute['Name'] == 'start_datetime':
+            return attribute['Value'][:10]
+    raise ValueError('No date for item {}'.format(item['Name']))
+
+
+def _write_array(out_file: BinaryIO, fmt: str, values: List[int]) -> None:
+    data = struct.pack('<{}{}'.format(len(values), fmt), *values)
+    out_file.write(data + b'\0' * (-len(data) % 8))
+
+
+def write_snapshot(items: Iterable[Dict], path: str) -> int:
+    """
+    Write items to a snapshot file
+
+    :return: number of items written
+    """
+    # sorted is stable, so items of one day keep their order
+    dated = sorted(((_day(item_date(x)), x) for x in items),
+                   key=lambda x: x[0])
+    string_ids = {}
+
+    def string_id(text: str) -> int:
+        return string_ids.setdefault(text, len(string_ids))
+
+    names = [string_id(x['Name']) for _, x in dated]
+    first_attributes = [0]
+    attribute_names, attribute_values = [], []
+    for _, item in dated:
+        for attribute in item['Attributes']:
+            attribute_names.append(string_id(attribute['Name']))
+            attribute_values.append(string_id(attribute['Value']))
+        first_attributes.append(len(attribute_names))
+    strings = [x.encode('utf-8') for x in string_ids]
+    string_offsets = [0]
+    for string in strings:
+        string_offsets.append(string_offsets[-1] + len(string))
+
+    columns = [[x for x, _ in dated], names, first_attributes,
+               attribute_names, attribute_values, string_offsets]
+    with open(path, 'wb') as out_file:
+        out_file.write(_HEADER.pack(MAGIC, len(dated), len(attribute_names),
+                                    len(strings)))
+        for (fmt, _), values in zip(_ARRAYS, columns):
+            _write_array(out_file, fmt, values)
+        out_file.write(b''.join(strings))
+    return len(dated)
+
+
+class Snapshot:
+    """
+    Read only, memory mapped snapshot
+
+    :param path: file made by write_snapshot
+    """
+    def __init__(self, path: str):
+        with open(path, 'rb') as snap_file:
+            self._mmap = mmap.mmap(snap_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        magic, self.n_items, n_attributes, n_strings = \
+            _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a snapshot file'.format(path))
+        view = memoryview(self._mmap)
+        lengths = [self.n_items, self.n_items, self.n_items + 1,
+                   n_attributes, n_attributes, n_strings + 1]
+        arrays = []
+        offset = _HEADER.size
+        for (fmt, size), length in zip(_ARRAYS, lengths):
+            end = offset + size * length
+            # native byte order casts, fine on the little endian machines we
+            # use
+            arrays.append(view[offset:end].cast(fmt))
+            offset = end + (-end % 8)
+        (self._dates, self._names, self._first_attributes,
+         self._attribute_names, self._attribute_values,
+         self._string_offsets) = arrays
+        self._strings_start = offset
+        # attribute names (a handful, on every item), decoded once
+        self._attribute_name_cache = {}
+
+    def __len__(self) -> int:
+        return self.n_items
+
+    def _string(self, string_id: int) -> str:
+        start = self._strings_start + self._string_offsets[string_id]
+        end = self._strings_start + self._string_offsets[string_id + 1]
+        return self._mmap[start:end].decode('utf-8')
+
+    def _attribute_name(self, string_id: int) -> str:
+        name = self._attribute_name_cache.get(string_id)
+        if name is None:
+            name = self._attribute_name_cache[string_id] = \
+                self._string(string_id)
+        return name
+
+    def _load(self, lo: int, hi: int) -> List[Dict]:
+        if lo >= hi:
+            return []
+        first = self._first_attributes[lo:hi + 1]
+        attributes = list(zip(self._attribute_names[first[0]:first[-1]],
+                              self._attribute_values[first[0]:first[-1]]))
+        return [{
+            'Name': self._string(self._names[lo + i]),
+            'Attributes': [
+                {'Name': self._attribute_name(x), 'Value': self._string(y)}
+                for x, y in attributes[first[i] - first[0]:
+                                       first[i + 1] - first[0]]]
+        } for i in range(hi - lo)]
+
+    def items_between(self, start: str, end: str) -> List[Dict]:
+        """
+        Items dated from start to end (YYYY-MM-DD, both included)
+        """
+        lo = bisect.bisect_left(self._dates, _day(start))
+        hi = bisect.bisect_right(self._dates, _day(end))
+        return self._load(lo, hi)
+
+    def all_items(self) -> List[Dict]:
+        return self._load(0, self.n_items)
+
+    def close(self) -> None:
+        for array in [self._dates, self._names, self._first_attributes,
+                      self._attribute_names, self._attribute_values,
+                      self._string_offsets]:
+            array.release()
+        self._mmap.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Make a snapshot file from a JSON data export'
+    )
+    parser.add_argument('export', help='JSON export, {"Items": [...]}')
+    parser.add_argument('snapshot', help='Snapshot file to write')
+    args = parser.parse_args()
+
+    with open(args.export, 'r') as export_file:
+        export_items = json.load(export_file)['Items']
+    print('Wrote {} items'.format(write_snapshot(export_items, args.snapshot)))
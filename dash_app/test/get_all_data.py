@@ -1,38 +1,43 @@
 """
 Get unit test data
 """
+import argparse
 import json
 from datetime import datetime
 
 import boto3
 
-from sdb_modify_domain import SDB_DOMAIN
+from dash_app.snapshot import write_snapshot
+from sdb_modify_domain import (
+    EPOCH_ATTRIBUTE,
+    epoch_range,
+    list_shard_domains,
+    read_domains,
+    select_shards
+)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='Also write the data as a snapshot file')
+    parser.add_argument('--range', nargs=2, metavar=('START', 'END'),
+                        help='Only items dated START to END (YYYY-MM-DD), in '
+                             'time order')
+    args = parser.parse_args()
+
     today_str = datetime.now().strftime('%Y-%m-%d')
     out_name = today_str + '-data.json'
 
     sdb = boto3.client('sdb')
-    next_token = ''
-    out_data = None
-    while True:
-        res = sdb.select(
-            SelectExpression='select * from `{}`'.format(SDB_DOMAIN),
-            NextToken=next_token
-        )
-
-        if not out_data:
-            out_data = res
-        else:
-            out_data['Items'].extend(res['Items'])
-
-        if 'NextToken' not in res:
-            break
-        else:
-            next_token = res['NextToken']
-
-    if 'NextToken' in out_data:
-        del out_data['NextToken']
+    domains = list_shard_domains(sdb)
+    query = 'select * from `{domain}`'
+    if args.range:
+        domains = [x for x in read_domains(*args.range) if x in domains]
+        query += ' where `{0}` >= "{1}" and `{0}` < "{2}" ' \
+            'order by `{0}`'.format(EPOCH_ATTRIBUTE, *epoch_range(*args.range))
+    out_data = {'Items': select_shards(sdb, query, domains)}
 
     with open(out_name, 'w') as out_file:
-        json.dump(res, out_file)
+        json.dump(out_data, out_file)
+    if args.snapshot:
+        write_snapshot(out_data['Items'], args.snapshot)
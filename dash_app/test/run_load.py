@@ -0,0 +1,317 @@
+"""
+Load test for the dashboard callbacks.
+
+Simulated parents step through weeks of a large synthetic data set by calling
+the Dash callback endpoint (/_dash-update-component) the same way the browser
+does. By default the app runs in process against the in-memory SimpleDB/S3
+fakes (local_fakes.py); pass --url to load test a running server instead.
+
+Run from the project root:
+
+    python -m dash_app.test.run_load --users 20 --weeks 150 --views 10
+"""
+import argparse
+import io
+import json
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+import pytz
+import requests
+from PIL import Image
+
+import metrics
+from lambda_function import put_sdb_activities
+from local_fakes import FakeS3, FakeSimpleDB, installed_fakes
+from note_parse import Activity, Nap
+from sdb_modify_domain import shard_domains
+
+BUCKET = 'gretchens-house-emails'
+DATE_FMT = '%Y-%m-%d'
+
+CHILD = 'Emilia'
+
+# (callback name, output id, output property, [(input id, input property)]),
+# the requests the browser sends when the date changes
+CALLBACKS = [
+    ('update_week', 'week-div', 'children',
+     [('date-picker-week', 'date'), ('child-select', 'value')]),
+    ('update_media', 'media-div', 'children',
+     [('date-picker-week', 'date'), ('child-select', 'value')]),
+]
+
+
+def _iso(day: datetime, hour: int, minute: int) -> str:
+    return pytz.timezone('US/Eastern').localize(
+        day.replace(hour=hour, minute=minute)).isoformat()
+
+
+def make_synthetic_data(s3: FakeS3, sdb: FakeSimpleDB, start: datetime,
+                        n_weeks: int, seed: int=0) -> List[str]:
+    """
+    Fill the fakes with weekday notes (meals, diapers, a nap, an activity)
+    and one photo per week
+
+    :return: week start dates
+    """
+    rand = random.Random(seed)
+    end = start + timedelta(weeks=n_weeks)
+    for domain in shard_domains(start.strftime(DATE_FMT),
+                                end.strftime(DATE_FMT)):
+        sdb.create_domain(DomainName=domain)
+
+    img_stream = io.BytesIO()
+    Image.new('RGB', (640, 480), (200, 120, 80)).save(img_stream, 'JPEG')
+    week_starts = []
+    with installed_fakes(s3, sdb):
+        for week in range(n_weeks):
+            week_start = start + timedelta(weeks=week)
+            week_starts.append(week_start.strftime(DATE_FMT))
+            for day_num in range(5):
+                day = week_start + timedelta(days=day_num)
+                date = day.strftime(DATE_FMT)
+                nap_start = (12, rand.choice([30, 40, 50]))
+                nap_end = (14, rand.choice([0, 10, 20]))
+                activities = [
+                    Activity(CHILD, date, 'Meal', _iso(day, x, 30),
+                             'Ate all of my food', None) for x in [8, 11, 15]
+                ] + [
+                    Activity(CHILD, date, 'Diaper', _iso(day, x, 10),
+                             'Wet diaper', None) for x in [9, 13, 16]
+                ] + [
+                    Activity(CHILD, date, 'Nap', _iso(day, *nap_start),
+                             'Napped ({:d}:{:02d} PM - {:d}:{:02d} PM)'.format(
+                                 (nap_start[0] - 1) % 12 + 1, nap_start[1],
+                                 (nap_end[0] - 1) % 12 + 1, nap_end[1]),
+                             None),
+                    Activity(CHILD, date, 'Activity', _iso(day, 10, 0),
+                             'Outside Time',
+                             'Played with chalk ' * rand.randint(1, 20))
+                ]
+                naps = [Nap(CHILD, _iso(day, *nap_start),
+                            _iso(day, *nap_end))]
+                put_sdb_activities(sdb, activities, naps)
+
+            media_name = 'synthetic{:05d}.jpg'.format(week)
+            s3.put_object(Bucket=BUCKET, Key='media/' + media_name,
+                          Body=img_stream.getvalue())
+            put_sdb_activities(sdb, [Activity(
+                '', week_start.strftime(DATE_FMT), 'Media',
+                _iso(week_start, 17, 0), media_name, media_name)], [])
+    return week_starts
+
+
+def callback_payload(output_id: str, output_prop: str,
+                     inputs: List[Tuple[str, str]], values: List) -> Dict:
+    return {
+        'output': {'id': output_id, 'property': output_prop},
+        'inputs': [{'id': x, 'property': y, 'value': z}
+                   for (x, y), z in zip(inputs, values)],
+        'state': []
+    }
+
+
+class _Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+
+    def add(self, name: str, seconds: float, ok: bool) -> None:
+        """
+        Record a request; failed ones only count as errors
+        """
+        with self.lock:
+            if ok:
+                self.latencies.setdefault(name, []).append(seconds)
+            else:
+                self.errors += 1
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1,
+                      int(round(pct / 100 * (len(values) - 1))))]
+
+
+def simulate_user(post, week_starts: List[str], n_views: int,
+                  recorder: _Recorder, seed: int) -> None:
+    """
+    One parent: pick a week, then keep stepping to neighboring weeks
+
+    :param post: function(payload) -> (status code, json response)
+    """
+    rand = random.Random(seed)
+    week_idx = rand.randrange(len(week_starts))
+    for _ in range(n_views):
+        week_idx = min(max(week_idx + rand.choice([-1, -1, 0, 1]), 0),
+                       len(week_starts) - 1)
+        # any day in the week
+        value = (datetime.strptime(week_starts[week_idx], DATE_FMT) +
+                 timedelta(days=rand.randrange(5))).strftime(DATE_FMT)
+        for name, out_id, out_prop, inputs in CALLBACKS:
+            start = time.perf_counter()
+            status, _ = post(callback_payload(out_id, out_prop, inputs,
+                                              [value, CHILD]))
+            recorder.add(name, time.perf_counter() - start, status == 200)
+
+
+def _max_rss_mb() -> float:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_load_test(args) -> Dict:
+    recorder = _Recorder()
+    counts = {'media_fetches': 0}
+
+    if args.url:
+        url = args.url.rstrip('/') + '/_dash-update-component'
+        local = threading.local()
+
+        def post(payload) -> Tuple[int, Dict]:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            resp = local.session.post(url, json=payload)
+            return resp.status_code, resp.json() if resp.ok else {}
+
+        week_starts = [
+            (datetime(2018, 9, 3) + timedelta(weeks=x)).strftime(DATE_FMT)
+            for x in range(args.weeks)
+        ]
+        rss_start = rss_end = float('nan')
+        cache_stats = week_stats = None
+        users = range(args.users)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            list(pool.map(lambda x: simulate_user(post, week_starts,
+                                                  args.views, recorder, x),
+                          users))
+        elapsed = time.perf_counter() - start
+    else:
+        from dash_app import application
+        s3 = FakeS3()
+        sdb = FakeSimpleDB()
+        week_starts = make_synthetic_data(s3, sdb, datetime(2018, 9, 3),
+                                          args.weeks)
+        s3.latency_s = args.aws_latency_ms / 1000
+        sdb.latency_s = args.aws_latency_ms / 1000
+
+        # week data hits and fills are counted by the cache
+        download_media = application.download_media
+
+        def counting_download_media(*x, **y):
+            with recorder.lock:
+                counts['media_fetches'] += 1
+            return download_media(*x, **y)
+
+        application.download_media = counting_download_media
+        # cache metrics would go to stdout
+        metrics_sink = metrics.METRICS_SINK
+        metrics.METRICS_SINK = 'off'
+        try:
+            with installed_fakes(s3, sdb):
+                rss_start = _max_rss_mb()
+                app = application.create_app()
+                server = app.server
+
+                def post(payload) -> Tuple[int, Dict]:
+                    with server.test_client() as client:
+                        resp = client.post('/_dash-update-component',
+                                           data=json.dumps(payload),
+                                           content_type='application/json')
+                        body = json.loads(resp.get_data(as_text=True)) \
+                            if resp.status_code == 200 else {}
+                        return resp.status_code, body
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.users) as pool:
+                    list(pool.map(
+                        lambda x: simulate_user(post, week_starts,
+                                                args.views, recorder, x),
+                        range(args.users)))
+                elapsed = time.perf_counter() - start
+                rss_end = _max_rss_mb()
+                cache_stats = dict(app.shared_cache.stats)
+                week_stats = app.shared_cache.kind_stats.get('week-data')
+        finally:
+            application.download_media = download_media
+            metrics.METRICS_SINK = metrics_sink
+
+    # successful requests
+    all_latencies = [x for y in recorder.latencies.values() for x in y]
+    n_requests = len(all_latencies)
+    # views whose callbacks all succeeded, at most
+    n_views = min(len(recorder.latencies.get(x[0], [])) for x in CALLBACKS)
+    week_hit_rate = None
+    if week_stats:
+        # a lookup filled by another worker's query is a hit too
+        week_hit_rate = 1 - week_stats['fills'] / max(
+            week_stats['hits'] + week_stats['misses'], 1)
+    result = {
+        'requests': n_requests,
+        'errors': recorder.errors,
+        'elapsed_s': elapsed,
+        'requests_per_s': n_requests / elapsed,
+        'views_per_s': n_views / elapsed,
+        'latency_ms': {
+            name: {'p50': 1000 * _percentile(values, 50),
+                   'p95': 1000 * _percentile(values, 95),
+                   'p99': 1000 * _percentile(values, 99)}
+            for name, values in sorted(recorder.latencies.items())
+        },
+        'week_cache_hit_rate': week_hit_rate,
+        'media_fetches': None if args.url else counts['media_fetches'],
+        'cache_stats': cache_stats,
+        'worker_rss_mb': {'start': rss_start, 'end': rss_end}
+    }
+    return result
+
+
+def print_report(result: Dict) -> None:
+    print('{requests} requests (and {errors} errors) in {elapsed_s:.1f} s: '
+          '{requests_per_s:.1f} req/s, {views_per_s:.1f} week views/s'.format(
+              **result))
+    print('{:<24}{:>10}{:>10}{:>10}'.format('callback', 'p50 ms', 'p95 ms',
+                                            'p99 ms'))
+    for name, stats in result['latency_ms'].items():
+        print('{:<24}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            name, stats['p50'], stats['p95'], stats['p99']))
+    if result['week_cache_hit_rate'] is not None:
+        print('week data cache hit rate: {:.1%}'.format(
+            result['week_cache_hit_rate']))
+        print('media downloads: {}'.format(result['media_fetches']))
+        print('week/history cache: {hits} hits, {misses} misses, {fills} '
+              'fills, {waits} filled by another worker'.format(
+                  **result['cache_stats']))
+        print('worker max RSS: {start:.0f} MB before, {end:.0f} MB '
+              'after'.format(**result['worker_rss_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test the dashboard callbacks')
+    parser.add_argument('--users', type=int, default=10,
+                        help='Concurrent simulated parents')
+    parser.add_argument('--views', type=int, default=10,
+                        help='Weeks each parent looks at')
+    parser.add_argument('--weeks', type=int, default=104,
+                        help='Weeks of synthetic data')
+    parser.add_argument('--aws-latency-ms', type=float, default=20,
+                        help='Latency of each fake S3/SimpleDB call')
+    parser.add_argument('--url',
+                        help='Load test a running dashboard instead')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results as JSON')
+    args = parser.parse_args()
+
+    load_result = run_load_test(args)
+    if args.json:
+        print(json.dumps(load_result, indent=2))
+    else:
+        print_report(load_result)
@@ -0,0 +1,156 @@
+import email
+import json
+import os
+from typing import Any, List, Tuple
+from unittest import TestCase, mock, skipIf
+
+import dash
+import flask
+
+from lambda_function import put_sdb_activities
+from local_fakes import FakeS3, FakeS3Resource, FakeSimpleDB
+from note_parse import Activity, parse_gretchens_notes
+from .. import application, get_data
+from ..application import cached_render, compute_week_start, create_app
+from ..cache import SharedCache, cache_config
+
+FAMILY = 'parents@a.example'
+TEST_MESSAGE = os.path.join(os.path.dirname(__file__), '..', '..',
+                            'test_message')
+
+
+def _load_email() -> str:
+    with open(TEST_MESSAGE, 'r') as test_file:
+        mail = email.message_from_file(test_file)
+    return mail.get_payload(decode=True).decode('utf-8')
+
+
+def update_component(client: Any, output: str,
+                     inputs: List[Tuple[str, str, Any]]) -> Any:
+    """
+    Children of a component, from the dash endpoint its callback serves
+
+    :param inputs: (id, property, value) of the callback's inputs, in order
+    """
+    payload = {'output': {'id': output, 'property': 'children'},
+               'inputs': [{'id': x, 'property': y, 'value': z}
+                          for x, y, z in inputs],
+               'state': []}
+    response = client.post('/_dash-update-component',
+                           data=json.dumps(payload),
+                           content_type='application/json')
+    if response.status_code != 200:
+        raise AssertionError(response.data)
+    return json.loads(response.data.decode('utf-8'))['response']['props'][
+        'children']
+
+
+def component_ids(tree: Any) -> List[str]:
+    """
+    ids of the components in a serialized layout
+    """
+    if isinstance(tree, list):
+        return sum([component_ids(x) for x in tree], [])
+    if not isinstance(tree, dict):
+        return []
+    props = tree.get('props', {})
+    ids = [props['id']] if 'id' in props else []
+    return ids + component_ids(props.get('children'))
+
+
+class TestCachedRender(TestCase):
+    def setUp(self):
+        self.cache = SharedCache(flask.Flask(__name__),
+                                 cache_config('simple'))
+        self.renders = []
+
+    def render(self, data):
+        self.renders.append(data['HighWaterMark'])
+        return {'data': [{'x': [len(data['Items'])]}]}
+
+    def testSameMark(self):
+        data = {'Items': [1, 2], 'HighWaterMark': '2018-10-01T17:00:00'}
+        first = cached_render(self.cache, 'nap-graph-2018-10-01', data,
+                              self.render)
+        second = cached_render(self.cache, 'nap-graph-2018-10-01', data,
+                               self.render)
+        self.assertEqual({'data': [{'x': [2]}]}, first)
+        self.assertEqual(first, second)
+        self.assertEqual(['2018-10-01T17:00:00'], self.renders)
+
+    def testNewMark(self):
+        data = {'Items': [1, 2], 'HighWaterMark': '2018-10-01T17:00:00'}
+        cached_render(self.cache, 'nap-graph-2018-10-01', data, self.render)
+        # an ingest adds an item and moves the mark
+        data = {'Items': [1, 2, 3], 'HighWaterMark': '2018-10-01T18:00:00'}
+        figure = cached_render(self.cache, 'nap-graph-2018-10-01', data,
+                               self.render)
+        self.assertEqual({'data': [{'x': [3]}]}, figure)
+        self.assertEqual(['2018-10-01T17:00:00', '2018-10-01T18:00:00'],
+                         self.renders)
+        # other panels of the week are rendered separately
+        cached_render(self.cache, 'activity-table-2018-10-01', data,
+                      self.render)
+        self.assertEqual(3, len(self.renders))
+
+
+# create_app sets app.config['TESTING'], which dash 1 and later reject
+@skipIf(not dash.__version__.startswith('0.'), 'needs dash 0.x')
+class TestWeekCallbacks(TestCase):
+    def setUp(self):
+        activities, naps = parse_gretchens_notes(_load_email())
+        media = Activity('', '2018-09-21', 'Media',
+                         '2018-09-21T10:00:00-04:00', 'abc123.mp4', None)
+        self.sdb = FakeSimpleDB()
+        put_sdb_activities(self.sdb, activities + [media], naps,
+                           family=FAMILY)
+        self.n_activities = sum(x.activity.upper() == 'ACTIVITY'
+                                for x in activities)
+
+    def testWeekPanels(self):
+        inputs = [('date-picker-week', 'date', '2018-09-21'),
+                  ('child-select', 'value', 'Emilia')]
+        with mock.patch.multiple(get_data, sdb=self.sdb,
+                                 s3=FakeS3Resource(FakeS3()),
+                                 _EPOCH_DOMAINS=set()), \
+                mock.patch.object(application, 'get_week_data',
+                                  wraps=get_data.get_week_data) as fetch:
+            client = create_app(family=FAMILY).server.test_client()
+            week = update_component(client, 'week-div', inputs)
+            media = update_component(client, 'media-div', inputs)
+            again = update_component(client, 'week-div', inputs)
+
+        # one request renders every panel of the week
+        self.assertEqual(['nap-time-bar-graph', 'activity-table'],
+                         component_ids(week))
+        graph, _, table = week
+        self.assertEqual(2, len(graph['props']['figure']['data']))
+        # a header row, then the activities
+        rows = table['props']['children']['props']['children']
+        self.assertEqual(self.n_activities + 1, len(rows))
+        self.assertEqual(['/media/abc123.mp4'],
+                         [x['props']['src'] for x in media])
+        # the week is queried once for all of them
+        # (the layout also renders the current week, when the app is created)
+        self.assertEqual(1, sum(x[0][0] == compute_week_start('2018-09-21')
+                                for x in fetch.call_args_list))
+        self.assertEqual(week, again)
+
+    def testMediaRange(self):
+        video = bytes(range(256)) * 4
+        s3 = FakeS3()
+        s3.put_object(Bucket=get_data.MEDIA_BUCKET, Key='media/abc123.mp4',
+                      Body=video, ContentType='video/mp4')
+        with mock.patch.multiple(get_data, sdb=self.sdb,
+                                 s3=FakeS3Resource(s3),
+                                 _EPOCH_DOMAINS=set()), \
+                mock.patch.object(application, 'MEDIA_PRESIGNED', False):
+            client = create_app(family=FAMILY).server.test_client()
+            response = client.get('/media/abc123.mp4',
+                                  headers={'Range': 'bytes=100-199'})
+
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('bytes 100-199/1024',
+                         response.headers['Content-Range'])
+        self.assertEqual('100', response.headers['Content-Length'])
+        self.assertEqual(video[100:200], response.data)
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+import flask
+
+import metrics
+from ..cache import SharedCache, cache_config
+
+
+class TestSharedCache(TestCase):
+    def setUp(self):
+        self.sink = metrics.METRICS_SINK
+        metrics.METRICS_SINK = 'off'
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.METRICS_SINK = self.sink
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.cache_dir + '.locks', ignore_errors=True)
+
+    def _filesystem_cache(self):
+        return SharedCache(flask.Flask(__name__),
+                           cache_config('filesystem', self.cache_dir))
+
+    def testGetOrFill(self):
+        cache = SharedCache(flask.Flask(__name__), cache_config('simple'))
+        fills = []
+
+        def fill(cached):
+            fills.append(cached)
+            return {'Items': [1, 2], 'Version': len(fills)}
+
+        def is_fresh(value):
+            return value['Version'] > 1
+
+        value = cache.get_or_fill('week', fill, is_fresh, as_json=True)
+        self.assertEqual({'Items': [1, 2], 'Version': 1}, value)
+        # stale, so refilled, getting the stale value
+        value = cache.get_or_fill('week', fill, is_fresh, as_json=True)
+        self.assertEqual([None, {'Items': [1, 2], 'Version': 1}], fills)
+        self.assertEqual(2, value['Version'])
+        cache.get_or_fill('week', fill, is_fresh, as_json=True,
+                          kind='week-data')
+        self.assertEqual({'hits': 1, 'misses': 2, 'fills': 2, 'waits': 0},
+                         cache.stats)
+        self.assertEqual({'week-data': {'hits': 1, 'misses': 0, 'fills': 0,
+                                        'waits': 0}}, cache.kind_stats)
+
+    def testSingleFlight(self):
+        # two caches on the same directory stand in for two worker processes
+        caches = [self._filesystem_cache(), self._filesystem_cache()]
+        fills = []
+
+        def fill(cached):
+            fills.append(1)
+            time.sleep(0.1)
+            return {'Items': ['a']}
+
+        results = []
+        threads = [threading.Thread(target=lambda x: results.append(
+            caches[x % 2].get_or_fill('week-data-2018-10-01', fill,
+                                      as_json=True)), args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(fills))
+        self.assertEqual([{'Items': ['a']}] * 8, results)
+        self.assertEqual(7, sum(x.stats['waits'] for x in caches))
+        # locks are not kept once nobody waits for them
+        self.assertEqual([{}, {}], [x._key_locks for x in caches])
+        self.assertEqual([], os.listdir(self.cache_dir + '.locks'))
+
+    def testRedisLockToken(self):
+        # the lock entry logic only needs add, get and delete
+        cache = SharedCache(flask.Flask(__name__), cache_config('simple'))
+        with cache._redis_lock('week'):
+            self.assertIsNotNone(cache.get('lock-week'))
+        self.assertIsNone(cache.get('lock-week'))
+        with cache._redis_lock('week'):
+            # expired, and taken by another worker
+            cache.set('lock-week', 'other')
+        self.assertEqual('other', cache.get('lock-week'))
+
+    def testStatsReport(self):
+        cache = SharedCache(flask.Flask(__name__), cache_config('simple'))
+        with mock.patch.object(metrics, 'emit') as emit:
+            for _ in range(5):
+                cache.get_or_fill('history', lambda _: 1)
+            # the fill, but not every hit
+            self.assertEqual(['cache_fill'],
+                             [x[0][0] for x in emit.call_args_list])
+            emit.reset_mock()
+            cache.report_stats()
+            emit.assert_has_calls([mock.call('cache_hit', 0, 4),
+                                   mock.call('cache_miss', 0, 1)])
+            emit.reset_mock()
+            cache.report_stats()
+            emit.assert_not_called()
@@ -1,17 +1,48 @@
+import functools
 import json
 import os
+import tempfile
 from unittest import TestCase
 from datetime import datetime
 import re
 
-from ..get_data import compute_nap_times, get_activty_table, get_media_keys
+from ..get_data import (
+    compute_nap_times,
+    get_activty_table,
+    get_media_keys,
+    high_water_mark,
+    merge_week_items
+)
+from ..snapshot import Snapshot, write_snapshot
 
 
-def get_test_week_data():
+def get_test_data():
     this_dir = os.path.dirname(os.path.abspath(__file__))
     test_data_path = os.path.join(this_dir, 'test_data.json')
     with open(test_data_path, 'r') as test_file:
-        data = json.load(test_file)
+        return json.load(test_file)
+
+
+@functools.lru_cache(maxsize=None)
+def get_test_snapshot() -> Snapshot:
+    """
+    Test data as a snapshot file, written once per process
+    """
+    snap_fd, snap_path = tempfile.mkstemp(suffix='.snap')
+    os.close(snap_fd)
+    write_snapshot(get_test_data()['Items'], snap_path)
+    snapshot = Snapshot(snap_path)
+    try:
+        # the open memory map keeps the data readable
+        os.remove(snap_path)
+    except OSError:
+        # not while it is mapped on windows
+        pass
+    return snapshot
+
+
+def get_test_week_data():
+    data = get_test_data()
 
     date_start = datetime(2018, 10, 1)
     date_end = datetime(2018, 10, 6)
@@ -51,9 +82,32 @@ class TestGetData(TestCase):
     def testActivityTable(self):
         table = get_activty_table(self.week_data['Items'])
         self.assertEqual(6, len(table.children))
+        # header only for a week without activities
+        no_activities = [x for x in self.week_data['Items']
+                         if '-Activity-' not in x['Name']]
+        table = get_activty_table(no_activities)
+        self.assertEqual(1, len(table.children))
 
     def testGetMediaKeys(self):
         media_keys = get_media_keys(self.week_data)
         self.assertEqual(1, len(media_keys))
         self.assertEqual('5bca27da361b5d0014939f80.jpg',
                          media_keys[0])
+
+    def testMergeWeekItems(self):
+        def item(name, result, ingest):
+            return {'Name': name,
+                    'Attributes': [{'Name': 'result', 'Value': result},
+                                   {'Name': 'ingest_datetime',
+                                    'Value': ingest}]}
+        old = [item('a', 'old', '2018-10-01T20:00:00+00:00'),
+               item('b', 'old', '2018-10-01T20:00:00+00:00')]
+        new = [item('b', 'new', '2018-10-02T20:00:00+00:00'),
+               item('c', 'new', '2018-10-02T20:00:00+00:00')]
+        merged = merge_week_items(old, new)
+        self.assertEqual(['a', 'b', 'c'], [x['Name'] for x in merged])
+        self.assertEqual('new', merged[1]['Attributes'][0]['Value'])
+        self.assertEqual('2018-10-02T20:00:00+00:00',
+                         high_water_mark(merged))
+        # legacy items without ingest times
+        self.assertEqual('', high_water_mark(self.week_data['Items']))
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from ..history import (
+    activity_counts,
+    child_history,
+    children,
+    hourly_heatmap,
+    items_to_frame,
+    nap_trend
+)
+from .test_get_data import get_test_data
+
+
+class TestHistory(TestCase):
+    def setUp(self):
+        self.history = items_to_frame(get_test_data()['Items'])
+
+    def testFrame(self):
+        self.assertEqual(len(get_test_data()['Items']), len(self.history))
+        naps = self.history[self.history['activity'] == 'NapTimes']
+        self.assertTrue(naps['end'].notnull().all())
+        # local time
+        self.assertEqual(12, naps['start'].min().hour)
+
+    def testNapTrend(self):
+        fig = nap_trend(self.history, 'month')
+        self.assertEqual(['2018-09', '2018-10'], fig['data'][0]['x'])
+        fig = nap_trend(self.history, 'year')
+        self.assertEqual(['2018'], fig['data'][0]['x'])
+        self.assertGreater(fig['data'][0]['y'][0], 30)
+
+    def testHeatmap(self):
+        fig = hourly_heatmap(self.history, 'Meal', 'quarter')
+        self.assertEqual(['2018Q3', '2018Q4'], fig['data'][0]['y'])
+        self.assertEqual(24, len(fig['data'][0]['z'][0]))
+
+    def testActivityCounts(self):
+        fig = activity_counts(self.history, 'year')
+        total = sum(x['y'][0] for x in fig['data'])
+        self.assertEqual(self.history['start'].notnull().sum(), total)
+
+    def testChildren(self):
+        self.assertEqual(['Emilia'], children(self.history))
+        self.assertEqual(len(self.history),
+                         len(child_history(self.history, 'Emilia')))
+        # media is kept for every child
+        self.assertEqual(['Media'], child_history(self.history, 'Mia')[
+            'activity'].astype(str).unique().tolist())
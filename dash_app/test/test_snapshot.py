@@ -0,0 +1,66 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from ..snapshot import Snapshot, item_date, write_snapshot
+from .test_get_data import get_test_data, get_test_week_data
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.items = get_test_data()['Items']
+        snap_fd, self.snap_path = tempfile.mkstemp(suffix='.snap')
+        os.close(snap_fd)
+        write_snapshot(self.items, self.snap_path)
+        self.snapshot = Snapshot(self.snap_path)
+
+    def tearDown(self):
+        self.snapshot.close()
+        os.remove(self.snap_path)
+
+    def testWeek(self):
+        week = self.snapshot.items_between('2018-10-01', '2018-10-07')
+        expected = [x for x in self.items
+                    if '2018-10-01' <= item_date(x) <= '2018-10-07']
+        self.assertEqual(sorted(expected, key=lambda x: x['Name']),
+                         sorted(week, key=lambda x: x['Name']))
+        self.assertEqual([], self.snapshot.items_between('2019-01-01',
+                                                         '2019-01-07'))
+        dates = [item_date(x) for x in self.snapshot.all_items()]
+        self.assertEqual(sorted(dates), dates)
+        self.assertEqual(len(self.items), len(self.snapshot))
+
+    def testMatchesRegexScan(self):
+        # same week as the item name scan the tests used before snapshots
+        expected = get_test_week_data()['Items']
+        week = self.snapshot.items_between('2018-10-01', '2018-10-06')
+        self.assertEqual(sorted(expected, key=lambda x: x['Name']),
+                         sorted(week, key=lambda x: x['Name']))
+        self.assertGreater(len(week), 0)
+
+    def testColumns(self):
+        items = [{'Name': 'Emilia-2018-10-0{}-Meal-000'.format(x),
+                  'Attributes': [{'Name': 'activity', 'Value': 'Meal'},
+                                 {'Name': 'notes', 'Value': 'Crème brûlée'},
+                                 {'Name': 'notes', 'Value': ''}]}
+                 for x in [2, 1]]
+        path = self.snap_path + '.columns'
+        write_snapshot(items, path)
+        snapshot = Snapshot(path)
+        # attribute order and repeated attributes are kept
+        self.assertEqual(items[::-1], snapshot.all_items())
+        self.assertEqual(items[:1], snapshot.items_between('2018-10-02',
+                                                           '2018-10-02'))
+        snapshot.close()
+        with open(path, 'rb') as snap_file:
+            # each distinct string is stored once
+            self.assertEqual(1, snap_file.read().count(b'activity'))
+        os.remove(path)
+
+    def testEmpty(self):
+        write_snapshot([], self.snap_path + '.empty')
+        snapshot = Snapshot(self.snap_path + '.empty')
+        self.assertEqual([], snapshot.items_between('2018-10-01',
+                                                    '2018-10-07'))
+        snapshot.close()
+        os.remove(self.snap_path + '.empty')
@@ -20,8 +20,16 @@ DEPLOY_NAME = 'deploy'
 
 # files to copy to distribution
 SRC_LIST = [
+    "activity_batch.py",
     "lambda_function.py",
+    "long_notes.py",
+    "media_dedup.py",
+    "media_manifest.py",
+    "metrics.py",
     "note_parse.py",
+    "notes_index.py",
+    "parse_cache.py",
+    "profiling.py",
     "sdb_modify_domain.py"
 ]
 
@@ -0,0 +1,215 @@
+"""
+Ingest emails from mail archives: mbox files, maildir trees, directories of
+single message files, and gzip/zip archives of any of those.
+
+Messages are streamed one at a time (archives are never unpacked to disk), and
+only messages from Kaymbu (by From header) have their bodies decoded.
+
+    python ingest_archive.py takeout.mbox.gz old-mail.zip ~/Maildir
+"""
+import argparse
+import email.parser
+import email.utils
+import gzip
+import logging
+import os
+import zipfile
+from typing import BinaryIO, Dict, Iterator, Tuple
+
+from profiling import profiled
+
+# messages larger than this are skipped, which bounds memory use
+MAX_MESSAGE_BYTES = 32 * 1024 * 1024
+KAYMBU_DOMAIN = 'kaymbu.com'
+
+
+def get_logger():
+    return logging.getLogger("ingest_archive")
+
+
+def _is_mbox(first_line: bytes) -> bool:
+    return first_line.startswith(b'From ')
+
+
+def iter_mbox_messages(stream: BinaryIO,
+                       max_bytes: int=MAX_MESSAGE_BYTES
+                       ) -> Iterator[bytes]:
+    """
+    Split an mbox stream into raw messages, one message in memory at a time
+
+    ">From " escaping (mboxrd) is undone. Messages larger than max_bytes are
+    skipped.
+    """
+    lines = []
+    size = 0
+    too_big = False
+    prev_blank = True
+    for line in stream:
+        if line.startswith(b'From ') and prev_blank:
+            if lines and not too_big:
+                yield b''.join(lines)
+            lines, size, too_big = [], 0, False
+            prev_blank = False
+            continue
+
+        prev_blank = line in (b'\n', b'\r\n')
+        if too_big:
+            continue
+        if line.startswith(b'>') and line.lstrip(b'>').startswith(b'From '):
+            line = line[1:]
+        size += len(line)
+        if size > max_bytes:
+            get_logger().warning('Skipping message over {} bytes'.format(
+                max_bytes))
+            too_big, lines = True, []
+            continue
+        lines.append(line)
+
+    if lines and not too_big:
+        yield b''.join(lines)
+
+
+def _iter_stream(stream: BinaryIO, name: str,
+                 max_bytes: int) -> Iterator[Tuple[str, bytes]]:
+    """
+    Messages in a stream that is either an mbox or one message
+    """
+    first_line = stream.readline()
+    if _is_mbox(first_line):
+        for i, raw in enumerate(iter_mbox_messages(stream, max_bytes)):
+            yield '{}#{}'.format(name, i), raw
+    else:
+        raw = first_line + stream.read(max_bytes + 1 - len(first_line))
+        if len(raw) > max_bytes:
+            get_logger().warning('Skipping {}, over {} bytes'.format(
+                name, max_bytes))
+        elif raw.strip():
+            yield name, raw
+
+
+def _is_maildir(path: str) -> bool:
+    return all(os.path.isdir(os.path.join(path, x))
+               for x in ['cur', 'new'])
+
+
+def iter_archive_messages(path: str,
+                          max_bytes: int=MAX_MESSAGE_BYTES
+                          ) -> Iterator[Tuple[str, bytes]]:
+    """
+    (source name, raw message) for every message in a path
+
+    :param path: mbox file, single message file, maildir, directory (searched
+        recursively), .gz file, or .zip file
+    :param max_bytes: skip messages larger than this
+    """
+    if os.path.isdir(path):
+        if _is_maildir(path):
+            for sub_dir in ['new', 'cur']:
+                sub_path = os.path.join(path, sub_dir)
+                for file_name in sorted(os.listdir(sub_path)):
+                    yield from iter_archive_messages(
+                        os.path.join(sub_path, file_name), max_bytes)
+            # maildir++ sub folders
+            for file_name in sorted(os.listdir(path)):
+                sub_path = os.path.join(path, file_name)
+                if file_name.startswith('.') and _is_maildir(sub_path):
+                    yield from iter_archive_messages(sub_path, max_bytes)
+        else:
+            for file_name in sorted(os.listdir(path)):
+                yield from iter_archive_messages(
+                    os.path.join(path, file_name), max_bytes)
+    elif path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                name = '{}:{}'.format(path, info.filename)
+                with archive.open(info) as member:
+                    if info.filename.lower().endswith('.gz'):
+                        member = gzip.GzipFile(fileobj=member)
+                    yield from _iter_stream(member, name, max_bytes)
+    elif path.lower().endswith('.gz'):
+        with gzip.open(path, 'rb') as stream:
+            yield from _iter_stream(stream, path, max_bytes)
+    else:
+        with open(path, 'rb') as stream:
+            yield from _iter_stream(stream, path, max_bytes)
+
+
+def is_kaymbu_message(raw: bytes) -> bool:
+    """
+    Check the From header without parsing the message body
+    """
+    end = raw.find(b'\n\n')
+    end_crlf = raw.find(b'\r\n\r\n')
+    if end < 0 or (0 <= end_crlf < end):
+        end = end_crlf
+    header_bytes = raw if end < 0 else raw[:end]
+    headers = email.parser.BytesHeaderParser().parsebytes(header_bytes)
+    _, address = email.utils.parseaddr(headers.get('From', ''))
+    domain = address.rpartition('@')[2].lower()
+    return domain == KAYMBU_DOMAIN or domain.endswith('.' + KAYMBU_DOMAIN)
+
+
+def ingest_archive(path: str, bucket: str, dry_run: bool=False,
+                   max_bytes: int=MAX_MESSAGE_BYTES) -> Dict[str, int]:
+    """
+    Parse and store every Kaymbu email in an archive
+
+    :param path: see iter_archive_messages
+    :param bucket: bucket for media
+    :param dry_run: only parse daily notes, do not write anything. Other
+        (picture) emails are counted as skipped
+    :return: counts of messages seen, from Kaymbu, ingested, skipped and
+        failed
+    """
+    from lambda_function import decode_email_body, email_family, \
+        lambda_parser
+    from note_parse import parse_gretchens_notes
+
+    counts = {'seen': 0, 'kaymbu': 0, 'ingested': 0, 'skipped': 0,
+              'failed': 0}
+    for name, raw in iter_archive_messages(path, max_bytes):
+        counts['seen'] += 1
+        if not is_kaymbu_message(raw):
+            continue
+        counts['kaymbu'] += 1
+        try:
+            body = decode_email_body(raw)
+            if dry_run:
+                if 'download_btn' in body:
+                    # picture emails need the network to parse
+                    counts['skipped'] += 1
+                    continue
+                parse_gretchens_notes(body)
+            else:
+                lambda_parser(body, bucket, reprocess=True,
+                              family=email_family(raw))
+        except Exception as e:
+            counts['failed'] += 1
+            get_logger().error('Failed to ingest {}: {}'.format(name, e))
+        else:
+            counts['ingested'] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Ingest Kaymbu emails from mail archives'
+    )
+    parser.add_argument('paths', nargs='+',
+                        help='mbox, maildir, directory, .gz or .zip')
+    parser.add_argument('--bucket', default='gretchens-house-emails',
+                        help='Bucket for media')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only parse daily notes, do not store anything')
+    parser.add_argument('--profile', metavar='DEST',
+                        help='Profile the run, writing stats to a directory '
+                             'or s3://bucket/prefix')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for archive_path in args.paths:
+        with profiled(os.path.basename(archive_path), args.profile):
+            result = ingest_archive(archive_path, args.bucket, args.dry_run)
+        print('{}: {}'.format(archive_path, result))
@@ -1,22 +1,85 @@
 import email
+import email.parser
+import email.utils
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import subprocess
+import tempfile
 import urllib.parse
-from typing import List, Tuple
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 import boto3
+import pytz
+from botocore.exceptions import ClientError
 
+from activity_batch import ActivityBatch
+from long_notes import is_overflow, note_key, note_preview, put_notes
+from media_dedup import (
+    MediaRef,
+    find_media_digest,
+    find_media_id,
+    index_media,
+    media_digest
+)
+from media_manifest import add_to_manifest, media_entry
+from metrics import timer
 from note_parse import (
     parse_gretchens_notes,
     Activity,
     Nap,
-    parse_gretchens_picture
+    is_video,
+    parse_gretchens_picture,
+    poster_name
+)
+from notes_index import NOTES_INDEX_PATH, index_activities, open_index
+from parse_cache import (
+    MEDIA,
+    NOTES,
+    ParsedEmail,
+    get_parsed,
+    is_email_key,
+    put_parsed
+)
+from profiling import profiled
+from sdb_modify_domain import (
+    EPOCH_ATTRIBUTE,
+    select_all,
+    shard_domain,
+    sortable_epoch,
+    write_to_domain
 )
-from sdb_modify_domain import SDB_DOMAIN
-
-print('Loading function')
 
 s3 = boto3.client('s3')
 sdb = boto3.client('sdb')
 
+# family whose items keep the names from before items were partitioned by
+# family (its items get the family attribute, but no name prefix)
+LEGACY_FAMILY = os.environ.get('KAYMBU_LEGACY_FAMILY', '').lower()
+# families whose emails are sent to more than one address, as
+# "address=family,address=family"; see email_family
+FAMILY_ADDRESSES = os.environ.get('KAYMBU_FAMILY_ADDRESSES', '')
+# max items per SimpleDB batch put/delete
+SDB_BATCH_SIZE = 25
+# attributes that record the write itself, see _ingest_attributes
+INGEST_ATTRIBUTES = ['ingest_datetime', 'ingest_mode']
+# bytes read from the start of a stored image to find its dimensions
+MEDIA_HEAD_BYTES = 128 * 1024
+# [family/]owner-date- part of an item name, shared by the items of a child
+# and day (or a media file)
+_RE_ITEM_STEM = re.compile('^(.*-[0-9]{4}-[0-9]{2}-[0-9]{2}-)[^/]*-[0-9]{3}$')
+
+
+def get_logger():
+    return logging.getLogger("lambda_function")
+
+
+get_logger().info('Loading function')
+
 
 def lambda_handler(event, context):
     #print("Received event: " + json.dumps(event, indent=2))
@@ -25,166 +88,625 @@ def lambda_handler(event, context):
     bucket = event['Records'][0]['s3']['bucket']['name']
     key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'],
                                     encoding='utf-8')
-    lambda_worker(bucket, key)
+    if not is_email_key(key):
+        get_logger().info('Ignoring {}, not an email'.format(key))
+        return
+    # profiled only if KAYMBU_PROFILE is set
+    with profiled(key):
+        lambda_worker(bucket, key)
+
 
+def lambda_worker(bucket: str,
+                  key: str,
+                  reprocess: bool=False) -> Tuple[List[Activity], List[Nap]]:
+    if reprocess:
+        parsed = get_cached_parse(bucket, key)
+        if parsed:
+            get_logger().info('Using cached parse of {}'.format(key))
+            return store_parsed(bucket, parsed, reprocess)
 
-def lambda_worker(bucket: str, key: str) -> Tuple[List[Activity], List[Nap]]:
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
-        print('Load email from bucket {}, key {}'.format(bucket, key))
+        raw_email, etag = fetch_email(bucket, key)
+        get_logger().info('Load email from bucket {}, key {}'.format(bucket,
+                                                                     key))
     except Exception as e:
-        print(e)
-        print('Error getting object {} from bucket {}.'.format(key, bucket))
+        get_logger().error(
+            'Error getting object {} from bucket {}: {}'.format(key, bucket, e))
         raise e
 
     try:
-        email_obj= email.message_from_bytes(response['Body'].read())
-        body = email_obj.get_payload(decode=True).decode('utf-8')
+        with timer('mime_decode'):
+            body = decode_email_body(raw_email)
     except Exception as e:
-        print(e)
-        print('Could not parse email')
+        get_logger().error('Could not parse email: {}'.format(e))
         raise e
-    lambda_parser(body, bucket)
+    return lambda_parser(body, bucket, reprocess, (key, etag),
+                         email_family(raw_email))
+
+
+def fetch_email(bucket: str, key: str) -> Tuple[bytes, str]:
+    """
+    Raw bytes and ETag of an email in S3
+    """
+    with timer('s3_fetch'):
+        response = s3.get_object(Bucket=bucket, Key=key)
+        return response['Body'].read(), response['ETag']
+
+
+def decode_email_body(raw_email: bytes) -> str:
+    """
+    HTML body of a raw email (the html part, if it has several parts)
+    """
+    email_obj = email.message_from_bytes(raw_email)
+    if email_obj.is_multipart():
+        for part in email_obj.walk():
+            if part.get_content_type() == 'text/html':
+                email_obj = part
+                break
+    charset = email_obj.get_content_charset() or 'utf-8'
+    return email_obj.get_payload(decode=True).decode(charset)
+
+
+def family_addresses(config: str) -> Dict[str, str]:
+    """
+    {address: family} from "address=family,address=family" (see
+    FAMILY_ADDRESSES), addresses and families lower case
+    """
+    addresses = {}
+    for pair in config.split(','):
+        if not pair.strip():
+            continue
+        address, _, family = pair.partition('=')
+        if not family.strip():
+            raise ValueError('No family for "{}" in {}'.format(
+                address.strip(), config))
+        addresses[address.strip().lower()] = family.strip().lower()
+    return addresses
+
+
+def family_version() -> str:
+    """
+    Version of the FAMILY_ADDRESSES in effect, '' if there are none. Cached
+    parses store it, so they are reparsed (and their family resolved again)
+    when the addresses change
+    """
+    addresses = sorted(family_addresses(FAMILY_ADDRESSES).items())
+    if not addresses:
+        return ''
+    normalized = ','.join('{}={}'.format(*x) for x in addresses)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:16]
 
 
-def lambda_parser(body: str, bucket: str) -> None:
+def email_family(raw_email: bytes,
+                 addresses: Optional[Dict[str, str]]=None) -> str:
+    """
+    Family of an email: the family its recipients map to in FAMILY_ADDRESSES
+    (e.g., two parents' addresses), else the (lower case) address it was sent
+    to. Each family forwards its Kaymbu emails from its own addresses
+
+    :param raw_email: the email
+    :param addresses: {address: family}, defaults to FAMILY_ADDRESSES
+    """
+    if addresses is None:
+        addresses = family_addresses(FAMILY_ADDRESSES)
+    headers = email.parser.BytesHeaderParser().parsebytes(raw_email)
+    recipients = [x[1].lower() for x in email.utils.getaddresses(
+        headers.get_all('To', []) + headers.get_all('Cc', []))]
+    for recipient in recipients:
+        if recipient in addresses:
+            return addresses[recipient]
+    to = email.utils.getaddresses(headers.get_all('To', []))
+    return to[0][1].lower() if to else ''
+
+
+def lambda_parser(body: str, bucket: str, reprocess: bool=False,
+                  source: Optional[Tuple[str, str]]=None, family: str=''):
+    """
+    Parse an email body and store the results
+
+    :param body: HTML body
+    :param bucket: bucket for media (and the cached parse)
+    :param reprocess: see put_sdb_activities
+    :param source: (key, ETag) of the email, to cache the parse
+    :param family: see email_family
+    """
 
     # Parse email for activities
     activities, naps = None, None
     try:
-        activities, naps = parse_gretchens_notes(body)
+        with timer('parse'):
+            activities, naps = parse_gretchens_notes(body)
     except Exception as e:
-        print(e)
-        print('Error parsing activities out of email')
+        get_logger().info(
+            'Error parsing activities out of email: {}'.format(e))
 
     # put in SimpleDB
     if activities and naps:
         try:
-            put_sdb_activities(sdb, activities, naps)
+            write_sdb_activities(bucket, activities, naps, reprocess, family)
         except Exception as e:
-            print(e)
-            print('Error while putting data in SimpleDB')
+            get_logger().error(
+                'Error while putting data in SimpleDB: {}'.format(e))
             raise e
         else:
-            print('Put in simpleDB successfully')
+            get_logger().info('Put in simpleDB successfully')
+        _update_notes_index(activities, family)
+        if source:
+            cache_parse(bucket, *source,
+                        ParsedEmail(NOTES, activities, naps, family))
 
         return activities, naps
     else:
-        print('Trying to parse as media email')
+        get_logger().info('Trying to parse as media email')
         try:
-            media_out = parse_gretchens_picture(body)
+            media_out = parse_gretchens_picture(
+                body, lambda x: known_media(bucket, x))
         except Exception as e:
-            print(e)
-            print('Error parsing media email')
+            get_logger().error('Error parsing media email: {}'.format(e))
             raise e
 
+        activities = []
         try:
             for media, activity_info in media_out:
-                s3.put_object(
-                    Body=media,
-                    Bucket=bucket,
-                    Key='media/{}'.format(activity_info.result)
-                )
-                put_sdb_activities(sdb, [activity_info], [])
-
-            _, activities = zip(*media_out)
-            return activities, []
+                activity_info = store_media(media, bucket, activity_info)
+                write_sdb_activities(bucket, [activity_info], [], reprocess,
+                                     family)
+                update_media_manifest(bucket, family, activity_info, media)
+                activities.append(activity_info)
         except Exception as e:
-            print(e)
-            print('Error putting media: {}'.format(activity_info))
+            get_logger().error(
+                'Error putting media: {}: {}'.format(activity_info, e))
             raise e
+        if source:
+            cache_parse(bucket, *source,
+                        ParsedEmail(MEDIA, activities, [], family))
+        return activities, []
 
 
-def put_sdb_activities(sdb: boto3.client,
-                       activities: List[Activity],
-                       naps: List[Nap]) -> None:
+def get_cached_parse(bucket: str, key: str) -> Optional[ParsedEmail]:
+    """
+    Current cached parse of an email, None if there is none (or it could not
+    be read)
+    """
+    try:
+        return get_parsed(s3, bucket, key, families=family_version())
+    except Exception as e:
+        get_logger().warning('Error reading cached parse of {}: {}'.format(
+            key, e))
+        return None
+
+
+def cache_parse(bucket: str, key: str, etag: str,
+                parsed: ParsedEmail) -> None:
+    try:
+        with timer('s3_put'):
+            put_parsed(s3, bucket, key, etag, parsed, family_version())
+    except Exception as e:
+        # only costs a reparse later
+        get_logger().warning('Error caching parse of {}: {}'.format(key, e))
+
+
+def store_parsed(bucket: str, parsed: ParsedEmail,
+                 reprocess: bool=False) -> Tuple[List[Activity], List[Nap]]:
+    """
+    Store a cached parse in SimpleDB. Media files were stored when the email
+    was first processed, so they are not downloaded again
+    """
+    write_sdb_activities(bucket, parsed.activities, parsed.naps, reprocess,
+                         parsed.family)
+    if parsed.kind == NOTES:
+        _update_notes_index(parsed.activities, parsed.family)
+    return parsed.activities, parsed.naps
+
+
+def known_media(bucket: str, media_id: str) -> Optional[Tuple[str, str]]:
+    """
+    (stored media name, original file name) of a Kaymbu media id that is
+    already stored, see note_parse.parse_gretchens_picture
+    """
+    try:
+        ref = find_media_id(s3, bucket, media_id)
+    except Exception as e:
+        # only costs a download
+        get_logger().warning('Error looking up media {}: {}'.format(media_id,
+                                                                   e))
+        return None
+    return (ref.media_name, ref.file_name) if ref else None
+
+
+def store_media(media: Optional[bytes], bucket: str,
+                activity: Activity) -> Activity:
+    """
+    Store a downloaded media file, unless the same content is already stored
+
+    :param media: content, None if it was not downloaded (see known_media)
+    :param bucket: email bucket
+    :param activity: media activity, its result is the media name
+    :return: the activity, with the name the content is stored under
+    """
+    if media is None:
+        return activity
+    media_id, _ = os.path.splitext(activity.result)
+    digest = media_digest(media)
+    with timer('s3_fetch'):
+        media_name = find_media_digest(s3, bucket, digest)
+    if media_name:
+        get_logger().info('Media {} is a copy of {}'.format(activity.result,
+                                                           media_name))
+    else:
+        media_name = activity.result
+        put_media_object(media, bucket, media_name)
+    with timer('s3_put'):
+        index_media(s3, bucket, media_id,
+                    MediaRef(media_name, activity.notes, digest),
+                    new_content=media_name == activity.result)
+    return activity._replace(result=media_name)
+
+
+def _stored_media_head(bucket: str,
+                       media_name: str) -> Tuple[int, Optional[bytes]]:
+    """
+    Size of a stored media file and the start of its content (None for
+    videos, whose dimensions are not read), (0, None) if it is not stored
+    """
+    key = 'media/{}'.format(media_name)
+    try:
+        with timer('s3_fetch'):
+            if is_video(media_name):
+                return s3.head_object(Bucket=bucket,
+                                      Key=key)['ContentLength'], None
+            response = s3.get_object(
+                Bucket=bucket, Key=key,
+                Range='bytes=0-{}'.format(MEDIA_HEAD_BYTES - 1))
+            head = response['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey',
+                                           'InvalidRange']:
+            return 0, None
+        raise e
+    # bytes <start>-<end>/<size>
+    content_range = response.get('ContentRange')
+    size = int(content_range.split('/')[-1]) if content_range else len(head)
+    return size, head
+
+
+def update_media_manifest(bucket: str, family: str, activity: Activity,
+                          media: Optional[bytes]=None) -> bool:
+    """
+    List a stored media file in the media manifest of its family and week
+    (see media_manifest.py)
+
+    :param bucket: email bucket
+    :param family: see email_family
+    :param activity: media activity, as returned by store_media
+    :param media: content, None to read what is needed from S3
+    :return: True if it was not listed yet
+    """
+    media_name = activity.result
+
+    def make_entry():
+        if media is not None:
+            size, content = len(media), None if is_video(media_name) else media
+        else:
+            size, content = _stored_media_head(bucket, media_name)
+        derivatives = []
+        if is_video(media_name):
+            poster = poster_name(media_name)
+            poster_size, poster_head = _stored_media_head(bucket, poster)
+            if poster_head:
+                derivatives.append((poster, poster_size, poster_head))
+        return media_entry(media_name, activity.datetime, size,
+                           content, derivatives)
+
+    with timer('s3_put'):
+        return add_to_manifest(s3, bucket, family, activity.date, media_name,
+                               make_entry)
+
+
+def put_media_object(media: bytes, bucket: str, media_name: str) -> None:
+    """
+    Store one downloaded media file (and a poster frame for videos) in S3
+    """
+    # served with the stored type, so browsers can play videos inline
+    content_type, _ = mimetypes.guess_type(media_name)
+    with timer('s3_put'):
+        s3.put_object(
+            Body=media,
+            Bucket=bucket,
+            Key='media/{}'.format(media_name),
+            ContentType=content_type or 'application/octet-stream'
+        )
+    if is_video(media_name):
+        _put_video_poster(media, bucket, media_name)
+
+
+def extract_poster_frame(video: bytes) -> Optional[bytes]:
+    """
+    First frame of a video as JPEG bytes, using ffmpeg if it is on the path
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        get_logger().info('ffmpeg not found, not making poster frame')
+        return None
+
+    # mp4 files often need seeking, so go through a file instead of a pipe
+    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as tmp:
+        tmp.write(video)
+    try:
+        proc = subprocess.run(
+            [ffmpeg, '-loglevel', 'error', '-i', tmp.name, '-frames:v', '1',
+             '-f', 'image2', '-vcodec', 'mjpeg', 'pipe:1'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60
+        )
+    finally:
+        os.remove(tmp.name)
+    if proc.returncode != 0 or not proc.stdout:
+        get_logger().warning(
+            'Could not make poster frame: {}'.format(proc.stderr))
+        return None
+    return proc.stdout
+
+
+def _put_video_poster(video: bytes, bucket: str, media_name: str) -> None:
+    poster = extract_poster_frame(video)
+    if poster:
+        with timer('s3_put'):
+            s3.put_object(
+                Body=poster,
+                Bucket=bucket,
+                Key='media/{}'.format(poster_name(media_name)),
+                ContentType='image/jpeg'
+            )
+
+
+def _ingest_attributes(reprocess: bool) -> List[dict]:
+    """
+    Attributes recording when (and how) an item was written, used by the
+    dashboard to fetch only items that changed since its last query
+    """
+    return [
+        {
+            'Name': 'ingest_datetime',
+            'Value': datetime.now(pytz.utc).isoformat(),
+            'Replace': True
+        },
+        {
+            'Name': 'ingest_mode',
+            'Value': 'reprocess' if reprocess else 'new',
+            'Replace': True
+        }
+    ]
+
+
+def item_name_prefix(family: str) -> str:
+    """
+    Start of the names of a family's items, so families with children of
+    the same name do not overwrite each other
+    """
+    if not family or family == LEGACY_FAMILY:
+        return ''
+    return family + '/'
+
+
+def activity_item_names(activities: List[Activity],
+                        family: str='') -> List[str]:
+    """
+    SimpleDB item names: [family/]name-date-activity-count, e.g.,
+    Emilia-2018-09-21-Meal-002. Media is named after the media file instead
+    of a child, e.g., 1234.jpg-2018-09-21-Media-000
+    """
+    prefix = item_name_prefix(family)
+    if isinstance(activities, ActivityBatch):
+        return [prefix + x for x in activities.item_names()]
     act_counts = {}
+    names = []
     for act in activities:
-        act_id = '-'.join(act[:3])
+        owner = act.result if act.activity == 'Media' else act.first_name
+        act_id = prefix + '-'.join([owner, act.date, act.activity])
         act_counts[act_id] = act_counts.setdefault(act_id, -1) + 1
 
-        # store all activities
-        attributes = [
-                {
-                    'Name': 'first_name',
-                    'Value': act.first_name,
-                    'Replace': True
-                },
-                # {
-                #     'Name': 'date',
-                #     'Value': act.date,
-                #     'Replace': True
-                # },
-                {
-                    'Name': 'activity',
-                    'Value': act.activity,
-                    'Replace': True
-                },
-                {
-                    'Name': 'result',
-                    'Value': act.result,
-                    'Replace': True
-                }
-        ]
-        if act.notes:
-            attributes.append({
-                'Name': 'notes',
-                'Value': act.notes,
-                'Replace': True
-            })
-        if act.datetime:
-            attributes.append({
-                'Name': 'start_datetime',
-                'Value': act.datetime,
-                'Replace': True
-            })
-
         if act_counts[act_id] > 99:
             e_str = 'Activity count over 99 for id {}, zero padding will fail'
             raise ValueError(e_str.format(act_id))
+        names.append('-'.join([act_id, str(act_counts[act_id]).zfill(3)]))
+    return names
+
+
+def _update_notes_index(activities: List[Activity], family: str='') -> None:
+    """
+    Add activities to the local search index, if one is configured
+    """
+    if not NOTES_INDEX_PATH:
+        return
+    try:
+        names = activity_item_names(activities, family)
+        # the email has all items of its children and days, see
+        # reconcile_sdb_activities
+        stems = set(_RE_ITEM_STEM.match(x).group(1) for x in names)
+        conn = open_index(NOTES_INDEX_PATH)
+        index_activities(conn, zip(names, activities), stems, family)
+        conn.close()
+    except Exception as e:
+        # the index can always be rebuilt from an export
+        get_logger().warning('Error updating notes index {}: {}'.format(
+            NOTES_INDEX_PATH, e))
 
-        sdb.put_attributes(
-            DomainName=SDB_DOMAIN,
-            ItemName='-'.join([act_id, str(act_counts[act_id]).zfill(3)]),
-            Attributes=attributes
-        )
 
-    nap_count = 0
-    for nap in naps:
-        attributes = [
-            {
-                'Name': 'first_name',
-                'Value': nap.first_name,
-                'Replace': True
-            },
-            {
-                'Name': 'activity',
-                'Value': 'NapTimes',
-                'Replace': True
-            },
-            {
-                'Name': 'start_datetime',
-                'Value': nap.start_datetime,
-                'Replace': True
-            },
-            {
-                'Name': 'end_datetime',
-                'Value': nap.end_datetime,
-                'Replace': True
-            }
-        ]
+def _is_long_note(act: Activity) -> bool:
+    """
+    True if an activity's notes are stored in S3 (see long_notes.py). Media
+    notes are file names, which always fit
+    """
+    return act.activity != 'Media' and is_overflow(act.notes)
 
+
+def sdb_items(activities: List[Activity], naps: List[Nap],
+              family: str='') -> List[Tuple[str, str, Dict[str, str]]]:
+    """
+    SimpleDB items for activities and naps, without the ingest attributes
+
+    :return: (domain, item name, {attribute: value}) per item
+    """
+    items = []
+    for act, item_name in zip(activities,
+                              activity_item_names(activities, family)):
+        attributes = {'first_name': act.first_name,
+                      'activity': act.activity,
+                      'result': act.result}
+        if _is_long_note(act):
+            attributes['notes'] = note_preview(act.notes)
+            attributes['notes_key'] = note_key(act.notes)
+        elif act.notes:
+            attributes['notes'] = act.notes
+        if act.datetime:
+            attributes['start_datetime'] = act.datetime
+            attributes[EPOCH_ATTRIBUTE] = sortable_epoch(act.datetime)
+        if family:
+            attributes['family'] = family
+        items.append((shard_domain(act.date), item_name, attributes))
+
+    for nap_count, nap in enumerate(naps):
         if nap_count > 99:
             e_str = 'over 99 naps, ID zero padding will fail'
             raise ValueError(e_str)
-        nap_id = '-'.join([nap.first_name,
-                           # date
-                           nap.start_datetime[:10],
-                           'NapTimes',
-                           str(nap_count).zfill(3)])
-        sdb.put_attributes(
-            DomainName=SDB_DOMAIN,
-            ItemName=nap_id,
-            Attributes=attributes
-        )
-        nap_count += 1
+        nap_id = item_name_prefix(family) + '-'.join([
+            nap.first_name,
+            # date
+            nap.start_datetime[:10],
+            'NapTimes',
+            str(nap_count).zfill(3)
+        ])
+        attributes = {'first_name': nap.first_name,
+                      'activity': 'NapTimes',
+                      'start_datetime': nap.start_datetime,
+                      EPOCH_ATTRIBUTE: sortable_epoch(nap.start_datetime),
+                      'end_datetime': nap.end_datetime}
+        if family:
+            attributes['family'] = family
+        items.append((shard_domain(nap.start_datetime), nap_id, attributes))
+    return items
+
+
+def _replace_attributes(attributes: Dict[str, str]) -> List[dict]:
+    return [{'Name': x, 'Value': y, 'Replace': True}
+            for x, y in attributes.items()]
+
+
+def put_sdb_activities(sdb: boto3.client,
+                       activities: List[Activity],
+                       naps: List[Nap],
+                       reprocess: bool=False,
+                       family: str='') -> None:
+    """
+    Store activities and naps in SimpleDB
+
+    :param sdb: SimpleDB client
+    :param activities: activities to store (a list or an ActivityBatch)
+    :param naps: naps to store
+    :param reprocess: items are being rewritten (e.g., after a parser fix),
+        which tells the dashboard to fully refresh the affected weeks
+    :param family: family the items belong to (see email_family), stored as
+        the family attribute and in the item names
+
+    Long notes only get a preview and the key of the full text, which must
+    be stored with long_notes.put_notes (write_sdb_activities does)
+    """
+    ingest_attributes = _ingest_attributes(reprocess)
+    for domain, item_name, attributes in sdb_items(activities, naps, family):
+        write_to_domain(sdb, domain, lambda: sdb.put_attributes(
+            DomainName=domain,
+            ItemName=item_name,
+            Attributes=_replace_attributes(attributes) + ingest_attributes
+        ))
+
+
+def write_sdb_activities(bucket: str, activities: List[Activity],
+                         naps: List[Nap], reprocess: bool=False,
+                         family: str='') -> None:
+    """
+    Store items with the module SimpleDB client: new emails are written,
+    reprocessed ones are reconciled with what is stored
+
+    :param bucket: email bucket, where long notes are stored
+    :param reprocess: see put_sdb_activities
+    """
+    # before the items that point to them
+    long_notes = [x.notes for x in activities if _is_long_note(x)]
+    if long_notes:
+        with timer('s3_put', len(long_notes)):
+            put_notes(s3, bucket, long_notes)
+    with timer('sdb_write', len(activities) + len(naps)):
+        if reprocess:
+            counts = reconcile_sdb_activities(sdb, activities, naps, family)
+            get_logger().info('Reconciled items: {}'.format(counts))
+        else:
+            put_sdb_activities(sdb, activities, naps, family=family)
+
+
+def reconcile_sdb_activities(sdb: boto3.client,
+                             activities: List[Activity],
+                             naps: List[Nap],
+                             family: str='') -> Dict[str, int]:
+    """
+    Rewrite reprocessed items, writing only what changed
+
+    The stored items of each child and date (or media file) are read with one
+    select and diffed against the new ones: changed and new items are written
+    (as reprocessed), attributes that are gone are deleted, and items that are
+    no longer parsed (e.g., the note lost an activity) are deleted. Unchanged
+    items are not written.
+
+    :param sdb: SimpleDB client
+    :param activities: see put_sdb_activities
+    :param naps: see put_sdb_activities
+    :param family: see put_sdb_activities
+    :return: numbers of unchanged, written and deleted items
+    """
+    counts = {'unchanged': 0, 'put': 0, 'deleted': 0}
+    new_items = {}
+    for domain, item_name, attributes in sdb_items(activities, naps, family):
+        stem = _RE_ITEM_STEM.match(item_name).group(1)
+        new_items.setdefault((domain, stem), {})[item_name] = attributes
+
+    ingest_attributes = _ingest_attributes(True)
+    for (domain, stem), items in new_items.items():
+        query = 'select * from `{}` where itemName() like "{}%"'.format(
+            domain, stem.replace('"', '""'))
+        stored = {x['Name']: {y['Name']: y['Value']
+                              for y in x.get('Attributes', [])}
+                  for x in select_all(sdb, query)}
+
+        puts, deletes = [], []
+        for item_name, attributes in items.items():
+            old = {x: y for x, y in stored.get(item_name, {}).items()
+                   if x not in INGEST_ATTRIBUTES}
+            if old == attributes:
+                counts['unchanged'] += 1
+                continue
+            puts.append({
+                'Name': item_name,
+                'Attributes': _replace_attributes(attributes) +
+                ingest_attributes
+            })
+            gone = sorted(set(old) - set(attributes))
+            if gone:
+                deletes.append({'Name': item_name,
+                                'Attributes': [{'Name': x} for x in gone]})
+        stale = sorted(set(stored) - set(items))
+        deletes.extend({'Name': x} for x in stale)
+        if stale and not puts:
+            # a reprocessed item tells the dashboard to drop its cached copy
+            # of the week, which still has the deleted items
+            touch = sorted(items)[0]
+            puts.append({'Name': touch, 'Attributes': ingest_attributes})
+        counts['put'] += len(puts)
+        counts['deleted'] += len(stale)
+
+        for i in range(0, len(puts), SDB_BATCH_SIZE):
+            batch = puts[i:i + SDB_BATCH_SIZE]
+            write_to_domain(sdb, domain, lambda: sdb.batch_put_attributes(
+                DomainName=domain, Items=batch))
+        for i in range(0, len(deletes), SDB_BATCH_SIZE):
+            sdb.batch_delete_attributes(DomainName=domain,
+                                        Items=deletes[i:i + SDB_BATCH_SIZE])
+    return counts
@@ -1,18 +1,243 @@
 """
-Run full lambda pipeline for one s3 item.
+Run full lambda pipeline for one s3 item, or every item under a prefix.
 
-Useful for reprocessing a failed email
+Useful for reprocessing a failed email, or the whole archive after a parser
+fix:
+
+    python lambda_one_email.py gretchens-house-emails 0a1b2c3d4e
+    python lambda_one_email.py gretchens-house-emails --prefix '' \\
+        --start 2018-09-01 --end 2018-12-31 --dry-run
 """
 import argparse
-from lambda_function import lambda_worker
+import logging
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import boto3
+
+import lambda_function
+from lambda_function import (
+    decode_email_body,
+    fetch_email,
+    get_cached_parse,
+    lambda_worker
+)
+from note_parse import parse_gretchens_notes
+from parse_cache import is_email_key
+from profiling import profiled, thread_profiled
+
+# SimpleDB starts throttling a domain somewhere past this many puts per second
+SDB_RATE = 50
+WORKERS = 16
+LIST_WORKERS = 8
+# the key space under a prefix is listed in ranges split at these characters
+LIST_SPLITS = string.digits[1:] + string.ascii_lowercase
+
+
+def get_logger():
+    return logging.getLogger("lambda_one_email")
+
+
+class RateLimiter:
+    """
+    Token bucket shared by threads: on average no more than rate calls per
+    second, in bursts of up to burst calls
+    """
+    def __init__(self, rate: float, burst: Optional[int]=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # take the token now, even if it is only available later
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class RateLimitedClient:
+    """
+    Wrap a boto3 client so every call waits on a RateLimiter
+    """
+    def __init__(self, client: boto3.client, limiter: RateLimiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def limited(*args, **kwargs):
+            self._limiter.wait()
+            return attr(*args, **kwargs)
+        return limited
+
+
+def _key_ranges(prefix: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    (start after, last key) ranges that together cover every key under prefix
+    """
+    bounds = [prefix + x for x in LIST_SPLITS]
+    return list(zip([''] + bounds, bounds + [None]))
+
+
+def _list_range(s3: boto3.client, bucket: str, prefix: str, start_after: str,
+                last: Optional[str]) -> List[Dict]:
+    paginator = s3.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                   StartAfter=start_after):
+        for obj in page.get('Contents', []):
+            if last is not None and obj['Key'] > last:
+                return objects
+            objects.append(obj)
+    return objects
+
+
+def list_keys(s3: boto3.client, bucket: str, prefix: str='',
+              start: Optional[str]=None, end: Optional[str]=None,
+              workers: int=LIST_WORKERS) -> List[str]:
+    """
+    Keys under a prefix, listing ranges of the key space in parallel
+
+    :param s3: S3 client
+    :param bucket: bucket name
+    :param prefix: key prefix
+    :param start: only keys last modified on or after this date (YYYY-MM-DD,
+        UTC), i.e., emails received on or after it
+    :param end: only keys last modified on or before this date
+    :param workers: ranges listed at once
+    :return: keys in order, leaving out media and cached parses
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pages = pool.map(lambda x: _list_range(s3, bucket, prefix, *x),
+                         _key_ranges(prefix))
+        objects = [x for y in pages for x in y]
+
+    keys = []
+    for obj in objects:
+        if not is_email_key(obj['Key']):
+            continue
+        date = obj['LastModified'].strftime('%Y-%m-%d')
+        if (start and date < start) or (end and date > end):
+            continue
+        keys.append(obj['Key'])
+    return keys
+
+
+def parse_only(bucket: str, key: str) -> Tuple[List, List]:
+    """
+    Parse an email (or read its cached parse) without storing anything.
+    Picture emails are not downloaded, so without a cached parse they give no
+    activities
+    """
+    parsed = get_cached_parse(bucket, key)
+    if parsed:
+        return parsed.activities, parsed.naps
+    raw_email, _ = fetch_email(bucket, key)
+    body = decode_email_body(raw_email)
+    if 'download_btn' in body:
+        return [], []
+    return parse_gretchens_notes(body)
+
+
+def reprocess_keys(bucket: str, keys: List[str], workers: int=WORKERS,
+                   sdb_rate: float=SDB_RATE, dry_run: bool=False) -> Dict:
+    """
+    Run the lambda pipeline for many keys on a pool of threads sharing the
+    module level S3 and SimpleDB clients
+
+    :param bucket: bucket name
+    :param keys: email keys
+    :param workers: emails processed at once
+    :param sdb_rate: SimpleDB calls per second across all workers
+    :param dry_run: only fetch and parse, see parse_only
+    :return: numbers of keys, processed emails and activities, and the
+        failures as (key, error) pairs
+    """
+    worker = parse_only if dry_run else \
+        lambda x, y: lambda_worker(x, y, reprocess=True)
+    summary = {'keys': len(keys), 'processed': 0, 'activities': 0,
+               'failures': []}
+
+    sdb = lambda_function.sdb
+    lambda_function.sdb = RateLimitedClient(sdb, RateLimiter(sdb_rate))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(x, pool.submit(thread_profiled(worker), bucket, x))
+                       for x in keys]
+            for key, future in futures:
+                error = future.exception()
+                if error:
+                    summary['failures'].append((key, str(error)))
+                    continue
+                activities, naps = future.result()
+                summary['processed'] += 1
+                summary['activities'] += len(activities) + len(naps)
+    finally:
+        lambda_function.sdb = sdb
+    return summary
+
+
+def _print_summary(summary: Dict) -> None:
+    print('{processed} of {keys} emails processed, {activities} '
+          'activities'.format(**summary))
+    if summary['failures']:
+        print('{} failed:'.format(len(summary['failures'])))
+        for key, error in summary['failures']:
+            print('  {}: {}'.format(key, error))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description="Process an s3 email and update simpledb"
+        description="Process s3 emails and update simpledb"
     )
     parser.add_argument('bucket', help='Bucket name')
-    parser.add_argument('key', help='Name of object')
+    parser.add_argument('key', nargs='?', help='Name of object')
+    parser.add_argument('--prefix',
+                        help='Reprocess every object under this prefix '
+                             'instead of one key')
+    parser.add_argument('--start', help='With --prefix, only emails '
+                                        'received on or after YYYY-MM-DD')
+    parser.add_argument('--end', help='With --prefix, only emails received '
+                                      'on or before YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Emails processed at once')
+    parser.add_argument('--sdb-rate', type=float, default=SDB_RATE,
+                        help='SimpleDB calls per second')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only fetch and parse, do not store anything')
+    parser.add_argument('--profile', metavar='DEST',
+                        help='Profile the run, writing stats to a directory '
+                             'or s3://bucket/prefix')
     args = parser.parse_args()
 
-    lambda_worker(args.bucket, args.key)
+    logging.basicConfig(level=logging.WARNING)
+    if args.prefix is None:
+        if not args.key:
+            parser.error('a key or --prefix is required')
+        with profiled(args.key, args.profile):
+            if args.dry_run:
+                print(parse_only(args.bucket, args.key))
+            else:
+                lambda_worker(args.bucket, args.key, reprocess=True)
+    else:
+        with profiled(args.prefix or args.bucket, args.profile):
+            email_keys = list_keys(lambda_function.s3, args.bucket,
+                                   args.prefix, args.start, args.end)
+            print('Found {} emails'.format(len(email_keys)))
+            _print_summary(reprocess_keys(args.bucket, email_keys,
+                                          args.workers, args.sdb_rate,
+                                          args.dry_run))
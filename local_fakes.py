@@ -0,0 +1,923 @@
+"""
+In-memory stand-ins for S3, SimpleDB, SQS and the Kaymbu export site.
+
+These let the whole pipeline (lambda_function, note_parse, dash_app.get_data)
+run offline, e.g., for tests and benchmarks:
+
+    s3, sdb = FakeS3(), FakeSimpleDB()
+    with FakeKaymbuServer(latency_s=0.02) as kaymbu, \\
+            installed_fakes(s3, sdb, kaymbu.url):
+        lambda_worker('gretchens-house-emails', 'some-email')
+
+Only the parts of the boto3 APIs used by this project are implemented.
+"""
+import base64
+import email.message
+import hashlib
+import io
+import re
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from botocore.exceptions import ClientError
+
+# items per select page when no limit is given (same as SimpleDB)
+SELECT_PAGE_SIZE = 100
+
+
+def _client_error(code: str, operation: str, message: str='') -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message}},
+                       operation)
+
+
+def _encode_token(offset: int) -> str:
+    return base64.b64encode(str(offset).encode('utf-8')).decode('utf-8')
+
+
+def _decode_token(token: Optional[str]) -> int:
+    if not token:
+        return 0
+    return int(base64.b64decode(token.encode('utf-8')).decode('utf-8'))
+
+
+class FakeStreamingBody:
+    """
+    Enough of botocore's StreamingBody for read() and iter_chunks()
+    """
+    def __init__(self, data: bytes):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt: Optional[int]=None) -> bytes:
+        return self._stream.read(amt)
+
+    def iter_chunks(self, chunk_size: int=1024) -> Iterator[bytes]:
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+class _FakeListPaginator:
+    def __init__(self, s3: 'FakeS3'):
+        self._s3 = s3
+
+    def paginate(self, **kwargs) -> Iterator[Dict]:
+        kwargs = dict(kwargs)
+        while True:
+            page = self._s3.list_objects_v2(**kwargs)
+            yield page
+            if not page['IsTruncated']:
+                break
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class FakeS3:
+    """
+    In-memory S3 client
+
+    :param latency_s: seconds every call sleeps, to mimic network round trips
+    """
+    def __init__(self, latency_s: float=0.0):
+        self.latency_s = latency_s
+        self._objects = {}
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _get(self, bucket: str, key: str, operation: str) -> Dict:
+        with self._lock:
+            obj = self._objects.get((bucket, key))
+        if obj is None:
+            code = '404' if operation == 'HeadObject' else 'NoSuchKey'
+            raise _client_error(code, operation, key)
+        return obj
+
+    def put_object(self, Bucket: str, Key: str, Body: Any=b'',
+                   ContentType: str='binary/octet-stream', **kwargs) -> Dict:
+        self._call('PutObject')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+        with self._lock:
+            self._objects[(Bucket, Key)] = {
+                'Body': bytes(Body),
+                'ContentType': ContentType,
+                'ETag': etag,
+                'LastModified': datetime.now(timezone.utc),
+                'Metadata': kwargs.get('Metadata', {})
+            }
+        return {'ETag': etag}
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str]=None,
+                   **kwargs) -> Dict:
+        self._call('GetObject')
+        obj = self._get(Bucket, Key, 'GetObject')
+        data = obj['Body']
+        out = {'ContentType': obj['ContentType'],
+               'ETag': obj['ETag'],
+               'LastModified': obj['LastModified'],
+               'Metadata': obj['Metadata']}
+        if Range:
+            range_re = re.match(r'bytes=([0-9]*)-([0-9]*)$', Range)
+            if not range_re or not any(range_re.groups()):
+                raise _client_error('InvalidRange', 'GetObject', Range)
+            start, end = range_re.groups()
+            if not start:
+                start, end = max(0, len(data) - int(end)), len(data) - 1
+            else:
+                start = int(start)
+                end = min(int(end), len(data) - 1) if end else len(data) - 1
+            if start >= len(data) or end < start:
+                raise _client_error('InvalidRange', 'GetObject', Range)
+            out['ContentRange'] = 'bytes {}-{}/{}'.format(start, end,
+                                                          len(data))
+            data = data[start:end + 1]
+        out['Body'] = FakeStreamingBody(data)
+        out['ContentLength'] = len(data)
+        return out
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> Dict:
+        self._call('HeadObject')
+        obj = self._get(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(obj['Body']),
+                'ContentType': obj['ContentType'],
+                'ETag': obj['ETag'],
+                'LastModified': obj['LastModified'],
+                'Metadata': obj['Metadata']}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> Dict:
+        self._call('DeleteObject')
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+        return {}
+
+    def copy_object(self, Bucket: str, Key: str, CopySource: Dict,
+                    **kwargs) -> Dict:
+        obj = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        return self.put_object(Bucket=Bucket, Key=Key, Body=obj['Body'],
+                               ContentType=obj['ContentType'])
+
+    def list_objects_v2(self, Bucket: str, Prefix: str='',
+                        Delimiter: str='', MaxKeys: int=1000,
+                        ContinuationToken: str='', StartAfter: str='',
+                        **kwargs) -> Dict:
+        self._call('ListObjectsV2')
+        with self._lock:
+            keys = sorted(k for b, k in self._objects
+                          if b == Bucket and k.startswith(Prefix) and
+                          k > StartAfter)
+        contents, prefixes = [], []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common = key[:key.index(Delimiter, len(Prefix)) + 1]
+                if common not in prefixes:
+                    prefixes.append(common)
+            else:
+                contents.append(key)
+
+        # page over keys and common prefixes together, like S3
+        entries = sorted([(x, False) for x in contents] +
+                         [(x, True) for x in prefixes])
+        offset = _decode_token(ContinuationToken)
+        page = entries[offset:offset + MaxKeys]
+        out = {
+            'Contents': [],
+            'CommonPrefixes': [{'Prefix': x} for x, y in page if y],
+            'KeyCount': len(page),
+            'IsTruncated': offset + MaxKeys < len(entries)
+        }
+        for key, _ in [x for x in page if not x[1]]:
+            obj = self._objects[(Bucket, key)]
+            out['Contents'].append({'Key': key,
+                                    'Size': len(obj['Body']),
+                                    'ETag': obj['ETag'],
+                                    'LastModified': obj['LastModified']})
+        if out['IsTruncated']:
+            out['NextContinuationToken'] = _encode_token(offset + MaxKeys)
+        return out
+
+    def get_paginator(self, operation: str) -> _FakeListPaginator:
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(operation)
+        return _FakeListPaginator(self)
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str,
+                       ExtraArgs: Optional[Dict]=None, **kwargs) -> None:
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read(),
+                        **(ExtraArgs or {}))
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str,
+                    **kwargs) -> None:
+        with open(Filename, 'rb') as in_file:
+            self.upload_fileobj(in_file, Bucket, Key, **kwargs)
+
+    def download_file(self, Bucket: str, Key: str, Filename: str,
+                      **kwargs) -> None:
+        with open(Filename, 'wb') as out_file:
+            out_file.write(self.get_object(Bucket=Bucket,
+                                           Key=Key)['Body'].read())
+
+    def generate_presigned_url(self, ClientMethod: str, Params: Dict,
+                               ExpiresIn: int=3600, **kwargs) -> str:
+        return 'https://fake-s3.local/{}/{}?Expires={}'.format(
+            Params['Bucket'], Params['Key'], ExpiresIn)
+
+
+class _FakeS3Object:
+    def __init__(self, client: FakeS3, bucket: str, key: str):
+        self._client = client
+        self.bucket_name = bucket
+        self.key = key
+
+    def get(self, **kwargs) -> Dict:
+        return self._client.get_object(Bucket=self.bucket_name, Key=self.key,
+                                       **kwargs)
+
+    def put(self, **kwargs) -> Dict:
+        return self._client.put_object(Bucket=self.bucket_name, Key=self.key,
+                                       **kwargs)
+
+
+class _FakeMeta:
+    def __init__(self, client: FakeS3):
+        self.client = client
+
+
+class FakeS3Resource:
+    """
+    boto3.resource('s3') stand-in on top of a FakeS3 client
+    """
+    def __init__(self, client: FakeS3):
+        self.meta = _FakeMeta(client)
+
+    def Object(self, bucket: str, key: str) -> _FakeS3Object:
+        return _FakeS3Object(self.meta.client, bucket, key)
+
+
+_SELECT_TOKENS = re.compile(r"""
+    \s*(?:
+        (?P<name>`(?:[^`]|``)*`)
+      | (?P<string>"(?:[^"]|"")*"|'(?:[^']|'')*')
+      | (?P<op>!=|>=|<=|=|>|<|\(|\)|,|\*)
+      | (?P<word>itemName\(\)|count\(\*\)|[A-Za-z0-9_.\-]+)
+    )""", re.VERBOSE | re.IGNORECASE)
+
+
+def _tokenize(expression: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _SELECT_TOKENS.match(expression, pos)
+        if not match or match.end() == pos:
+            raise _client_error('InvalidQueryExpression', 'Select',
+                                expression)
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name':
+            kind, value = 'word', value[1:-1].replace('``', '`')
+        elif kind == 'string':
+            value = value[1:-1].replace(value[0] * 2, value[0])
+        elif kind == 'word' and value.lower() in ['itemname()', 'count(*)']:
+            value = value.lower()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+class _SelectParser:
+    """
+    Recursive descent parser for SimpleDB select expressions
+    """
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def _error(self) -> ClientError:
+        return _client_error('InvalidQueryExpression', 'Select',
+                             self.expression)
+
+    def peek(self, offset: int=0) -> Tuple[str, str]:
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return ('end', '')
+
+    def next(self) -> Tuple[str, str]:
+        token = self.peek()
+        if token[0] == 'end':
+            raise self._error()
+        self.pos += 1
+        return token
+
+    def keyword(self, word: str) -> bool:
+        kind, value = self.peek()
+        if kind == 'word' and value.lower() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, word: str) -> None:
+        kind, value = self.next()
+        if value.lower() != word:
+            raise self._error()
+
+    def parse(self) -> Dict:
+        self.expect('select')
+        output = []
+        while True:
+            kind, value = self.next()
+            output.append(value)
+            if not (self.peek() == ('op', ',')):
+                break
+            self.next()
+        self.expect('from')
+        _, domain = self.next()
+
+        query = {'output': output, 'domain': domain, 'where': None,
+                 'order': None, 'limit': None}
+        if self.keyword('where'):
+            query['where'] = self.parse_or()
+        if self.keyword('order'):
+            self.expect('by')
+            _, attr = self.next()
+            descending = self.keyword('desc')
+            if not descending:
+                self.keyword('asc')
+            query['order'] = (attr, descending)
+        if self.keyword('limit'):
+            query['limit'] = int(self.next()[1])
+        if self.peek()[0] != 'end':
+            raise self._error()
+        return query
+
+    def parse_or(self) -> Callable:
+        terms = [self.parse_and()]
+        while self.keyword('or'):
+            terms.append(self.parse_and())
+        return lambda x: any(t(x) for t in terms)
+
+    def parse_and(self) -> Callable:
+        factors = [self.parse_factor()]
+        while self.keyword('and') or self.keyword('intersection'):
+            factors.append(self.parse_factor())
+        return lambda x: all(f(x) for f in factors)
+
+    def parse_factor(self) -> Callable:
+        if self.keyword('not'):
+            inner = self.parse_factor()
+            return lambda x: not inner(x)
+        if self.peek() == ('op', '('):
+            self.next()
+            inner = self.parse_or()
+            if self.next() != ('op', ')'):
+                raise self._error()
+            return inner
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> Callable:
+        _, attr = self.next()
+        if attr.lower() == 'every':
+            # every(attr): all values must match
+            self.expect('(')
+            _, attr = self.next()
+            self.expect(')')
+            test = self.parse_condition()
+            return lambda x: bool(_values(x, attr)) and \
+                all(test(v) for v in _values(x, attr))
+
+        if self.keyword('is'):
+            negate = self.keyword('not')
+            self.expect('null')
+            return lambda x: bool(_values(x, attr)) == negate
+        test = self.parse_condition()
+        return lambda x: any(test(v) for v in _values(x, attr))
+
+    def parse_condition(self) -> Callable:
+        negate = self.keyword('not')
+        if self.keyword('like'):
+            pattern = self.next()[1]
+            regex = re.compile('^' + '.*'.join(
+                re.escape(x) for x in pattern.split('%')) + '$', re.DOTALL)
+            return lambda v: bool(regex.match(v)) != negate
+        if negate:
+            raise self._error()
+        if self.keyword('between'):
+            low = self.next()[1]
+            self.expect('and')
+            high = self.next()[1]
+            return lambda v: low <= v <= high
+        if self.keyword('in'):
+            self.expect('(')
+            options = [self.next()[1]]
+            while self.peek() == ('op', ','):
+                self.next()
+                options.append(self.next()[1])
+            self.expect(')')
+            return lambda v: v in options
+        kind, op = self.next()
+        value = self.next()[1]
+        compare = {'=': lambda v: v == value,
+                   '!=': lambda v: v != value,
+                   '>': lambda v: v > value,
+                   '>=': lambda v: v >= value,
+                   '<': lambda v: v < value,
+                   '<=': lambda v: v <= value}
+        if kind != 'op' or op not in compare:
+            raise self._error()
+        return compare[op]
+
+
+def _values(item: Tuple[str, Dict[str, List[str]]], attr: str) -> List[str]:
+    name, attributes = item
+    if attr == 'itemname()':
+        return [name]
+    return attributes.get(attr, [])
+
+
+class FakeSimpleDB:
+    """
+    In-memory SimpleDB client, including select with NextToken paging
+
+    :param latency_s: seconds every call sleeps, to mimic network round trips
+    :param page_size: items per select page when the query has no limit
+    """
+    def __init__(self, latency_s: float=0.0,
+                 page_size: int=SELECT_PAGE_SIZE):
+        self.latency_s = latency_s
+        self.page_size = page_size
+        self._domains = {}
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _domain(self, domain: str, operation: str) -> Dict:
+        if domain not in self._domains:
+            raise _client_error('NoSuchDomain', operation, domain)
+        return self._domains[domain]
+
+    def create_domain(self, DomainName: str) -> Dict:
+        self._call('CreateDomain')
+        with self._lock:
+            self._domains.setdefault(DomainName, {})
+        return {}
+
+    def delete_domain(self, DomainName: str) -> Dict:
+        self._call('DeleteDomain')
+        with self._lock:
+            self._domains.pop(DomainName, None)
+        return {}
+
+    def list_domains(self, MaxNumberOfDomains: int=100,
+                     NextToken: str='') -> Dict:
+        self._call('ListDomains')
+        names = sorted(self._domains)
+        offset = _decode_token(NextToken)
+        out = {'DomainNames': names[offset:offset + MaxNumberOfDomains]}
+        if offset + MaxNumberOfDomains < len(names):
+            out['NextToken'] = _encode_token(offset + MaxNumberOfDomains)
+        return out
+
+    def _put(self, domain: Dict, name: str, attributes: List[Dict]) -> None:
+        item = domain.setdefault(name, {})
+        replaced = set()
+        for atrib in attributes:
+            if atrib.get('Replace') and atrib['Name'] not in replaced:
+                item[atrib['Name']] = []
+                replaced.add(atrib['Name'])
+            values = item.setdefault(atrib['Name'], [])
+            if atrib['Value'] not in values:
+                values.append(atrib['Value'])
+
+    def put_attributes(self, DomainName: str, ItemName: str,
+                       Attributes: List[Dict], **kwargs) -> Dict:
+        self._call('PutAttributes')
+        with self._lock:
+            self._put(self._domain(DomainName, 'PutAttributes'), ItemName,
+                      Attributes)
+        return {}
+
+    def batch_put_attributes(self, DomainName: str, Items: List[Dict]
+                             ) -> Dict:
+        self._call('BatchPutAttributes')
+        if len(Items) > 25:
+            raise _client_error('NumberSubmittedItemsExceeded',
+                                'BatchPutAttributes')
+        with self._lock:
+            domain = self._domain(DomainName, 'BatchPutAttributes')
+            for item in Items:
+                self._put(domain, item['Name'], item['Attributes'])
+        return {}
+
+    def _delete(self, domain: Dict, name: str,
+                attributes: Optional[List[Dict]]) -> None:
+        if name not in domain:
+            return
+        if not attributes:
+            del domain[name]
+            return
+        item = domain[name]
+        for atrib in attributes:
+            if 'Value' in atrib:
+                values = item.get(atrib['Name'], [])
+                if atrib['Value'] in values:
+                    values.remove(atrib['Value'])
+            else:
+                item.pop(atrib['Name'], None)
+            if not item.get(atrib['Name']):
+                item.pop(atrib['Name'], None)
+        if not item:
+            del domain[name]
+
+    def delete_attributes(self, DomainName: str, ItemName: str,
+                          Attributes: Optional[List[Dict]]=None,
+                          **kwargs) -> Dict:
+        self._call('DeleteAttributes')
+        with self._lock:
+            self._delete(self._domain(DomainName, 'DeleteAttributes'),
+                         ItemName, Attributes)
+        return {}
+
+    def batch_delete_attributes(self, DomainName: str, Items: List[Dict]
+                                ) -> Dict:
+        self._call('BatchDeleteAttributes')
+        if len(Items) > 25:
+            raise _client_error('NumberSubmittedItemsExceeded',
+                                'BatchDeleteAttributes')
+        with self._lock:
+            domain = self._domain(DomainName, 'BatchDeleteAttributes')
+            for item in Items:
+                self._delete(domain, item['Name'], item.get('Attributes'))
+        return {}
+
+    def get_attributes(self, DomainName: str, ItemName: str,
+                       AttributeNames: Optional[List[str]]=None,
+                       **kwargs) -> Dict:
+        self._call('GetAttributes')
+        with self._lock:
+            item = dict(self._domain(DomainName, 'GetAttributes').get(
+                ItemName, {}))
+        return {'Attributes': [
+            {'Name': name, 'Value': value}
+            for name, values in item.items()
+            if not AttributeNames or name in AttributeNames
+            for value in values
+        ]}
+
+    def select(self, SelectExpression: str, NextToken: str='',
+               ConsistentRead: bool=False) -> Dict:
+        self._call('Select')
+        query = _SelectParser(SelectExpression).parse()
+        with self._lock:
+            domain = self._domain(query['domain'], 'Select')
+            items = [(name, {k: list(v) for k, v in atribs.items()})
+                     for name, atribs in domain.items()]
+
+        if query['where']:
+            items = [x for x in items if query['where'](x)]
+        if query['order']:
+            attr, descending = query['order']
+            items = [x for x in items if _values(x, attr)]
+            items.sort(key=lambda x: min(_values(x, attr)),
+                       reverse=descending)
+
+        output = query['output']
+        if output == ['count(*)']:
+            return {'Items': [{'Name': 'Domain', 'Attributes': [
+                {'Name': 'Count', 'Value': str(len(items))}]}]}
+
+        page_size = query['limit'] or self.page_size
+        offset = _decode_token(NextToken)
+        page = items[offset:offset + page_size]
+        out = {'Items': []}
+        for name, atribs in page:
+            out_item = {'Name': name}
+            if output != ['itemname()']:
+                out_item['Attributes'] = [
+                    {'Name': key, 'Value': value}
+                    for key, values in atribs.items()
+                    if output == ['*'] or key in output
+                    for value in values
+                ]
+            out['Items'].append(out_item)
+        if offset + page_size < len(items):
+            out['NextToken'] = _encode_token(offset + page_size)
+        return out
+
+
+class FakeSQS:
+    """
+    In-memory SQS client for one or more queues
+
+    Received messages are hidden until deleted or until visibility_timeout_s
+    passes, like SQS. receive_message does not wait for new messages.
+
+    :param latency_s: seconds every call sleeps, to mimic network round trips
+    :param visibility_timeout_s: seconds a received message stays hidden
+    """
+    def __init__(self, latency_s: float=0.0,
+                 visibility_timeout_s: float=30.0):
+        self.latency_s = latency_s
+        self.visibility_timeout_s = visibility_timeout_s
+        # queue url -> list of [message id, body, visible at, receipt]
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._count = 0
+        self.calls = {}
+
+    def _call(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def send_message(self, QueueUrl: str, MessageBody: str,
+                     **kwargs) -> Dict:
+        self._call('SendMessage')
+        with self._lock:
+            self._count += 1
+            message_id = 'message{:08d}'.format(self._count)
+            self._queues.setdefault(QueueUrl, []).append(
+                [message_id, MessageBody, 0.0, None])
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl: str, MaxNumberOfMessages: int=1,
+                        **kwargs) -> Dict:
+        self._call('ReceiveMessage')
+        now = time.monotonic()
+        messages = []
+        with self._lock:
+            for message in self._queues.get(QueueUrl, []):
+                if len(messages) >= MaxNumberOfMessages:
+                    break
+                if message[2] <= now:
+                    self._count += 1
+                    message[2] = now + self.visibility_timeout_s
+                    message[3] = 'receipt{:08d}'.format(self._count)
+                    messages.append({'MessageId': message[0],
+                                     'ReceiptHandle': message[3],
+                                     'Body': message[1]})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str) -> Dict:
+        self._call('DeleteMessage')
+        with self._lock:
+            self._queues[QueueUrl] = [
+                x for x in self._queues.get(QueueUrl, [])
+                if x[3] != ReceiptHandle
+            ]
+        return {}
+
+    def pending(self, QueueUrl: str) -> int:
+        """
+        Messages not yet deleted (visible or not)
+        """
+        with self._lock:
+            return len(self._queues.get(QueueUrl, []))
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only in python 3.7+
+    daemon_threads = True
+
+
+class _KaymbuHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeKaymbu/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, headers: Dict[str, str],
+              cut_after: Optional[int]=None):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if cut_after is not None:
+            # connection drops part way through the body
+            body = body[:cut_after]
+            self.close_connection = True
+        self.wfile.write(body)
+        with self.server.kaymbu.lock:
+            self.server.kaymbu.bytes_sent += len(body)
+
+    def do_GET(self):
+        kaymbu = self.server.kaymbu
+        if kaymbu.latency_s:
+            time.sleep(kaymbu.latency_s)
+        url = urlsplit(self.path)
+        with kaymbu.lock:
+            kaymbu.requests.append(self.path)
+
+        if url.path.startswith('/export/'):
+            page_id = url.path[len('/export/'):]
+            if page_id not in kaymbu.pages:
+                return self._send(404, b'', {})
+            return self._send(200,
+                              kaymbu.export_page(page_id).encode('utf-8'),
+                              {'Content-Type': 'text/html'})
+
+        if url.path == '/download/moments':
+            media_id = url.query.replace('/?', '').rstrip('/')
+            if media_id not in kaymbu.media:
+                return self._send(404, b'', {})
+            file_name, data = kaymbu.media[media_id]
+            with kaymbu.lock:
+                cuts = kaymbu.cut_after.get(media_id)
+                cut_after = cuts.pop(0) if cuts else None
+            headers = {
+                'Content-Type': 'application/octet-stream',
+                'Content-Disposition': 'attachment; filename={}'.format(
+                    file_name),
+                'Accept-Ranges': 'bytes',
+                'ETag': '"{}"'.format(hashlib.md5(data).hexdigest())
+            }
+            range_re = re.match(r'bytes=([0-9]+)-([0-9]*)$',
+                                self.headers.get('Range', ''))
+            if range_re:
+                start = int(range_re.group(1))
+                end = int(range_re.group(2) or len(data) - 1)
+                end = min(end, len(data) - 1)
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                    start, end, len(data))
+                return self._send(206, data[start:end + 1], headers,
+                                  cut_after)
+            return self._send(200, data, headers, cut_after)
+
+        self._send(404, b'', {})
+
+
+class FakeKaymbuServer:
+    """
+    Local HTTP server mimicking the Kaymbu export page and media download
+
+    :param latency_s: seconds every request sleeps before answering
+    """
+    def __init__(self, latency_s: float=0.0):
+        self.latency_s = latency_s
+        # page id -> (media ids, is video)
+        self.pages = {}
+        # media id -> (file name, bytes)
+        self.media = {}
+        # media id -> bytes sent before the connection drops, one per request
+        self.cut_after = {}
+        self.requests = []
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def add_media(self, page_id: str, media_id: str, file_name: str,
+                  data: bytes, is_video: bool=False) -> str:
+        """
+        Serve a media file on an export page
+
+        :return: url of the export page (the email's download link)
+        """
+        with self.lock:
+            self.media[media_id] = (file_name, data)
+            ids, _ = self.pages.get(page_id, ([], is_video))
+            self.pages[page_id] = (ids + [media_id], is_video)
+        return '{}/export/{}'.format(self.url, page_id)
+
+    def export_page(self, page_id: str) -> str:
+        media_ids, is_video = self.pages[page_id]
+        if is_video:
+            links = ['<a href="{}/download/moments?{}/?" '
+                     'class="download-btn">'.format(self.url, x)
+                     for x in media_ids]
+        else:
+            links = ['<div data-type="image" data-id="{}"></div>'.format(x)
+                     for x in media_ids]
+        return '<html><body>{}</body></html>'.format(''.join(links))
+
+    def start(self) -> 'FakeKaymbuServer':
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _KaymbuHandler)
+        self._server.kaymbu = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'FakeKaymbuServer':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+def _html_email(html_body: str, subject: str, to: str) -> bytes:
+    msg = email.message.EmailMessage()
+    msg['From'] = 'Kaymbu <no-reply@kaymbu.com>'
+    msg['To'] = to
+    msg['Subject'] = subject
+    msg.set_content(html_body, subtype='html')
+    return msg.as_bytes()
+
+
+def make_note_email(template_payload: str, date: datetime,
+                    child_name: Optional[str]=None,
+                    to: str='parent@example.com') -> bytes:
+    """
+    Daily note email for another date (and child), from a real email payload
+
+    :param template_payload: decoded html of a daily note (e.g., test_message)
+    :param date: date of the new note
+    :param child_name: name to use instead of the one in the template
+    :param to: recipient, which is the family of the email
+    """
+    payload = re.sub('class="heading-date">(.*?)<',
+                     'class="heading-date">{}<'.format(
+                         date.strftime('%B %d, %Y')),
+                     template_payload, count=1)
+    if child_name:
+        payload = re.sub("class=\"heading-name\">(.*)'s Daily Note<",
+                         "class=\"heading-name\">{}'s Daily Note<".format(
+                             child_name),
+                         payload, count=1)
+    return _html_email(payload, 'Daily Note', to)
+
+
+def make_picture_email(download_url: str, date: datetime,
+                       to: str='parent@example.com') -> bytes:
+    """
+    Minimal picture ("moment") email linking to an export page
+    """
+    payload = ('<html><body><table><tr>'
+               '<td class="date">{}</td></tr></table>'
+               '<a href="{}" target="_blank"><img src="https://cdn.example/'
+               'email/download_btn-v1.png"/></a>'
+               '</body></html>').format(date.strftime('%B %d, %Y'),
+                                        download_url)
+    return _html_email(payload, 'New Moment', to)
+
+
+@contextmanager
+def installed_fakes(s3: Optional[FakeS3]=None,
+                    sdb: Optional[FakeSimpleDB]=None,
+                    kaymbu_url: Optional[str]=None) -> Iterator[None]:
+    """
+    Swap the module level AWS clients (and the Kaymbu url) for fakes
+
+    Patches lambda_function, note_parse and dash_app.get_data (if the
+    dashboard requirements are installed). Originals are restored on exit.
+    """
+    import lambda_function
+    import note_parse
+    modules = [(lambda_function, 's3', s3),
+               (lambda_function, 'sdb', sdb),
+               (note_parse, 'KAYMBU_EXPORT_URL', kaymbu_url)]
+    try:
+        from dash_app import get_data
+    except ImportError:
+        pass
+    else:
+        modules.append((get_data, 's3', FakeS3Resource(s3) if s3 else None))
+        modules.append((get_data, 'sdb', sdb))
+        # what it knows about the domains is for the real client
+        modules.append((get_data, '_EPOCH_DOMAINS', set() if sdb else None))
+
+    originals = []
+    for module, name, fake in modules:
+        if fake is not None:
+            originals.append((module, name, getattr(module, name)))
+            setattr(module, name, fake)
+    try:
+        yield
+    finally:
+        for module, name, original in originals:
+            setattr(module, name, original)
@@ -0,0 +1,96 @@
+"""
+Overflow storage for long activity notes.
+
+SimpleDB attribute values are limited to 1024 bytes, which long teacher notes
+go over. Notes longer than NOTES_INLINE_BYTES (or every note, with
+NOTES_OVERFLOW=all) are stored gzipped in the email bucket under
+
+    notes/<sha256 of the text>.txt.gz
+
+and their item gets a short preview in `notes` and the key in `notes_key`.
+Keys are content addressed, so storing a note again (e.g., when an email is
+reprocessed) writes the same object, and an item's attributes only change
+when its text does. The dashboard fetches the full text when it renders the
+activity table.
+"""
+import gzip
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List
+
+import boto3
+
+NOTES_PREFIX = 'notes/'
+# longest note (UTF-8 bytes) kept in SimpleDB, whose limit is 1024
+NOTES_INLINE_BYTES = int(os.environ.get('NOTES_INLINE_BYTES', '1024'))
+# 'long' to store only notes over NOTES_INLINE_BYTES in S3, 'all' for all
+NOTES_OVERFLOW = os.environ.get('NOTES_OVERFLOW', 'long')
+# characters of an overflowed note kept in SimpleDB
+PREVIEW_CHARS = 200
+# notes fetched at once by get_notes
+FETCH_WORKERS = 8
+
+
+def is_overflow(notes: str) -> bool:
+    """
+    True if a note is stored in S3 instead of SimpleDB
+    """
+    if not notes:
+        return False
+    return NOTES_OVERFLOW == 'all' or \
+        len(notes.encode('utf-8')) > NOTES_INLINE_BYTES
+
+
+def note_key(notes: str) -> str:
+    return '{}{}.txt.gz'.format(
+        NOTES_PREFIX, hashlib.sha256(notes.encode('utf-8')).hexdigest())
+
+
+def note_preview(notes: str) -> str:
+    """
+    Start of a note, cut at a word where possible
+    """
+    if len(notes) <= PREVIEW_CHARS:
+        return notes
+    preview = notes[:PREVIEW_CHARS]
+    if ' ' in preview[PREVIEW_CHARS // 2:]:
+        preview = preview[:preview.rindex(' ')]
+    return preview.rstrip() + '...'
+
+
+def put_notes(s3: boto3.client, bucket: str, notes: Iterable[str]) -> int:
+    """
+    Store the overflowing notes of a list of notes
+
+    :return: number of notes stored
+    """
+    stored = set()
+    for text in notes:
+        if not is_overflow(text) or text in stored:
+            continue
+        s3.put_object(Bucket=bucket, Key=note_key(text),
+                      Body=gzip.compress(text.encode('utf-8')),
+                      ContentType='text/plain; charset=utf-8')
+        stored.add(text)
+    return len(stored)
+
+
+def get_note(s3: boto3.client, bucket: str, key: str) -> str:
+    response = s3.get_object(Bucket=bucket, Key=key)
+    return gzip.decompress(response['Body'].read()).decode('utf-8')
+
+
+def get_notes(s3: boto3.client, bucket: str,
+              keys: List[str]) -> Dict[str, str]:
+    """
+    Full text of overflowed notes, fetched in parallel
+
+    :return: {key: text}
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(min(FETCH_WORKERS, len(keys))) as pool:
+        texts = pool.map(lambda x: get_note(s3, bucket, x), keys)
+        return dict(zip(keys, texts))
@@ -0,0 +1,85 @@
+"""
+Index of stored media, so Kaymbu media that is sent again is not stored again.
+
+Two small JSON objects per stored file, in the email bucket:
+
+- media-index/id/<Kaymbu media id>.json: the stored media name, the
+  original file name and the SHA-256 of the content. A media id found here is
+  not downloaded again.
+- media-index/sha256/<hex digest>.json: the stored media name of that
+  content. A new media id with the same content (e.g., a photo in a weekly
+  roundup) only gets a reference to the stored file.
+"""
+import hashlib
+import json
+from collections import namedtuple
+from typing import Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+MEDIA_INDEX_PREFIX = 'media-index/'
+
+# media_name: name under media/, file_name: original file name
+MediaRef = namedtuple('MediaRef', ['media_name', 'file_name', 'sha256'])
+
+
+def media_digest(media: bytes) -> str:
+    return hashlib.sha256(media).hexdigest()
+
+
+def _id_key(media_id: str) -> str:
+    return '{}id/{}.json'.format(MEDIA_INDEX_PREFIX, media_id)
+
+
+def _hash_key(digest: str) -> str:
+    return '{}sha256/{}.json'.format(MEDIA_INDEX_PREFIX, digest)
+
+
+def _get_json(s3: boto3.client, bucket: str, key: str) -> Optional[dict]:
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return None
+        raise e
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def _put_json(s3: boto3.client, bucket: str, key: str, value: dict) -> None:
+    s3.put_object(Bucket=bucket, Key=key,
+                  Body=json.dumps(value).encode('utf-8'),
+                  ContentType='application/json')
+
+
+def find_media_id(s3: boto3.client, bucket: str,
+                  media_id: str) -> Optional[MediaRef]:
+    """
+    Stored media of a Kaymbu media id, None if it was never stored
+    """
+    ref = _get_json(s3, bucket, _id_key(media_id))
+    return MediaRef(**ref) if ref else None
+
+
+def find_media_digest(s3: boto3.client, bucket: str,
+                      digest: str) -> Optional[str]:
+    """
+    Stored media name of content with a SHA-256 digest, None if there is none
+    """
+    ref = _get_json(s3, bucket, _hash_key(digest))
+    return ref['media_name'] if ref else None
+
+
+def index_media(s3: boto3.client, bucket: str, media_id: str,
+                ref: MediaRef, new_content: bool) -> None:
+    """
+    Record where a media id is stored
+
+    :param ref: stored media
+    :param new_content: the content was stored under ref.media_name (rather
+        than found by its digest), so it is indexed by digest too
+    """
+    if new_content:
+        _put_json(s3, bucket, _hash_key(ref.sha256),
+                  {'media_name': ref.media_name})
+    _put_json(s3, bucket, _id_key(media_id), ref._asdict())
@@ -0,0 +1,266 @@
+"""
+Per-week manifest of a family's media, so the dashboard can lay out the media
+panel from one small object instead of scanning the week's items and
+downloading every image to learn its size.
+
+One JSON object per family and week (Monday) in the email bucket, which the
+dashboard reads with one GET:
+
+    media-manifest/<family>/<week start>.json
+
+    {"family": ..., "week_start": ..., "media": [<entries>, ...]}
+
+It is compacted from one entry object per media file, which ingest writes
+first:
+
+    media-manifest/<family>/<week start>/<media name>.json
+
+    {"media_name": "abc123.jpg", "content_type": "image/jpeg",
+     "size": 123456, "width": 700, "height": 525,
+     "captured": "2018-10-19T17:02:03-04:00",
+     "derivatives": [{"media_name": "abc123.poster.jpg", ...}]}
+
+Widths and heights are as displayed, i.e., after the EXIF orientation is
+applied; None if they could not be read (e.g., videos). Media is for the
+whole family (see note_parse.FAMILY_WIDE), so every child shares the
+manifest. Each entry is its own object, so concurrent picture emails add
+theirs without read-modify-write races and without the conditional puts the
+Lambda runtime's boto does not have; see compact_manifest for how the
+manifest keeps up with them.
+"""
+import json
+import mimetypes
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+MANIFEST_PREFIX = 'media-manifest/'
+# entries fetched at once by get_manifest
+FETCH_WORKERS = 8
+# JPEG start of frame markers (C4, C8 and CC are not frames)
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# captured: time of the media item (Activity.datetime)
+MediaEntry = namedtuple('MediaEntry', ['media_name', 'content_type', 'size',
+                                       'width', 'height', 'captured',
+                                       'derivatives'])
+
+
+def week_start(date: str) -> str:
+    """
+    Monday of the week of a YYYY-MM-DD date, as the dashboard shows weeks
+    """
+    day = datetime.strptime(date[:10], '%Y-%m-%d')
+    return (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+
+
+def manifest_prefix(family: str, week: str) -> str:
+    """
+    :param family: family attribute, '' for emails without one
+    :param week: any YYYY-MM-DD date in the week
+    """
+    return '{}{}/{}/'.format(MANIFEST_PREFIX, family or '_',
+                             week_start(week))
+
+
+def entry_key(family: str, week: str, media_name: str) -> str:
+    return '{}{}.json'.format(manifest_prefix(family, week), media_name)
+
+
+def _exif_orientation(exif: bytes) -> int:
+    """
+    Orientation tag of a TIFF formatted EXIF block, 1 (normal) if missing
+    """
+    order = {b'II': '<', b'MM': '>'}.get(exif[:2])
+    if not order:
+        return 1
+    ifd, = struct.unpack(order + 'I', exif[4:8])
+    n_entries, = struct.unpack(order + 'H', exif[ifd:ifd + 2])
+    for i in range(n_entries):
+        entry = exif[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if len(entry) < 12:
+            break
+        tag, = struct.unpack(order + 'H', entry[:2])
+        if tag == 0x0112:
+            return struct.unpack(order + 'H', entry[8:10])[0]
+    return 1
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    size = None
+    orientation = 1
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a length
+            i += 2
+            continue
+        length, = struct.unpack('>H', data[i + 2:i + 4])
+        segment = data[i + 4:i + 2 + length]
+        if marker == 0xE1 and segment[:6] == b'Exif\0\0':
+            orientation = _exif_orientation(segment[6:])
+        elif marker in _JPEG_SOF and len(segment) >= 5:
+            height, width = struct.unpack('>HH', segment[1:5])
+            size = (width, height)
+            break
+        elif marker == 0xDA:
+            # image data follows, no frame header found
+            break
+        i += 2 + length
+    if size and orientation in [5, 6, 7, 8]:
+        # rotated a quarter turn
+        size = (size[1], size[0])
+    return size
+
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) of a JPEG, PNG or GIF image from its header, as
+    displayed; None for other content
+    """
+    if data[:2] == b'\xff\xd8':
+        return _jpeg_size(data)
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in [b'GIF87a', b'GIF89a'] and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    return None
+
+
+def _content_type(media_name: str) -> str:
+    content_type, _ = mimetypes.guess_type(media_name)
+    return content_type or 'application/octet-stream'
+
+
+def media_entry(media_name: str, captured: Optional[str], size: int,
+                content: Optional[bytes]=None,
+                derivatives: Optional[List[Tuple[str, int, bytes]]]=None
+                ) -> MediaEntry:
+    """
+    Manifest entry of a stored media file
+
+    :param media_name: name under media/
+    :param captured: capture time (the media activity's datetime)
+    :param size: bytes stored
+    :param content: content, or enough of it to read image dimensions; None
+        if they are not needed (e.g., videos)
+    :param derivatives: (name, size, content) of files made from it, e.g.,
+        the poster frame of a video
+    """
+    width, height = (image_size(content) if content else None) or \
+        (None, None)
+    derived = [media_entry(*x, captured=captured)._asdict()
+               for x in derivatives or []]
+    for derivative in derived:
+        del derivative['derivatives'], derivative['captured']
+    return MediaEntry(media_name, _content_type(media_name), size, width,
+                      height, captured, derived)
+
+
+def manifest_key(family: str, week: str) -> str:
+    """
+    Key of the compacted manifest, which the dashboard reads
+    """
+    return '{}{}/{}.json'.format(MANIFEST_PREFIX, family or '_',
+                                 week_start(week))
+
+
+def _list_keys(s3: boto3.client, bucket: str, prefix: str) -> List[str]:
+    keys = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        keys.extend(x['Key'] for x in response.get('Contents', []))
+        if not response.get('IsTruncated'):
+            return keys
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _get_json(s3: boto3.client, bucket: str, key: str) -> Dict:
+    response = s3.get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def compact_manifest(s3: boto3.client, bucket: str, family: str,
+                     week: str) -> Dict:
+    """
+    Rewrite the manifest of a family's week from its entries
+
+    Writers racing on a week each list the entries again after writing, and
+    write again if one was added meanwhile, so the last write has every entry
+    put before it.
+
+    :param week: any YYYY-MM-DD date in the week
+    :return: the manifest written
+    """
+    prefix = manifest_prefix(family, week)
+    entries = {}
+    manifest = None
+    while True:
+        keys = [x for x in _list_keys(s3, bucket, prefix)
+                if x not in entries]
+        if manifest is not None and not keys:
+            return manifest
+        if keys:
+            with ThreadPoolExecutor(min(FETCH_WORKERS, len(keys))) as pool:
+                entries.update(zip(keys, pool.map(
+                    lambda x: _get_json(s3, bucket, x), keys)))
+        manifest = {'family': family, 'week_start': week_start(week),
+                    'media': sorted(entries.values(),
+                                    key=lambda x: (x['captured'] or '',
+                                                   x['media_name']))}
+        s3.put_object(Bucket=bucket, Key=manifest_key(family, week),
+                      Body=json.dumps(manifest).encode('utf-8'),
+                      ContentType='application/json')
+
+
+def get_manifest(s3: boto3.client, bucket: str, family: str,
+                 week: str) -> Optional[Dict]:
+    """
+    Media manifest of a family's week, entries in capture order; None if
+    there is none
+    """
+    try:
+        return _get_json(s3, bucket, manifest_key(family, week))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+            raise e
+    return None
+
+
+def add_to_manifest(s3: boto3.client, bucket: str, family: str, date: str,
+                    media_name: str,
+                    make_entry: Callable[[], MediaEntry]) -> bool:
+    """
+    Add a media file to the manifest of its week, unless it is listed
+
+    :param date: date of the media item
+    :param media_name: name under media/
+    :param make_entry: function() -> entry, only called if it is not listed
+    :return: True if the manifest was changed
+    """
+    key = entry_key(family, date, media_name)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return False
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+            raise e
+    # writers racing on the same file put the same entry
+    s3.put_object(Bucket=bucket, Key=key,
+                  Body=json.dumps(make_entry()._asdict()).encode('utf-8'),
+                  ContentType='application/json')
+    compact_manifest(s3, bucket, family, date)
+    return True
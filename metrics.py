@@ -0,0 +1,133 @@
+"""
+Stage timing for the ingest pipeline.
+
+Timings are written as CloudWatch embedded metric format (EMF) JSON lines.
+Where they go is set by the METRICS_SINK environment variable:
+
+- 'emf' (default): stdout, which CloudWatch logs turns into metrics
+- 'off': nothing is recorded
+- anything else: path of a local JSON lines file
+
+Summarize a local file with `python metrics.py metrics.jsonl`.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+METRICS_SINK = os.environ.get('METRICS_SINK', 'emf')
+METRICS_NAMESPACE = 'KaymbuParsing'
+
+# stage names used by the pipeline
+STAGES = ['s3_fetch', 'mime_decode', 'parse', 'media_download', 's3_put',
+          'sdb_write']
+
+_sink_lock = threading.Lock()
+
+
+def _write_line(line: str) -> None:
+    if METRICS_SINK == 'emf':
+        with _sink_lock:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+    else:
+        with _sink_lock, open(METRICS_SINK, 'a') as sink:
+            sink.write(line + '\n')
+
+
+def emit(stage: str, duration_ms: float, count: int=1) -> None:
+    """
+    Record one timing for a stage
+
+    :param stage: pipeline stage, see STAGES
+    :param duration_ms: time spent in milliseconds
+    :param count: number of things (items, files) handled in that time
+    """
+    if METRICS_SINK == 'off':
+        return
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Stage']],
+                'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'},
+                            {'Name': 'Count', 'Unit': 'Count'}]
+            }]
+        },
+        'Stage': stage,
+        'Duration': round(duration_ms, 3),
+        'Count': count
+    }
+    _write_line(json.dumps(record))
+
+
+@contextmanager
+def timer(stage: str, count: int=1) -> Iterator[None]:
+    """
+    Time a block of code and emit it as a stage metric
+
+        with timer('s3_fetch'):
+            response = s3.get_object(Bucket=bucket, Key=key)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit(stage, (time.perf_counter() - start) * 1000, count)
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def summarize(lines: Iterator[str]) -> Dict[str, Dict[str, float]]:
+    """
+    p50/p99/max duration (ms) per stage from EMF JSON lines. Lines that are
+    not metrics (e.g., other log output) are skipped
+    """
+    durations = {}
+    for line in lines:
+        line = line.strip()
+        if not line.startswith('{'):
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if 'Stage' in record and 'Duration' in record:
+            durations.setdefault(record['Stage'], []).append(
+                record['Duration'])
+
+    return {
+        stage: {'n': len(values),
+                'p50': _percentile(values, 50),
+                'p99': _percentile(values, 99),
+                'max': max(values)}
+        for stage, values in durations.items()
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarize stage timings from a metrics file or log export'
+    )
+    parser.add_argument('path', help='JSON lines file')
+    args = parser.parse_args()
+
+    with open(args.path, 'r') as metrics_file:
+        summary = summarize(metrics_file)
+    print('{:<16}{:>8}{:>12}{:>12}{:>12}'.format('stage', 'n', 'p50 ms',
+                                                 'p99 ms', 'max ms'))
+    for stage in sorted(summary, key=lambda x: (x not in STAGES,
+                                                STAGES.index(x)
+                                                if x in STAGES else x)):
+        stats = summary[stage]
+        print('{:<16}{:>8d}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            stage, stats['n'], stats['p50'], stats['p99'], stats['max']))
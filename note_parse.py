@@ -1,12 +1,25 @@
+import base64
+import email.message
+import hashlib
+import json
+import logging
+import mimetypes
 import os
+import random
 import re
+import tempfile
+import time
+from calendar import timegm
 from collections import namedtuple
-from datetime import datetime
-from typing import List, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
 
 import pytz
 import requests
 
+import metrics
+from metrics import timer
+
 Activity = namedtuple('Activity', ['first_name',
                                    'date',
                                    'activity',
@@ -19,6 +32,241 @@ Nap = namedtuple('Nap', ['first_name',
                          'start_datetime',
                          'end_datetime'])
 
+# bump when the parsed output changes, so older cached parses (see
+# parse_cache.py) are not used
+PARSER_VERSION = 2
+
+# first name of media activities: media emails are sent to the whole family
+# and do not say which child they are of
+FAMILY_WIDE = ''
+
+# root of the export site that serves media downloads
+KAYMBU_EXPORT_URL = os.environ.get('KAYMBU_EXPORT_URL',
+                                   'http://export.kaymbu.com')
+
+
+# partial (and finished, until their email is done) media downloads, kept so
+# a retry only downloads the missing bytes
+MEDIA_DOWNLOAD_DIR = os.environ.get(
+    'MEDIA_DOWNLOAD_DIR', os.path.join(tempfile.gettempdir(), 'kaymbu-media'))
+# tries per media file, waiting a random time up to
+# MEDIA_RETRY_BASE_S * 2 ** try between them
+MEDIA_TRIES = 5
+MEDIA_RETRY_BASE_S = 0.5
+MEDIA_TIMEOUT_S = 60
+# bytes written at a time. A dropped connection can lose the chunk being read
+MEDIA_CHUNK_SIZE = 64 * 1024
+# extensions mimetypes gets wrong (.jpe) on older pythons
+_MEDIA_EXTENSIONS = {'image/jpeg': '.jpg'}
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_RE_ISO = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+                     r'(?:\.(\d{1,6}))?(?:([+-])(\d\d):(\d\d)|Z)?$')
+
+
+def get_logger():
+    return logging.getLogger("note_parse")
+
+
+class IncompleteDownload(Exception):
+    """
+    A media download ended early or did not match its checksum
+    """
+
+
+# media extensions (upper case) that are served as video
+VIDEO_EXTENSIONS = ['.MP4', '.MOV', '.M4V']
+
+
+def is_video(media_name: str) -> bool:
+    _, ext = os.path.splitext(media_name)
+    return ext.upper() in VIDEO_EXTENSIONS
+
+
+def poster_name(media_name: str) -> str:
+    """
+    Name of the still image (poster frame) stored for a video
+    """
+    base, _ = os.path.splitext(media_name)
+    return base + '.poster.jpg'
+
+
+def media_file_name(headers: Dict[str, str]) -> Optional[str]:
+    """
+    File name from a download's Content-Disposition header (quoted or
+    RFC 2231 encoded), else a name made from its Content-Type, else None
+    """
+    disposition = headers.get('Content-Disposition')
+    if disposition:
+        msg = email.message.Message()
+        msg['Content-Disposition'] = disposition
+        file_name = msg.get_filename()
+        if file_name:
+            # never a path
+            return os.path.basename(file_name.replace('\\', '/'))
+    content_type = headers.get('Content-Type', '').split(';')[0].strip()
+    ext = _MEDIA_EXTENSIONS.get(content_type) or \
+        mimetypes.guess_extension(content_type or 'unknown/unknown')
+    return 'media' + ext if ext else None
+
+
+def _expected_md5(headers: Dict[str, str]) -> Optional[str]:
+    """
+    Hex MD5 of the whole file from Content-MD5, or from an ETag that is an
+    MD5 (single part S3 uploads)
+    """
+    if 'Content-MD5' in headers:
+        return base64.b64decode(headers['Content-MD5']).hex()
+    etag = headers.get('ETag', '').strip('"')
+    if re.match('^[0-9a-f]{32}$', etag):
+        return etag
+    return None
+
+
+def _download_paths(media_id: str) -> Tuple[str, str]:
+    """
+    (partial file, progress file) of a media download
+    """
+    base = os.path.join(MEDIA_DOWNLOAD_DIR,
+                        re.sub('[^A-Za-z0-9_.-]', '_', media_id))
+    return base + '.part', base + '.json'
+
+
+def _load_progress(progress_path: str, url: str) -> Dict:
+    try:
+        with open(progress_path, 'r') as progress_file:
+            progress = json.load(progress_file)
+    except (OSError, ValueError):
+        return {'url': url}
+    return progress if progress.get('url') == url else {'url': url}
+
+
+def _save_progress(progress_path: str, progress: Dict) -> None:
+    with open(progress_path, 'w') as progress_file:
+        json.dump(progress, progress_file)
+
+
+def _file_md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as media_file:
+        for chunk in iter(lambda: media_file.read(MEDIA_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _download_attempt(url: str, part_path: str, progress: Dict,
+                      progress_path: str) -> None:
+    """
+    Get the rest of a media file, appending to the partial file
+
+    :raise IncompleteDownload: if the file is not complete afterwards
+    :raise ValueError: if the server refuses the download
+    """
+    have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if have and progress.get('length'):
+        if have == progress['length']:
+            return
+        headers['Range'] = 'bytes={}-'.format(have)
+        if progress.get('validator'):
+            # whole file if it changed since the partial download
+            headers['If-Range'] = progress['validator']
+    resp = requests.get(url, headers=headers, stream=True,
+                        timeout=MEDIA_TIMEOUT_S)
+    with resp:
+        if resp.status_code == 206:
+            content_range = re.match(r'bytes ([0-9]+)-[0-9]+/([0-9]+)',
+                                     resp.headers.get('Content-Range', ''))
+            if not content_range or int(content_range.group(1)) != have:
+                raise IncompleteDownload(
+                    'Bad Content-Range for {}: {}'.format(
+                        url, resp.headers.get('Content-Range')))
+            mode = 'ab'
+            length = int(content_range.group(2))
+        elif resp.status_code == 200:
+            mode, have = 'wb', 0
+            length = int(resp.headers['Content-Length']) \
+                if 'Content-Length' in resp.headers else None
+            progress.update(
+                file_name=media_file_name(resp.headers),
+                validator=resp.headers.get('ETag') or
+                resp.headers.get('Last-Modified'),
+                md5=_expected_md5(resp.headers)
+            )
+        elif resp.status_code == 416 or resp.status_code >= 500:
+            # 416: partial file is bad, start over
+            if resp.status_code == 416:
+                os.remove(part_path)
+            raise IncompleteDownload('HTTP {} for {}'.format(
+                resp.status_code, url))
+        else:
+            raise ValueError('Could not download media file {}: HTTP {}'
+                             .format(url, resp.status_code))
+        progress['length'] = length
+        _save_progress(progress_path, progress)
+
+        with open(part_path, mode) as part_file:
+            for chunk in resp.iter_content(MEDIA_CHUNK_SIZE):
+                part_file.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if length is not None and size != length:
+        raise IncompleteDownload('Got {} of {} bytes of {}'.format(
+            size, length, url))
+
+
+def download_media_file(url: str, media_id: str) -> Tuple[bytes,
+                                                           Optional[str]]:
+    """
+    Download a media file, resuming partial downloads with Range requests
+    and retrying failures with jittered exponential backoff. The size (and
+    MD5, if the server gives one) is checked before the file is returned
+
+    The downloaded file is kept in MEDIA_DOWNLOAD_DIR until
+    discard_media_file, so an email that fails part way does not download
+    its finished files again
+
+    :param url: media download url
+    :param media_id: Kaymbu media id, names the download
+    :return: file content and its name (see media_file_name)
+    :raise IncompleteDownload: if it did not download in MEDIA_TRIES tries
+    """
+    os.makedirs(MEDIA_DOWNLOAD_DIR, exist_ok=True)
+    part_path, progress_path = _download_paths(media_id)
+    progress = _load_progress(progress_path, url)
+    for attempt in range(MEDIA_TRIES):
+        try:
+            _download_attempt(url, part_path, progress, progress_path)
+            if progress.get('md5') and \
+                    _file_md5(part_path) != progress['md5']:
+                os.remove(part_path)
+                raise IncompleteDownload('Checksum mismatch for {}'.format(
+                    url))
+            break
+        except (requests.RequestException, IncompleteDownload) as e:
+            if attempt == MEDIA_TRIES - 1:
+                raise IncompleteDownload('Gave up on {} after {} tries: {}'
+                                         .format(url, MEDIA_TRIES, e)) from e
+            delay_s = random.uniform(0, MEDIA_RETRY_BASE_S * 2 ** attempt)
+            get_logger().warning('Retrying media {} in {:.1f} s: {}'.format(
+                media_id, delay_s, e))
+            metrics.emit('media_retry', delay_s * 1000)
+            time.sleep(delay_s)
+
+    with open(part_path, 'rb') as part_file:
+        return part_file.read(), progress.get('file_name')
+
+
+def discard_media_file(media_id: str) -> None:
+    """
+    Remove a finished download, see download_media_file
+    """
+    for path in _download_paths(media_id):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 
 def parse_gretchens_notes(email_payload: str
                           ) -> Tuple[List[Activity], List[Nap]]:
@@ -27,7 +275,8 @@ def parse_gretchens_notes(email_payload: str
     :param email_payload: string of HTML email
     :return: attributes
     """
-    print('start parsing email')
+    logger = get_logger()
+    logger.debug('start parsing email')
     # TODO: Find a clever way to detect time zone
     time_zone = pytz.timezone('US/Eastern')
 
@@ -44,7 +293,8 @@ def parse_gretchens_notes(email_payload: str
     date_re = re.search("class=\"heading-date\">(.*?)<",
                         payload)
     if date_re:
-        date_str = re.sub('(rd|st|th|nd)', '', date_re.group(1))
+        # drop ordinal suffixes (21st), but not the 'st' in August
+        date_str = re.sub('([0-9])(rd|st|th|nd)', '\\1', date_re.group(1))
         date_py = datetime.strptime(date_str, '%B %d, %Y')
         date = date_py.strftime('%Y-%m-%d')
     else:
@@ -62,7 +312,7 @@ def parse_gretchens_notes(email_payload: str
     activities = []
     for act_str in act_split[1:]:
         activity_name = re_begin.search(act_str).group(1)
-        print('ACTIVITY:', activity_name)
+        logger.debug('ACTIVITY: %s', activity_name)
 
         # remove out unwanted stuff
         act_str = re_begin.sub('', act_str)
@@ -83,14 +333,14 @@ def parse_gretchens_notes(email_payload: str
                 activity_time = _make_iso_time(py_time,
                                                date_py,
                                                time_zone)
-                print('Activity time:', activity_time)
+                logger.debug('Activity time: %s', activity_time)
                 # result
                 activity_result = re_result.search(act_sub).group(1)
-                print('Activity result:', activity_result)
+                logger.debug('Activity result: %s', activity_result)
                 activity_note_re = re_note.search(act_sub)
                 if activity_note_re:
                     activity_note = activity_note_re.group(1)
-                    print('Activity note:', activity_note)
+                    logger.debug('Activity note: %s', activity_note)
                 else:
                     activity_note = None
 
@@ -109,11 +359,11 @@ def parse_gretchens_notes(email_payload: str
             activity_time = None
             for act_sub in act_sub_split[1:]:
                 activity_result = re_begin.search(act_sub).group(1)
-                print('Note result:', activity_result)
+                logger.debug('Note result: %s', activity_result)
                 activity_note_re = re_note.search(act_sub)
                 if activity_note_re:
                     activity_note = activity_note_re.group(1)
-                    print('Note note:', activity_note)
+                    logger.debug('Note note: %s', activity_note)
                 else:
                     activity_note = None
                 activities.append(Activity(first_name=child_name,
@@ -123,7 +373,7 @@ def parse_gretchens_notes(email_payload: str
                                            result=activity_result,
                                            notes=activity_note))
 
-        print('---')
+        logger.debug('---')
 
     # parse naps
     re_nap = re.compile('([0-9]+:[0-9]+ (AM|PM)) - ([0-9]+:[0-9]+ (AM|PM))')
@@ -151,7 +401,20 @@ def parse_gretchens_notes(email_payload: str
     return activities, naps
 
 
-def parse_gretchens_picture(email: str) -> List[Tuple[bytes, Activity]]:
+def parse_gretchens_picture(
+        email: str,
+        known_media: Optional[Callable[[str], Optional[Tuple[str, str]]]]=None
+) -> List[Tuple[Optional[bytes], Activity]]:
+    """
+    Download the media of a picture email
+
+    :param email: string of HTML email
+    :param known_media: function(media id) -> (stored media name, original
+        file name) of media that is already stored, or None. Known media is
+        not downloaded again
+    :return: (content, activity) per media file. Content is None for known
+        media, whose activity has the stored name as its result
+    """
     payload = _remove_line_breaks(email)
     re_date = re.compile('class="date">(.*?)</td>')
     re_date_search = re_date.search(payload)
@@ -174,25 +437,26 @@ def parse_gretchens_picture(email: str) -> List[Tuple[bytes, Activity]]:
     download_search = re_download_link.search(payload)
     if download_search:
         download_url = download_search.group(1)
-        print('Found download link')
+        get_logger().debug('Found download link')
     else:
         raise ValueError("Could not find download link in picture email")
 
-    download_page = requests.get(download_url)
+    with timer('media_download'):
+        download_page = requests.get(download_url)
     if download_page.status_code != 200:
         raise ValueError('Could not access page at {}'.format(download_url))
     else:
-        print('Downloaded page {}'.format(download_url))
+        get_logger().info('Downloaded page {}'.format(download_url))
 
     # find media ids
     download_txt = download_page.text
     re_media = re.compile('<div data-type=".*" data-id="(.*?)"')
     media_search = re_media.search(download_txt)
-    base_url = "http://export.kaymbu.com/download/moments?{}"
+    base_url = KAYMBU_EXPORT_URL + "/download/moments?{}"
     if not media_search:
-        print('No media found, trying to find video instead')
-        re_str = '<a href="{}" class="download-btn">'
-        media_search = re.search(re_str.format(base_url.format('(.*)')),
+        get_logger().info('No media found, trying to find video instead')
+        re_str = '<a href="{}(.*)" class="download-btn">'
+        media_search = re.search(re_str.format(re.escape(base_url.format(''))),
                                  download_txt)
         if not media_search:
             raise ValueError('Unable to find media or video strings')
@@ -200,37 +464,37 @@ def parse_gretchens_picture(email: str) -> List[Tuple[bytes, Activity]]:
 
     # download
     out = []
-    for media_id in media_search.groups():
-        # video strings have this added in
-        media_id = media_id.replace('/?', '')
-        print('Downloading media ID {}'.format(media_id))
-        this_url = base_url.format(media_id)
-        media_resp = requests.get(this_url,
-                                  stream=True)
-        if media_resp.status_code != 200:
-            e_str = 'Could not download media file {}'
-            raise ValueError(e_str.format(this_url))
-        headers = media_resp.headers
-        media_name = None
-        if 'Content-Disposition' in headers:
-            content_split = headers['Content-Disposition'].split(';')
-            content_split = [x.strip() for x in content_split]
-            if content_split[0] == 'attachment':
-                if content_split[1].startswith('filename'):
-                    media_name = content_split[1][9:]
-        if not media_name:
-            print('No media name found in header: {}'.format(headers))
-
-        _, media_ext = os.path.splitext(media_name)
-        media_obj_name = media_id + media_ext
-        act_info = Activity(first_name=media_obj_name,
+    media_ids = [x.replace('/?', '') for x in media_search.groups()]
+    for media_id in media_ids:
+        known = known_media(media_id) if known_media else None
+        if known:
+            get_logger().info('Media ID {} is already stored as {}'.format(
+                media_id, known[0]))
+            media_content = None
+            media_obj_name, media_name = known
+        else:
+            get_logger().info('Downloading media ID {}'.format(media_id))
+            this_url = base_url.format(media_id)
+            with timer('media_download'):
+                media_content, media_name = download_media_file(this_url,
+                                                                media_id)
+            if not media_name:
+                get_logger().warning(
+                    'No media name found for media ID {}'.format(media_id))
+
+            _, media_ext = os.path.splitext(media_name or '')
+            media_obj_name = media_id + media_ext
+        act_info = Activity(first_name=FAMILY_WIDE,
                             date=date_raw.strftime('%Y-%m-%d'),
                             activity='Media',
                             datetime=date,
                             result=media_obj_name,
                             notes=media_name
                             )
-        out.append((media_resp.content, act_info))
+        out.append((media_content, act_info))
+    # every file is in memory now
+    for media_id in media_ids:
+        discard_media_file(media_id)
     return out
 
 
@@ -256,3 +520,32 @@ def _make_iso_time(time: datetime,
                                  month=date.month,
                                  day=date.day)
     return time_zone.localize(time_combined).isoformat()
+
+
+def parse_iso_time(iso_time: str) -> Tuple[int, int, int]:
+    """
+    (epoch seconds, microseconds, UTC offset in minutes) of an ISO 8601 time
+    like the ones made by _make_iso_time, e.g., 2018-09-21T08:30:00-04:00
+    """
+    match = _RE_ISO.match(iso_time)
+    if not match:
+        raise ValueError('Not an ISO 8601 time: {}'.format(iso_time))
+    year, month, day, hour, minute, second = \
+        [int(x) for x in match.group(1, 2, 3, 4, 5, 6)]
+    micros = int((match.group(7) or '0').ljust(6, '0'))
+    offset = 0
+    if match.group(8):
+        offset = int(match.group(9)) * 60 + int(match.group(10))
+        if match.group(8) == '-':
+            offset = -offset
+    local_s = timegm((year, month, day, hour, minute, second))
+    return local_s - offset * 60, micros, offset
+
+
+def format_iso_time(epoch_s: int, micros: int, offset: int) -> str:
+    """
+    Inverse of parse_iso_time
+    """
+    time_zone = timezone(timedelta(minutes=offset))
+    time = (_EPOCH + timedelta(seconds=epoch_s)).astimezone(time_zone)
+    return time.replace(microsecond=micros).isoformat()
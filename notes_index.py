@@ -0,0 +1,280 @@
+"""
+Full text search index over activity results and notes.
+
+Stored locally in SQLite (FTS5). Activities are added at ingest time when
+NOTES_INDEX_PATH is set, which is only useful for ingest running next to the
+dashboard (e.g., async_worker.py), not in Lambda. The index can be rebuilt
+from a bulk export made by dash_app/test/get_all_data.py, with the full text
+of long notes (see long_notes.py) read from the email bucket:
+
+    python notes_index.py --rebuild 2018-10-29-data.json
+    python notes_index.py please
+"""
+import argparse
+import html
+import json
+import os
+import re
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import boto3
+
+from long_notes import get_notes
+from note_parse import Activity
+
+# index updated at ingest only if this is set
+NOTES_INDEX_PATH = os.environ.get('NOTES_INDEX_PATH', '')
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'notes_index.sqlite3')
+
+# activities that have no text worth searching
+SKIP_ACTIVITIES = ['MEDIA', 'NAPTIMES']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    item_name TEXT UNIQUE NOT NULL,
+    family TEXT,
+    first_name TEXT,
+    date TEXT,
+    activity TEXT,
+    start_datetime TEXT,
+    result TEXT,
+    notes TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+    activity, result, notes,
+    content='items', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS items_ai AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts(rowid, activity, result, notes)
+    VALUES (new.id, new.activity, new.result, new.notes);
+END;
+CREATE TRIGGER IF NOT EXISTS items_ad AFTER DELETE ON items BEGIN
+    INSERT INTO items_fts(items_fts, rowid, activity, result, notes)
+    VALUES ('delete', old.id, old.activity, old.result, old.notes);
+END;
+CREATE TRIGGER IF NOT EXISTS items_au AFTER UPDATE ON items BEGIN
+    INSERT INTO items_fts(items_fts, rowid, activity, result, notes)
+    VALUES ('delete', old.id, old.activity, old.result, old.notes);
+    INSERT INTO items_fts(rowid, activity, result, notes)
+    VALUES (new.id, new.activity, new.result, new.notes);
+END;
+"""
+
+_UPSERT = """
+INSERT INTO items (item_name, family, first_name, date, activity,
+                   start_datetime, result, notes)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(item_name) DO UPDATE SET
+    family=excluded.family,
+    first_name=excluded.first_name,
+    date=excluded.date,
+    activity=excluded.activity,
+    start_datetime=excluded.start_datetime,
+    result=excluded.result,
+    notes=excluded.notes
+"""
+
+
+class IndexMissing(Exception):
+    """
+    There is no index file to open
+    """
+
+
+def open_index(path: str=None, create: bool=True) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the index
+
+    :param path: sqlite file, or ':memory:'. Defaults to NOTES_INDEX_PATH or
+        DEFAULT_INDEX_PATH
+    :param create: create a missing index, else raise IndexMissing
+    """
+    path = path or NOTES_INDEX_PATH or DEFAULT_INDEX_PATH
+    if not create and path != ':memory:' and not os.path.exists(path):
+        raise IndexMissing('No notes index at {}, make one with '
+                           '"python notes_index.py --rebuild"'.format(path))
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.executescript(_SCHEMA)
+    columns = [x[1] for x in conn.execute('PRAGMA table_info(items)')]
+    if 'family' not in columns:
+        # an index made before families were stored: item names start with
+        # the family (see lambda_function.activity_item_names)
+        with conn:
+            conn.execute('ALTER TABLE items ADD COLUMN family TEXT')
+            conn.execute("UPDATE items SET family = "
+                         "substr(item_name, 1, instr(item_name, '/') - 1)")
+    return conn
+
+
+def _unescape(text: str) -> str:
+    return html.unescape(text) if text else text
+
+
+def _upsert_rows(conn: sqlite3.Connection,
+                 rows: Iterable[Tuple]) -> int:
+    rows = [x for x in rows
+            if x[4] and x[4].upper() not in SKIP_ACTIVITIES]
+    with conn:
+        conn.executemany(_UPSERT, rows)
+    return len(rows)
+
+
+def index_activities(conn: sqlite3.Connection,
+                     named_activities: Iterable[Tuple[str, Activity]],
+                     replace_prefixes: Iterable[str]=(),
+                     family: str='') -> int:
+    """
+    Add or update parsed activities
+
+    :param conn: index connection
+    :param named_activities: (SimpleDB item name, activity) pairs
+    :param replace_prefixes: item name prefixes (e.g., a child and day) whose
+        items are all in named_activities: other items with them are deleted,
+        as reprocessing deletes them from SimpleDB
+    :param family: family of the email, '' for emails without one
+    :return: number of rows indexed
+    """
+    named_activities = list(named_activities)
+    names = set(x for x, _ in named_activities)
+    with conn:
+        for prefix in replace_prefixes:
+            stale = [x for x, in conn.execute(
+                'SELECT item_name FROM items '
+                'WHERE substr(item_name, 1, ?) = ?',
+                (len(prefix), prefix)) if x not in names]
+            conn.executemany('DELETE FROM items WHERE item_name = ?',
+                             [(x,) for x in stale])
+    return _upsert_rows(conn, (
+        (name, family, act.first_name, act.date, act.activity, act.datetime,
+         _unescape(act.result), _unescape(act.notes))
+        for name, act in named_activities
+    ))
+
+
+def index_items(conn: sqlite3.Connection, items: List[Dict],
+                notes: Optional[Dict[str, str]]=None) -> int:
+    """
+    Add or update SimpleDB items (as returned by select)
+
+    :param notes: full text of long notes by notes_key (see
+        long_notes.get_notes), indexed instead of their previews
+    :return: number of rows indexed
+    """
+    notes = notes or {}
+    re_date = re.compile('-([0-9]{4}-[0-9]{2}-[0-9]{2})-')
+    rows = []
+    for item in items:
+        atribs = {x['Name']: x['Value'] for x in item['Attributes']}
+        date_re = re_date.search(item['Name'])
+        rows.append((item['Name'],
+                     atribs.get('family', ''),
+                     atribs.get('first_name'),
+                     date_re.group(1) if date_re else None,
+                     atribs.get('activity'),
+                     atribs.get('start_datetime'),
+                     _unescape(atribs.get('result')),
+                     _unescape(notes.get(atribs.get('notes_key'),
+                                         atribs.get('notes')))))
+    return _upsert_rows(conn, rows)
+
+
+def note_keys(items: List[Dict]) -> List[str]:
+    """
+    notes_key of the items with long notes
+    """
+    return [y['Value'] for x in items for y in x['Attributes']
+            if y['Name'] == 'notes_key']
+
+
+def rebuild_index(conn: sqlite3.Connection, items: List[Dict],
+                  notes: Optional[Dict[str, str]]=None) -> int:
+    """
+    Replace the whole index with items from a bulk export
+
+    :param notes: see index_items
+    """
+    with conn:
+        conn.execute('DELETE FROM items')
+        conn.execute("INSERT INTO items_fts(items_fts) VALUES ('rebuild')")
+    n_rows = index_items(conn, items, notes)
+    with conn:
+        conn.execute("INSERT INTO items_fts(items_fts) VALUES ('optimize')")
+    return n_rows
+
+
+def _match_expression(query: str) -> str:
+    """
+    Turn free text into an FTS query (all words must match, last word may be
+    a prefix so results show up while typing)
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return ''
+    terms = ['"{}"'.format(x) for x in words[:-1]]
+    terms.append('"{}"*'.format(words[-1]))
+    return ' '.join(terms)
+
+
+def search(conn: sqlite3.Connection,
+           query: str,
+           limit: int=20,
+           first_name: Optional[str]=None,
+           family: str='') -> List[Dict]:
+    """
+    Ranked (bm25) search over activity, result and notes
+
+    :param conn: index connection
+    :param query: free text
+    :param limit: max number of hits
+    :param first_name: only this child's notes
+    :param family: only this family's notes, '' for all families
+    :return: hits, best first
+    """
+    match = _match_expression(query)
+    if not match:
+        return []
+    rows = conn.execute(
+        """
+        SELECT items.item_name, items.date, items.activity, items.result,
+               snippet(items_fts, 2, '', '', '...', 24),
+               bm25(items_fts)
+        FROM items_fts JOIN items ON items.id = items_fts.rowid
+        WHERE items_fts MATCH ? AND (? IS NULL OR items.first_name = ?)
+            AND (? = '' OR items.family = ?)
+        ORDER BY bm25(items_fts), items.date
+        LIMIT ?
+        """,
+        (match, first_name, first_name, family, family, limit)
+    ).fetchall()
+    cols = ['item_name', 'date', 'activity', 'result', 'snippet', 'score']
+    return [dict(zip(cols, x)) for x in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search activity notes')
+    parser.add_argument('query', nargs='*', help='Words to search for')
+    parser.add_argument('--index', help='Index file')
+    parser.add_argument('--family', default='',
+                        help='Only search this family\'s notes')
+    parser.add_argument('--rebuild', metavar='EXPORT_JSON',
+                        help='Rebuild index from a bulk export')
+    parser.add_argument('--bucket', default='gretchens-house-emails',
+                        help='Email bucket, where long notes are stored')
+    args = parser.parse_args()
+
+    index = open_index(args.index, create=bool(args.rebuild))
+    if args.rebuild:
+        with open(args.rebuild, 'r') as export_file:
+            export_items = json.load(export_file)['Items']
+        long_notes = get_notes(boto3.client('s3'), args.bucket,
+                               note_keys(export_items))
+        n_indexed = rebuild_index(index, export_items, long_notes)
+        print('Indexed {} items ({} long notes)'.format(n_indexed,
+                                                       len(long_notes)))
+    if args.query:
+        for hit in search(index, ' '.join(args.query),
+                          family=args.family.lower()):
+            print('{date} {activity}: {result} | {snippet}'.format(**hit))
@@ -0,0 +1,107 @@
+"""
+Parsed emails cached in S3 next to the raw emails.
+
+After an email is parsed, its activities and naps are written as compact
+JSON to parsed/<email key>.json in the same bucket, tagged with the parser
+version (note_parse.PARSER_VERSION) and the email's ETag. Reprocessing reads
+the cached result instead of decoding and parsing the email again. A cached
+result is ignored if the parser version changed, the email was replaced or
+the family addresses its family was resolved with changed (see
+lambda_function.family_version).
+"""
+import json
+from collections import namedtuple
+from typing import List, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from note_parse import PARSER_VERSION, Activity, Nap
+
+PARSED_PREFIX = 'parsed/'
+# kinds of email
+NOTES = 'notes'
+MEDIA = 'media'
+
+# family is the recipient of the email (see lambda_function.email_family)
+ParsedEmail = namedtuple('ParsedEmail', ['kind', 'activities', 'naps',
+                                         'family'])
+ParsedEmail.__new__.__defaults__ = ('',)
+
+
+def sidecar_key(key: str) -> str:
+    return '{}{}.json'.format(PARSED_PREFIX, key)
+
+
+def dumps_parsed(parsed: ParsedEmail, etag: str,
+                 families: str='') -> bytes:
+    """
+    :param families: version of the family addresses parsed.family was
+        resolved with
+    """
+    return json.dumps({
+        'parser_version': PARSER_VERSION,
+        'etag': etag,
+        'families': families,
+        'kind': parsed.kind,
+        'family': parsed.family,
+        # rows as lists, in namedtuple field order
+        'activities': [list(x) for x in parsed.activities],
+        'naps': [list(x) for x in parsed.naps]
+    }, separators=(',', ':')).encode('utf-8')
+
+
+def loads_parsed(data: bytes, etag: str,
+                 families: str='') -> Optional[ParsedEmail]:
+    """
+    :param families: see dumps_parsed
+    :return: None if the cached result is from another parser version,
+        another version of the email or other family addresses
+    """
+    cached = json.loads(data.decode('utf-8'))
+    if cached['parser_version'] != PARSER_VERSION or \
+            cached['etag'] != etag or cached.get('families', '') != families:
+        return None
+    return ParsedEmail(cached['kind'],
+                       [Activity(*x) for x in cached['activities']],
+                       [Nap(*x) for x in cached['naps']],
+                       cached['family'])
+
+
+def get_parsed(s3: boto3.client, bucket: str, key: str,
+               etag: Optional[str]=None,
+               families: str='') -> Optional[ParsedEmail]:
+    """
+    Cached parse of an email, if there is a current one
+
+    :param s3: S3 client
+    :param bucket: bucket of the email
+    :param key: key of the email
+    :param etag: ETag of the email, looked up if not given
+    :param families: see dumps_parsed
+    """
+    try:
+        if etag is None:
+            etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+        response = s3.get_object(Bucket=bucket, Key=sidecar_key(key))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return None
+        raise e
+    return loads_parsed(response['Body'].read(), etag, families)
+
+
+def put_parsed(s3: boto3.client, bucket: str, key: str, etag: str,
+               parsed: ParsedEmail, families: str='') -> None:
+    s3.put_object(Bucket=bucket, Key=sidecar_key(key),
+                  Body=dumps_parsed(parsed, etag, families),
+                  ContentType='application/json')
+
+
+def is_email_key(key: str) -> bool:
+    """
+    False for the objects this project writes next to the emails
+    """
+    return not any(key.startswith(x)
+                   for x in [PARSED_PREFIX, 'media/', 'media-index/',
+                             'media-manifest/', 'notes/'])
@@ -1,15 +1,27 @@
+"""
+Parse every Kaymbu email in a directory (or mbox, maildir, .gz or .zip
+archive, see ingest_archive.py) and update simpledb
+"""
+import argparse
 import logging
 import os
-import sys
 
-from lambda_function import lambda_parser
-from test import _load_email
+from ingest_archive import ingest_archive
+from profiling import profiled
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Parse a directory of emails and update simpledb"
+    )
+    parser.add_argument('input_dir',
+                        help='Directory of email files, or a mail archive')
+    parser.add_argument('--profile', metavar='DEST',
+                        help='Profile the run, writing stats to a directory '
+                             'or s3://bucket/prefix')
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
-    input_dir = sys.argv[1]
-    for file_path in os.listdir(input_dir):
-        logging.info('Parsing {}'.format(file_path))
-        full_path = os.path.join(input_dir, file_path)
-        payload = _load_email(full_path)
-        lambda_parser(payload, 'gretchens-house-emails')
+    input_dir = args.input_dir
+    with profiled(os.path.basename(os.path.abspath(input_dir)), args.profile):
+        counts = ingest_archive(input_dir, 'gretchens-house-emails')
+    logging.info('Done: {}'.format(counts))
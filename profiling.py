@@ -0,0 +1,220 @@
+"""
+Opt-in profiling of ingest runs.
+
+Set KAYMBU_PROFILE (or pass --profile to the command line tools) to a local
+directory or an s3://bucket/prefix. Each run then writes a cProfile stats file
+(.pstats) and the top memory allocations (.alloc.txt) there.
+
+cProfile only records the thread that enabled it, so functions run on thread
+pools are wrapped with thread_profiled, which profiles them in their worker
+thread and adds them to the run's stats.
+
+Summarize the hot functions across many captured profiles with:
+
+    python profiling.py report s3://gretchens-house-emails/profiles/
+"""
+import argparse
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import re
+import tempfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional
+
+import boto3
+
+PROFILE_DEST = os.environ.get('KAYMBU_PROFILE', '')
+# number of allocation sites kept per run
+TOP_ALLOCATIONS = 25
+
+
+def get_logger():
+    return logging.getLogger("profiling")
+
+
+class _ProfiledRun:
+    """
+    Profiles of the worker threads of the run being profiled
+    """
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profiles = []
+
+
+# set while profiled() runs
+_run = None
+
+
+def thread_profiled(func: Callable) -> Callable:
+    """
+    Wrap a function that runs on a thread pool, so a profiled run records it
+    too. Calls in the profiled thread itself, or outside a profiled run, are
+    not changed
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        run = _run
+        if run is None or threading.get_ident() == run.thread:
+            return func(*args, **kwargs)
+        profile = getattr(run.local, 'profile', None)
+        if profile is None:
+            profile = run.local.profile = cProfile.Profile()
+            with run.lock:
+                run.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # a Python whose profiler already records every thread
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+    return wrapper
+
+
+def _split_s3(dest: str):
+    bucket, _, prefix = dest[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def _write_output(dest: str, name: str, data: bytes) -> str:
+    if dest.startswith('s3://'):
+        bucket, prefix = _split_s3(dest)
+        key = '/'.join([x for x in [prefix.rstrip('/'), name] if x])
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+        return 's3://{}/{}'.format(bucket, key)
+    else:
+        os.makedirs(dest, exist_ok=True)
+        path = os.path.join(dest, name)
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+        return path
+
+
+@contextmanager
+def profiled(name: str, dest: Optional[str]=None) -> Iterator[None]:
+    """
+    Profile a block with cProfile and tracemalloc if profiling is enabled
+
+    :param name: run name used in the output file names (e.g., the email key)
+    :param dest: local directory or s3://bucket/prefix, defaults to
+        PROFILE_DEST. Profiling is off if both are empty
+    """
+    global _run
+    dest = dest or PROFILE_DEST
+    if not dest:
+        yield
+        return
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    run, previous_run = _ProfiledRun(), _run
+    _run = run
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _run = previous_run
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        # a profile that cannot be written must not fail the run (or hide
+        # its exception)
+        try:
+            run_name = '{}-{}'.format(
+                datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+                re.sub('[^A-Za-z0-9_.-]', '_', name)
+            )
+            stats = pstats.Stats(profile)
+            for thread_profile in run.profiles:
+                stats.add(thread_profile)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                stats_path = os.path.join(tmp_dir, 'stats')
+                stats.dump_stats(stats_path)
+                with open(stats_path, 'rb') as stats_file:
+                    out_path = _write_output(dest, run_name + '.pstats',
+                                             stats_file.read())
+
+            alloc_lines = [str(x) for x in
+                           snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+            _write_output(dest, run_name + '.alloc.txt',
+                          '\n'.join(alloc_lines).encode('utf-8'))
+        except Exception as e:
+            get_logger().error('Could not write profile to {}: {}'.format(
+                dest, e))
+        else:
+            get_logger().info('Wrote profile {}'.format(out_path))
+
+
+def _collect_stats_files(source: str, tmp_dir: str) -> List[str]:
+    """
+    Local paths of all .pstats files in a directory or s3 prefix
+    """
+    if not source.startswith('s3://'):
+        return [os.path.join(source, x) for x in sorted(os.listdir(source))
+                if x.endswith('.pstats')]
+
+    bucket, prefix = _split_s3(source)
+    s3 = boto3.client('s3')
+    paths = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.pstats'):
+                path = os.path.join(tmp_dir, os.path.basename(obj['Key']))
+                s3.download_file(bucket, obj['Key'], path)
+                paths.append(path)
+    return paths
+
+
+def report(source: str, sort: str='cumulative', top: int=30) -> str:
+    """
+    Hot functions summed over every profile in a directory or s3 prefix
+
+    :param source: local directory or s3://bucket/prefix
+    :param sort: pstats sort key, e.g., 'cumulative' or 'tottime'
+    :param top: number of functions to list
+    :return: report text
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = _collect_stats_files(source, tmp_dir)
+        if not paths:
+            return 'No profiles found in {}'.format(source)
+        out = io.StringIO()
+        stats = pstats.Stats(*paths, stream=out)
+        out.write('{} profiles from {}\n'.format(len(paths), source))
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+        return out.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profiling tools')
+    sub_parsers = parser.add_subparsers(dest='command')
+    report_parser = sub_parsers.add_parser(
+        'report', help='Summarize hot functions across captured profiles')
+    report_parser.add_argument('source',
+                               help='Directory or s3://bucket/prefix')
+    report_parser.add_argument('--sort', default='cumulative',
+                               help='pstats sort key (default cumulative)')
+    report_parser.add_argument('--top', type=int, default=30,
+                               help='Number of functions to show')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        print(report(args.source, args.sort, args.top))
+    else:
+        parser.print_help()
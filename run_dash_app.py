@@ -5,8 +5,10 @@ from dash_app.application import create_app
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--testing', action='store_true')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='Show a snapshot file (see dash_app/snapshot.py)')
     args = parser.parse_args()
 
     logging.basicConfig(level='INFO')
-    app = create_app(is_test=args.testing)
+    app = create_app(is_test=args.testing, snapshot_path=args.snapshot)
     app.run_server(debug=True)
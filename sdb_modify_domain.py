@@ -1,19 +1,442 @@
 from __future__ import print_function
 
 import argparse
+import os
+import re
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
 
 import boto3
+import pytz
+from botocore.exceptions import ClientError
+
+from note_parse import parse_iso_time
 
 SDB_DOMAIN = 'gretchens-notes-db'
 
+# period used to split items into domains: 'year', 'quarter', 'month', or
+# 'none' to keep everything in SDB_DOMAIN
+SDB_SHARD_PERIOD = os.environ.get('SDB_SHARD_PERIOD', 'year')
+SHARD_PERIODS = ['year', 'quarter', 'month', 'none']
+# also read SDB_DOMAIN, which held every item before sharding; turn off once
+# `--migrate-legacy` has moved its items into the shards
+SDB_READ_LEGACY = os.environ.get('SDB_READ_LEGACY', '1') == '1'
+
+# max parallel select requests when querying many shards
+SHARD_QUERY_WORKERS = 8
+
+# start time of an item as zero padded UTC epoch seconds, which compare (and
+# sort) as strings the way the times do, whatever their UTC offsets
+EPOCH_ATTRIBUTE = 'start_epoch'
+EPOCH_DIGITS = 12
+# time zone of the dates in item names and of dashboard weeks
+TIME_ZONE = 'US/Eastern'
+# max items per SimpleDB batch put
+BATCH_SIZE = 25
+# date in an item name, e.g., Emilia-2018-10-19-Meal-000
+_RE_NAME_DATE = re.compile(r'-(\d{4}-\d{2}-\d{2})-')
+
+
+def _shard_suffix(day: datetime, period: str) -> str:
+    if period == 'year':
+        return '{:04d}'.format(day.year)
+    elif period == 'quarter':
+        return '{:04d}q{:d}'.format(day.year, (day.month - 1) // 3 + 1)
+    elif period == 'month':
+        return '{:04d}-{:02d}'.format(day.year, day.month)
+    else:
+        raise ValueError('Unknown shard period "{}"'.format(period))
+
+
+def shard_domain(date: str, period: str=None) -> str:
+    """
+    Domain that holds items for a date
+
+    :param date: date string starting with YYYY-MM-DD (ISO times are fine)
+    :param period: shard period, defaults to SDB_SHARD_PERIOD
+    :return: domain name
+    """
+    period = period or SDB_SHARD_PERIOD
+    if period == 'none':
+        return SDB_DOMAIN
+    day = datetime.strptime(date[:10], '%Y-%m-%d')
+    return '-'.join([SDB_DOMAIN, _shard_suffix(day, period)])
+
+
+def shard_domains(start: str, end: str, period: str=None) -> List[str]:
+    """
+    All domains that overlap a (inclusive) date range, in date order
+
+    :param start: first date, YYYY-MM-DD
+    :param end: last date, YYYY-MM-DD
+    :param period: shard period, defaults to SDB_SHARD_PERIOD
+    :return: domain names
+    """
+    period = period or SDB_SHARD_PERIOD
+    if period == 'none':
+        return [SDB_DOMAIN]
+    day = datetime.strptime(start[:10], '%Y-%m-%d')
+    day_end = datetime.strptime(end[:10], '%Y-%m-%d')
+    if day_end < day:
+        return []
+
+    domains = []
+    # step a month at a time, which is the finest shard period
+    year, month = day.year, day.month
+    while (year, month) <= (day_end.year, day_end.month):
+        domain = shard_domain('{:04d}-{:02d}-01'.format(year, month), period)
+        if domain not in domains:
+            domains.append(domain)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return domains
+
+
+def read_domains(start: str, end: str, period: str=None) -> List[str]:
+    """
+    Domains to query for items in a (inclusive) date range: the shards of
+    shard_domains and, until it is migrated (see SDB_READ_LEGACY), the
+    legacy SDB_DOMAIN first
+    """
+    period = period or SDB_SHARD_PERIOD
+    domains = shard_domains(start, end, period)
+    if SDB_READ_LEGACY and domains and SDB_DOMAIN not in domains:
+        domains = [SDB_DOMAIN] + domains
+    return domains
+
+
+def is_no_such_domain(error: ClientError) -> bool:
+    return error.response.get('Error', {}).get('Code') == 'NoSuchDomain'
+
+
+def write_to_domain(sdb: boto3.client, domain: str, write: Callable):
+    """
+    Run a write to a domain, creating the domain if it does not exist yet
+    (shards are made by the first write of their period)
+
+    :param sdb: SimpleDB client
+    :param domain: domain written to
+    :param write: function() doing the write
+    :return: what write returns
+    """
+    try:
+        return write()
+    except ClientError as e:
+        if not is_no_such_domain(e):
+            raise e
+    # creating a domain that exists is a no-op, so racing writers are fine
+    sdb.create_domain(DomainName=domain)
+    return write()
+
+
+def sortable_epoch(iso_time: str) -> str:
+    """
+    EPOCH_ATTRIBUTE value of an ISO 8601 start time
+    """
+    epoch_s, _, _ = parse_iso_time(iso_time)
+    return str(epoch_s).zfill(EPOCH_DIGITS)
+
+
+def epoch_range(start: str, end: str,
+                time_zone: str=TIME_ZONE) -> Tuple[str, str]:
+    """
+    EPOCH_ATTRIBUTE bounds of the items dated start to end (YYYY-MM-DD, both
+    included, in a time zone): >= the first and < the second
+
+        where `start_epoch` >= "{}" and `start_epoch` < "{}"
+    """
+    zone = pytz.timezone(time_zone)
+    day = datetime.strptime(start[:10], '%Y-%m-%d')
+    day_after = datetime.strptime(end[:10], '%Y-%m-%d') + timedelta(days=1)
+    return tuple(str(timegm(zone.localize(x).utctimetuple())).zfill(
+        EPOCH_DIGITS) for x in [day, day_after])
+
+
+def list_shard_domains(sdb: boto3.client) -> List[str]:
+    """
+    Existing domains that belong to SDB_DOMAIN (including legacy SDB_DOMAIN)
+    """
+    domains = []
+    next_token = ''
+    while True:
+        response = sdb.list_domains(NextToken=next_token)
+        domains.extend(x for x in response.get('DomainNames', [])
+                       if x == SDB_DOMAIN or
+                       x.startswith(SDB_DOMAIN + '-'))
+        if 'NextToken' not in response:
+            break
+        next_token = response['NextToken']
+    return sorted(domains)
+
+
+def select_all(sdb: boto3.client, query: str,
+               consistent: bool=False) -> List[Dict]:
+    """
+    Run a select expression, following NextToken until all pages are read
+
+    :param consistent: read every write that completed before the select
+        (slower), instead of eventually consistent data
+
+    A domain that does not exist (e.g., a shard nothing was written to yet)
+    has no items
+    """
+    items = []
+    next_token = ''
+    while True:
+        try:
+            res = sdb.select(
+                SelectExpression=query,
+                NextToken=next_token,
+                ConsistentRead=consistent
+            )
+        except ClientError as e:
+            if is_no_such_domain(e):
+                return items
+            raise e
+        items.extend(res.get('Items', []))
+
+        if 'NextToken' not in res:
+            break
+        else:
+            next_token = res['NextToken']
+    return items
+
+
+def unique_items(items: List[Dict]) -> List[Dict]:
+    """
+    Items with one copy per item name, the last one, in order
+
+    An item of the legacy SDB_DOMAIN that was reprocessed before it was
+    migrated also has a copy in its shard. Listing the legacy domain first
+    (as read_domains and list_shard_domains do) keeps the shard copy.
+    """
+    last = {x['Name']: i for i, x in enumerate(items)}
+    return [x for i, x in enumerate(items) if last[x['Name']] == i]
+
+
+def select_shards(sdb: boto3.client,
+                  query_fmt: str,
+                  domains: List[str],
+                  consistent: bool=False) -> List[Dict]:
+    """
+    Run a select against several domains in parallel and merge the items
+
+    :param sdb: SimpleDB client
+    :param query_fmt: select expression with a `{domain}` placeholder
+    :param domains: domains to query, items are returned in this order
+    :param consistent: see select_all
+    :return: items from all domains, an item in several only from the last
+        (see unique_items)
+    """
+    if len(domains) == 1:
+        return select_all(sdb, query_fmt.format(domain=domains[0]),
+                          consistent)
+
+    workers = max(1, min(SHARD_QUERY_WORKERS, len(domains)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pages = pool.map(
+            lambda x: select_all(sdb, query_fmt.format(domain=x),
+                                 consistent),
+            domains
+        )
+        items = []
+        for page in pages:
+            items.extend(page)
+    return unique_items(items)
+
+
+def _reprocess_attributes() -> List[Dict]:
+    """
+    Ingest attributes of a rewrite, see lambda_function._ingest_attributes
+    """
+    return [
+        {'Name': 'ingest_datetime',
+         'Value': datetime.now(timezone.utc).isoformat(), 'Replace': True},
+        {'Name': 'ingest_mode', 'Value': 'reprocess', 'Replace': True}
+    ]
+
+
+def missing_epochs(sdb: boto3.client, domain: str) -> bool:
+    """
+    True if a domain has items with a start time but no EPOCH_ATTRIBUTE
+    (see backfill_epochs)
+    """
+    try:
+        res = sdb.select(
+            SelectExpression='select itemName() from `{}` where '
+                             '`start_datetime` is not null and `{}` is null '
+                             'limit 1'.format(domain, EPOCH_ATTRIBUTE),
+            ConsistentRead=True)
+    except ClientError as e:
+        if is_no_such_domain(e):
+            return False
+        raise e
+    # a page cut short without items may still have some after it
+    return bool(res.get('Items')) or 'NextToken' in res
+
+
+def backfill_epochs(sdb: boto3.client, domains: List[str]) -> int:
+    """
+    Add EPOCH_ATTRIBUTE to items written before ingest stored it
+
+    Items are marked as reprocessed, so dashboards re-query their weeks.
+
+    :return: number of items updated
+    """
+    ingest_attributes = _reprocess_attributes()
+    count = 0
+    for domain in domains:
+        items = select_all(
+            sdb, 'select start_datetime from `{}` where `start_datetime` is '
+                 'not null and `{}` is null'.format(domain, EPOCH_ATTRIBUTE))
+        puts = [{'Name': x['Name'], 'Attributes': [
+            {'Name': EPOCH_ATTRIBUTE, 'Replace': True,
+             'Value': sortable_epoch(x['Attributes'][0]['Value'])}
+        ] + ingest_attributes} for x in items]
+        for i in range(0, len(puts), BATCH_SIZE):
+            sdb.batch_put_attributes(DomainName=domain,
+                                     Items=puts[i:i + BATCH_SIZE])
+        count += len(puts)
+    return count
+
+
+def cleanup_media_items(sdb: boto3.client,
+                        domains: List[str]) -> Dict[str, int]:
+    """
+    Delete media items left under their names from before items had a
+    family
+
+    Those items have the media file name as first_name. Reprocessing their
+    email stores the media again under its family's name (with an empty
+    first_name), leaving the old item behind as a duplicate. Old items are
+    only deleted once their media (same file and date) has a current item,
+    which is marked reprocessed so dashboards re-query its week.
+
+    :return: numbers of deleted old items and of old items kept because
+        their email has not been reprocessed yet
+    """
+    counts = {'deleted': 0, 'kept': 0}
+    for domain in domains:
+        items = select_all(sdb, 'select first_name, result from `{}` where '
+                                '`activity` = "Media"'.format(domain))
+        current, old = {}, []
+        for item in items:
+            attributes = {x['Name']: x['Value']
+                          for x in item.get('Attributes', [])}
+            key = (attributes.get('result'), _item_date(item))
+            if attributes.get('first_name'):
+                old.append((item['Name'], key))
+            else:
+                current.setdefault(key, item['Name'])
+
+        deletes = [x for x, y in old if y in current]
+        touches = sorted(set(current[y] for _, y in old if y in current))
+        counts['deleted'] += len(deletes)
+        counts['kept'] += len(old) - len(deletes)
+        ingest_attributes = _reprocess_attributes()
+        for i in range(0, len(touches), BATCH_SIZE):
+            sdb.batch_put_attributes(DomainName=domain, Items=[
+                {'Name': x, 'Attributes': ingest_attributes}
+                for x in touches[i:i + BATCH_SIZE]])
+        for i in range(0, len(deletes), BATCH_SIZE):
+            sdb.batch_delete_attributes(DomainName=domain, Items=[
+                {'Name': x} for x in deletes[i:i + BATCH_SIZE]])
+    return counts
+
+
+def _item_date(item: Dict) -> Optional[str]:
+    """
+    YYYY-MM-DD date of a selected item, from its name or start_datetime
+    """
+    match = _RE_NAME_DATE.search(item['Name'])
+    if match:
+        return match.group(1)
+    for attribute in item.get('Attributes', []):
+        if attribute['Name'] == 'start_datetime':
+            return attribute['Value'][:10]
+    return None
+
+
+def _with_epoch(attributes: List[Dict]) -> List[Dict]:
+    """
+    Put attributes copying selected ones, adding EPOCH_ATTRIBUTE if missing
+    """
+    puts = [{'Name': x['Name'], 'Value': x['Value']} for x in attributes]
+    names = [x['Name'] for x in attributes]
+    if 'start_datetime' in names and EPOCH_ATTRIBUTE not in names:
+        start = attributes[names.index('start_datetime')]['Value']
+        puts.append({'Name': EPOCH_ATTRIBUTE, 'Value': sortable_epoch(start)})
+    return puts
+
+
+def migrate_legacy(sdb: boto3.client, period: str=None) -> int:
+    """
+    Move the items of the legacy SDB_DOMAIN into their shard domains
+
+    Items are copied with all their attributes (and EPOCH_ATTRIBUTE, which
+    the dashboard expects shards to have) before they are deleted from
+    SDB_DOMAIN, so an interrupted run can be repeated. Items without a date
+    stay in SDB_DOMAIN. Once it is empty, set SDB_READ_LEGACY=0 and delete
+    it.
+
+    :return: number of items moved
+    """
+    period = period or SDB_SHARD_PERIOD
+    if period == 'none':
+        return 0
+    shards = {}
+    for item in select_all(sdb, 'select * from `{}`'.format(SDB_DOMAIN)):
+        date = _item_date(item)
+        if date:
+            shards.setdefault(shard_domain(date, period), []).append(item)
+
+    count = 0
+    for domain, items in sorted(shards.items()):
+        for i in range(0, len(items), BATCH_SIZE):
+            batch = items[i:i + BATCH_SIZE]
+            puts = [{'Name': x['Name'],
+                     'Attributes': _with_epoch(x.get('Attributes', []))}
+                    for x in batch]
+            write_to_domain(sdb, domain, lambda: sdb.batch_put_attributes(
+                DomainName=domain, Items=puts))
+            sdb.batch_delete_attributes(
+                DomainName=SDB_DOMAIN,
+                Items=[{'Name': x['Name']} for x in batch])
+            count += len(batch)
+    return count
+
+
 def get_args():
     parser = argparse.ArgumentParser('Manipulating my SimpleDB domain')
     parser.add_argument('--create-domain', action='store_true',
                         help='Make domain "{}"'.format(SDB_DOMAIN))
     parser.add_argument('--delete-domain', action='store_true',
                         help='Delete (clear) domain "{}"'.format(SDB_DOMAIN))
+    parser.add_argument('--create-shards', nargs=2, metavar=('START', 'END'),
+                        help='Make all shard domains covering dates '
+                             'START to END (YYYY-MM-DD)')
+    parser.add_argument('--delete-shards', nargs=2, metavar=('START', 'END'),
+                        help='Delete all shard domains covering dates '
+                             'START to END (YYYY-MM-DD)')
+    parser.add_argument('--shard-period', choices=SHARD_PERIODS,
+                        default=SDB_SHARD_PERIOD,
+                        help='Shard period (default "{}")'.format(
+                            SDB_SHARD_PERIOD))
+    parser.add_argument('--list-shards', action='store_true',
+                        help='List existing shard domains')
+    parser.add_argument('--backfill-epochs', action='store_true',
+                        help='Add {} to items that do not have '
+                             'it'.format(EPOCH_ATTRIBUTE))
+    parser.add_argument('--cleanup-media', action='store_true',
+                        help='Delete media items that were stored again '
+                             'under their family\'s names')
+    parser.add_argument('--migrate-legacy', action='store_true',
+                        help='Move the items of "{}" into shard '
+                             'domains'.format(SDB_DOMAIN))
     return parser.parse_args()
 
+
 if __name__ == '__main__':
     args = get_args()
     sdb = boto3.client('sdb')
@@ -33,4 +456,38 @@ if __name__ == '__main__':
         response = sdb.create_domain(DomainName=SDB_DOMAIN)
         print('Creating domain "{}", response: {}'.format(SDB_DOMAIN,
                                                           response))
+
+    existing = list_shard_domains(sdb)
+    if args.delete_shards:
+        for domain in shard_domains(*args.delete_shards,
+                                    period=args.shard_period):
+            if domain in existing:
+                response = sdb.delete_domain(DomainName=domain)
+                print('Deleted domain "{}". reponse: {}'.format(domain,
+                                                                response))
+        existing = list_shard_domains(sdb)
+
+    if args.create_shards:
+        for domain in shard_domains(*args.create_shards,
+                                    period=args.shard_period):
+            if domain not in existing:
+                response = sdb.create_domain(DomainName=domain)
+                print('Creating domain "{}", response: {}'.format(domain,
+                                                                  response))
+        existing = list_shard_domains(sdb)
+
+    if args.migrate_legacy:
+        print('Moved {} items from "{}"'.format(
+            migrate_legacy(sdb, args.shard_period), SDB_DOMAIN))
+        existing = list_shard_domains(sdb)
+
+    if args.cleanup_media:
+        print('Media items: {}'.format(cleanup_media_items(sdb, existing)))
+
+    if args.list_shards:
+        for domain in existing:
+            print(domain)
+    if args.backfill_epochs:
+        print('Added {} to {} items'.format(EPOCH_ATTRIBUTE,
+                                            backfill_epochs(sdb, existing)))
     print('done')
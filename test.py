@@ -1,14 +1,89 @@
+import asyncio
 import email
+import gzip
+import io
 import json
+import os
+import shutil
+import sqlite3
 import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
-from unittest import TestCase
+from datetime import timedelta
+from unittest import TestCase, mock
 
 import boto3
+import dateutil.parser
 import pytz
 
-from lambda_function import lambda_handler, lambda_worker
-from note_parse import parse_gretchens_notes, parse_gretchens_picture
+import metrics
+import parse_cache
+from activity_batch import ActivityBatch
+from async_worker import run_worker, s3_event_records, sqs_source
+from ingest_archive import (
+    ingest_archive,
+    is_kaymbu_message,
+    iter_archive_messages
+)
+import profiling
+from local_fakes import (
+    FakeKaymbuServer,
+    FakeS3,
+    FakeSimpleDB,
+    FakeSQS,
+    installed_fakes,
+    make_note_email,
+    make_picture_email
+)
+
+from lambda_function import (
+    activity_item_names,
+    email_family,
+    family_addresses,
+    lambda_handler,
+    lambda_worker,
+    put_sdb_activities,
+    reconcile_sdb_activities
+)
+from lambda_one_email import RateLimiter, list_keys, reprocess_keys
+from media_manifest import add_to_manifest, get_manifest, media_entry
+import long_notes
+import note_parse
+import notes_index
+from note_parse import (
+    Activity,
+    download_media_file,
+    format_iso_time,
+    is_video,
+    media_file_name,
+    parse_gretchens_notes,
+    parse_gretchens_picture,
+    parse_iso_time,
+    poster_name
+)
+from notes_index import (
+    IndexMissing,
+    index_activities,
+    open_index,
+    rebuild_index,
+    search
+)
+from sdb_modify_domain import (
+    SDB_DOMAIN,
+    backfill_epochs,
+    cleanup_media_items,
+    epoch_range,
+    migrate_legacy,
+    read_domains,
+    select_all,
+    shard_domain,
+    shard_domains,
+    sortable_epoch
+)
 
 
 def _load_email(test_path: str) -> str:
@@ -77,6 +152,46 @@ class TestNoteParse(TestCase):
                           'Thank you!=20  '),
                          activities[0])
 
+    def test_activity_batch(self):
+        activities, _ = parse_gretchens_notes(_load_email('test_message'))
+        activities += [
+            Activity('abc123.jpg', '2018-09-21', 'Media',
+                     '2018-09-21T17:02:03.250000-04:00', 'abc123.jpg',
+                     'IMG_1.jpg'),
+            Activity('Emilia', '2018-09-22', 'Activity', None, 'Art', None)
+        ]
+        batch = ActivityBatch.from_activities(activities)
+        self.assertEqual(len(activities), len(batch))
+        self.assertEqual(activities, list(batch))
+        self.assertEqual(activities[-1], batch[-1])
+        self.assertEqual(activity_item_names(activities),
+                         activity_item_names(batch))
+        self.assertEqual(['Emilia', 'abc123.jpg'], batch.first_names)
+        self.assertEqual((1537563600, 0, 0),
+                         parse_iso_time('2018-09-21T21:00:00Z'))
+        self.assertEqual('2018-09-21T21:00:00+00:00',
+                         format_iso_time(1537563600, 0, 0))
+
+        columns = batch.to_numpy()
+        self.assertEqual(len(batch), len(columns['epoch_s']))
+        with self.assertRaises(BufferError):
+            batch.append(activities[0])
+        del columns
+
+        frame = batch.to_pandas('US/Eastern')
+        self.assertEqual(['Meal', 'Media'],
+                         list(frame['activity'].iloc[[0, -2]]))
+        self.assertEqual(8, frame['datetime'].iloc[0].hour)
+        self.assertTrue(frame['datetime'].isnull().iloc[-1])
+        self.assertEqual('2018-09-22',
+                         frame['date'].iloc[-1].strftime('%Y-%m-%d'))
+
+    def test_video_names(self):
+        self.assertTrue(is_video('5bca27da361b5d0014939f80.mp4'))
+        self.assertFalse(is_video('5bca27da361b5d0014939f80.jpg'))
+        self.assertEqual('5bca27da361b5d0014939f80.poster.jpg',
+                         poster_name('5bca27da361b5d0014939f80.MP4'))
+
     def test_lambda_function(self):
         """
         Test local run of lambda function.
@@ -136,10 +251,869 @@ class TestNoteParse(TestCase):
 
         # check it is in simpledb
         sdb = boto3.client('sdb')
-        query_str = 'select * from `gretchens-notes-db` where ' + \
+        query_str = 'select * from `{}` where ' + \
                     'activity = "Media" and result = "{}"'
         res = sdb.select(
-            SelectExpression=query_str.format(out_file)
+            SelectExpression=query_str.format(
+                shard_domain(activities[0].date), out_file)
         )
         self.assertTrue('Items' in res)
         self.assertEqual(1, len(res['Items']))
+
+
+class TestShards(TestCase):
+    def test_shard_domain(self):
+        self.assertEqual('gretchens-notes-db-2018',
+                         shard_domain('2018-09-21T08:30:00-04:00', 'year'))
+        self.assertEqual('gretchens-notes-db-2018q3',
+                         shard_domain('2018-09-21', 'quarter'))
+        self.assertEqual('gretchens-notes-db-2018-09',
+                         shard_domain('2018-09-21', 'month'))
+        self.assertEqual('gretchens-notes-db',
+                         shard_domain('2018-09-21', 'none'))
+
+    def test_shard_domains(self):
+        # week spanning new years only touches two year shards
+        self.assertEqual(['gretchens-notes-db-2018',
+                          'gretchens-notes-db-2019'],
+                         shard_domains('2018-12-31', '2019-01-06', 'year'))
+        self.assertEqual(['gretchens-notes-db-2018q4'],
+                         shard_domains('2018-10-01', '2018-12-31',
+                                       'quarter'))
+        self.assertEqual(['gretchens-notes-db-2018-09',
+                          'gretchens-notes-db-2018-10'],
+                         shard_domains('2018-09-30', '2018-10-06', 'month'))
+        self.assertEqual([], shard_domains('2018-10-06', '2018-10-01'))
+
+    def test_epochs(self):
+        self.assertEqual('001537533000',
+                         sortable_epoch('2018-09-21T08:30:00-04:00'))
+        # the second is later, though its string sorts first (clocks went
+        # back an hour)
+        self.assertLess(sortable_epoch('2018-11-04T01:30:00-04:00'),
+                        sortable_epoch('2018-11-04T01:10:00-05:00'))
+        # midnight to midnight Eastern, a week with a DST change
+        self.assertEqual((sortable_epoch('2018-10-29T00:00:00-04:00'),
+                          sortable_epoch('2018-11-05T00:00:00-05:00')),
+                         epoch_range('2018-10-29', '2018-11-04'))
+
+
+class TestNotesIndex(TestCase):
+    def setUp(self):
+        activities, _ = parse_gretchens_notes(_load_email('test_message'))
+        self.index = open_index(':memory:')
+        index_activities(self.index, zip(activity_item_names(activities),
+                                         activities))
+
+    def test_search(self):
+        hits = search(self.index, 'please')
+        self.assertEqual(1, len(hits))
+        self.assertEqual('Emilia-2018-09-21-Activity-000',
+                         hits[0]['item_name'])
+        self.assertEqual('2018-09-21', hits[0]['date'])
+        # html entities are unescaped, prefix of last word matches
+        self.assertIn('"please"', hits[0]['snippet'])
+        self.assertEqual(1, len(search(self.index, 'pink pap')))
+        self.assertEqual([], search(self.index, 'pink elephant'))
+        self.assertEqual([], search(self.index, '  '))
+
+    def test_reindex(self):
+        # indexing the same email again does not duplicate hits
+        activities, _ = parse_gretchens_notes(_load_email('test_message'))
+        index_activities(self.index, zip(activity_item_names(activities),
+                                         activities))
+        self.assertEqual(1, len(search(self.index, 'markers')))
+
+        # a reprocessed email without the activity
+        others = [x for x in activities if 'markers' not in (x.notes or '')]
+        index_activities(self.index,
+                         zip(activity_item_names(others), others),
+                         ['Emilia-2018-09-21-'])
+        self.assertEqual([], search(self.index, 'markers'))
+        self.assertEqual(1, len(search(self.index, 'breakfast')))
+
+        rebuild_index(self.index, [{
+            'Name': 'Emilia-2018-10-01-Activity-000',
+            'Attributes': [{'Name': 'activity', 'Value': 'Activity'},
+                           {'Name': 'result', 'Value': 'Music'},
+                           {'Name': 'notes', 'Value': 'Sang songs...'},
+                           {'Name': 'notes_key', 'Value': 'notes/abc'}]
+        }], {'notes/abc': 'Sang songs and played drums'})
+        self.assertEqual([], search(self.index, 'breakfast'))
+        hits = search(self.index, 'drums')
+        self.assertEqual('2018-10-01', hits[0]['date'])
+
+        with self.assertRaises(IndexMissing):
+            open_index(os.path.join(tempfile.mkdtemp(), 'index.sqlite3'),
+                       create=False)
+
+    def test_family(self):
+        activities, _ = parse_gretchens_notes(_load_email('test_message'))
+        for family in ['parents@a.example', 'parents@b.example']:
+            index_activities(
+                self.index,
+                zip(activity_item_names(activities, family), activities),
+                family=family)
+        self.assertEqual(3, len(search(self.index, 'please')))
+        hits = search(self.index, 'please', family='parents@b.example')
+        self.assertEqual(['parents@b.example/Emilia-2018-09-21-Activity-000'],
+                         [x['item_name'] for x in hits])
+        self.assertEqual([], search(self.index, 'please',
+                                    family='parents@c.example'))
+
+        # an index made before families were stored gets them from the names
+        path = os.path.join(tempfile.mkdtemp(), 'index.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        conn = sqlite3.connect(path)
+        conn.executescript(notes_index._SCHEMA.replace('family TEXT,', ''))
+        with conn:
+            conn.executemany(
+                'INSERT INTO items (item_name, activity, notes) '
+                'VALUES (?, "Meal", "Ate it all")',
+                [('parents@a.example/Emilia-2018-09-21-Meal-000',),
+                 ('Emilia-2018-09-21-Meal-000',)])
+        conn.close()
+        conn = open_index(path)
+        self.assertEqual(
+            [('', 'Emilia-2018-09-21-Meal-000'),
+             ('parents@a.example',
+              'parents@a.example/Emilia-2018-09-21-Meal-000')],
+            conn.execute('SELECT family, item_name FROM items '
+                         'ORDER BY family').fetchall())
+        self.assertEqual(1, len(search(conn, 'ate',
+                                       family='parents@a.example')))
+        conn.close()
+
+
+class TestMetrics(TestCase):
+    def test_timer_summary(self):
+        sink_dir = tempfile.mkdtemp()
+        sink_path = os.path.join(sink_dir, 'metrics.jsonl')
+        old_sink = metrics.METRICS_SINK
+        metrics.METRICS_SINK = sink_path
+        try:
+            for _ in range(3):
+                with metrics.timer('parse'):
+                    pass
+            metrics.emit('sdb_write', 100.0, 8)
+        finally:
+            metrics.METRICS_SINK = old_sink
+
+        with open(sink_path, 'r') as sink:
+            lines = sink.readlines()
+        self.assertEqual(4, len(lines))
+        record = json.loads(lines[-1])
+        self.assertEqual('KaymbuParsing',
+                         record['_aws']['CloudWatchMetrics'][0]['Namespace'])
+        self.assertEqual(8, record['Count'])
+
+        summary = metrics.summarize(lines + ['START RequestId: 1234'])
+        self.assertEqual(3, summary['parse']['n'])
+        self.assertEqual(100.0, summary['sdb_write']['p99'])
+
+
+class TestProfiling(TestCase):
+    def test_profile_report(self):
+        out_dir = tempfile.mkdtemp()
+        payload = _load_email('test_message')
+        for i in range(2):
+            with profiling.profiled('test/message {}'.format(i), out_dir):
+                parse_gretchens_notes(payload)
+        # off unless a destination is given
+        with profiling.profiled('not-written'):
+            pass
+
+        files = sorted(os.listdir(out_dir))
+        self.assertEqual(4, len(files))
+        self.assertEqual(2, len([x for x in files if x.endswith('.pstats')]))
+        self.assertIn('test_message_0', files[0])
+
+        report = profiling.report(out_dir, top=5)
+        self.assertIn('2 profiles', report)
+        self.assertIn('parse_gretchens_notes', report)
+
+    def test_profile_threads(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        payload = _load_email('test_message')
+        with profiling.profiled('threads', out_dir):
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(
+                    profiling.thread_profiled(parse_gretchens_notes),
+                    [payload] * 2))
+        # parsed only on the worker threads
+        report = profiling.report(out_dir, top=50)
+        self.assertIn('parse_gretchens_notes', report)
+
+    def test_profile_write_error(self):
+        # a file where the output directory should be
+        with tempfile.NamedTemporaryFile() as not_dir:
+            with self.assertLogs('profiling', 'ERROR'):
+                with profiling.profiled('message', not_dir.name):
+                    pass
+            # the block's own exception is not replaced
+            with self.assertLogs('profiling', 'ERROR'), \
+                    self.assertRaises(ValueError):
+                with profiling.profiled('message', not_dir.name):
+                    raise ValueError('parse failed')
+
+
+class TestOffline(TestCase):
+    """
+    End to end runs against the in-memory fakes
+    """
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.sdb = FakeSimpleDB(page_size=3)
+        for domain in shard_domains('2018-01-01', '2018-12-31'):
+            self.sdb.create_domain(DomainName=domain)
+        self.bucket = 'gretchens-house-emails'
+
+    def test_select(self):
+        domain = shard_domain('2018-10-01')
+        self.sdb.batch_put_attributes(DomainName=domain, Items=[
+            {'Name': 'item-{}'.format(i),
+             'Attributes': [{'Name': 'n', 'Value': str(i)},
+                            {'Name': 'activity',
+                             'Value': 'Meal' if i % 2 else 'Nap'}]}
+            for i in range(8)
+        ])
+        query = 'select n from `{}` where activity = "Meal" and ' \
+                '(`n` >= "3" or itemName() = "item-1") order by n desc'
+        res = self.sdb.select(SelectExpression=query.format(domain))
+        self.assertEqual(['item-7', 'item-5', 'item-3'],
+                         [x['Name'] for x in res['Items']])
+        res = self.sdb.select(SelectExpression=query.format(domain),
+                              NextToken=res['NextToken'])
+        self.assertEqual(['item-1'], [x['Name'] for x in res['Items']])
+        self.assertNotIn('NextToken', res)
+
+        res = self.sdb.select(SelectExpression='select count(*) from `{}` '
+                              'where n like "1%"'.format(domain))
+        self.assertEqual('1', res['Items'][0]['Attributes'][0]['Value'])
+
+    def test_note_worker(self):
+        payload = _load_email('test_message')
+        self.s3.put_object(Bucket=self.bucket, Key='note',
+                           Body=make_note_email(payload,
+                                                dt(2018, 8, 1)))
+        with installed_fakes(self.s3, self.sdb):
+            activities, naps = lambda_worker(self.bucket, 'note')
+            from dash_app.get_data import get_week_data
+            week = get_week_data('2018-08-01')
+        self.assertEqual('2018-08-01', activities[0].date)
+        self.assertEqual(len(activities) + len(naps), len(week['Items']))
+
+    def test_long_notes(self):
+        payload = _load_email('test_message')
+        self.s3.put_object(Bucket=self.bucket, Key='note',
+                           Body=make_note_email(payload, dt(2018, 8, 1)))
+        with installed_fakes(self.s3, self.sdb), \
+                mock.patch.object(long_notes, 'NOTES_INLINE_BYTES', 100), \
+                mock.patch.object(long_notes, 'PREVIEW_CHARS', 40):
+            activities, _ = lambda_worker(self.bucket, 'note')
+            text = activities[6].notes
+            self.assertGreater(len(text), 100)
+            item = select_all(self.sdb, 'select * from `{}` where activity = '
+                              '"Activity"'.format(shard_domain('2018-08-01')))
+            attributes = {x['Name']: x['Value']
+                          for x in item[0]['Attributes']}
+            self.assertEqual('Mia and Emilia used markers together...',
+                             attributes['notes'])
+            obj = self.s3.get_object(Bucket=self.bucket,
+                                     Key=attributes['notes_key'])
+            self.assertEqual(text, gzip.decompress(
+                obj['Body'].read()).decode('utf-8'))
+
+            # a reprocess stores the same key, so nothing changes
+            lambda_worker(self.bucket, 'note', reprocess=True)
+            item = select_all(self.sdb, 'select ingest_mode from `{}` where '
+                              'activity = "Activity"'.format(
+                                  shard_domain('2018-08-01')))
+            self.assertEqual('new', item[0]['Attributes'][0]['Value'])
+
+            from dash_app.get_data import expand_notes, get_week_data
+            week = get_week_data('2018-08-01')
+            self.assertEqual([text],
+                             [y['Value'] for x in expand_notes(week['Items'])
+                              for y in x['Attributes'] if y['Name'] == 'notes'])
+
+    def test_week_range(self):
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        # the notes are from a Friday, add a Sunday evening
+        sunday = activities[0]._replace(date='2018-09-23',
+                                        datetime='2018-09-23T19:30:00-04:00')
+        put_sdb_activities(self.sdb, activities + [sunday], naps)
+        domain = shard_domain('2018-09-21')
+        # written before start_epoch was
+        self.sdb.put_attributes(DomainName=domain, ItemName='old', Attributes=[
+            {'Name': 'first_name', 'Value': 'Emilia'},
+            {'Name': 'activity', 'Value': 'Diaper'},
+            {'Name': 'start_datetime', 'Value': '2018-09-19T07:00:00-04:00'}])
+
+        with installed_fakes(self.s3, self.sdb):
+            from dash_app.get_data import get_week_data
+            week = get_week_data('2018-09-21')
+            # found by its start_datetime until it is backfilled
+            self.assertEqual(len(activities) + len(naps) + 2,
+                             len(week['Items']))
+            self.assertEqual(['old', 'Emilia-2018-09-23-Meal-000'],
+                             [week['Items'][0]['Name'],
+                              week['Items'][-1]['Name']])
+
+            self.assertEqual(1, backfill_epochs(self.sdb, [domain]))
+            self.assertEqual(0, backfill_epochs(self.sdb, [domain]))
+            week = get_week_data('2018-09-21', week)
+        self.assertEqual(len(activities) + len(naps) + 2, len(week['Items']))
+        self.assertEqual(1, len([x for x in week['Items']
+                                 if x['Name'] == 'old']))
+
+    def test_picture_worker(self):
+        with FakeKaymbuServer() as kaymbu, \
+                installed_fakes(self.s3, self.sdb, kaymbu.url):
+            url = kaymbu.add_media('page1', 'abc123', 'IMG_1.jpg', b'jpeg')
+            self.s3.put_object(Bucket=self.bucket, Key='picture',
+                               Body=make_picture_email(url,
+                                                       dt(2018, 10, 19)))
+            activities, _ = lambda_worker(self.bucket, 'picture')
+
+        self.assertEqual('abc123.jpg', activities[0].result)
+        obj = self.s3.get_object(Bucket=self.bucket, Key='media/abc123.jpg')
+        self.assertEqual(b'jpeg', obj['Body'].read())
+        self.assertEqual('image/jpeg', obj['ContentType'])
+        res = self.sdb.select(SelectExpression='select * from `{}` where '
+                              'activity = "Media"'.format(
+                                  shard_domain('2018-10-19')))
+        self.assertEqual(1, len(res['Items']))
+
+    def test_media_dedup(self):
+        with FakeKaymbuServer() as kaymbu, \
+                installed_fakes(self.s3, self.sdb, kaymbu.url):
+            # the same photo sent again the next day, with a new media id
+            url1 = kaymbu.add_media('page1', 'abc123', 'IMG_1.jpg', b'jpeg')
+            url2 = kaymbu.add_media('page2', 'def456', 'IMG_1.jpg', b'jpeg')
+            for key, url, day in [('picture1', url1, 19),
+                                  ('picture2', url2, 20)]:
+                self.s3.put_object(Bucket=self.bucket, Key=key,
+                                   Body=make_picture_email(url,
+                                                           dt(2018, 10, day)))
+                activities, _ = lambda_worker(self.bucket, key)
+                self.assertEqual('abc123.jpg', activities[0].result)
+            self.assertEqual(['media/abc123.jpg'],
+                             [key for bucket, key in self.s3._objects
+                              if key.startswith('media/')])
+
+            # a media id that is stored is not downloaded again
+            downloads = len(kaymbu.requests)
+            lambda_worker(self.bucket, 'picture1')
+            self.assertEqual(['/export/page1'], kaymbu.requests[downloads:])
+
+            from dash_app.get_data import get_media_keys, get_week_data
+            week = get_week_data('2018-10-19')
+        self.assertEqual(2, len(week['Items']))
+        self.assertEqual(['abc123.jpg'], get_media_keys(week))
+
+    def test_media_manifest(self):
+        from PIL import Image
+        # 40x20, with an EXIF orientation of 6 (shown rotated a quarter turn)
+        exif = b'Exif\0\0MM\0\x2a\0\0\0\x08\0\x01' \
+            b'\x01\x12\0\x03\0\0\0\x01\0\x06\0\0\0\0\0\0'
+        jpeg = io.BytesIO()
+        Image.new('RGB', (40, 20)).save(jpeg, format='JPEG', exif=exif)
+        family = 'parents@a.example'
+        with FakeKaymbuServer() as kaymbu, \
+                installed_fakes(self.s3, self.sdb, kaymbu.url):
+            url = kaymbu.add_media('page1', 'abc123', 'IMG_1.jpg',
+                                   jpeg.getvalue())
+            self.s3.put_object(Bucket=self.bucket, Key='picture',
+                               Body=make_picture_email(url, dt(2018, 10, 19),
+                                                       family))
+            lambda_worker(self.bucket, 'picture')
+            # listed once, however often it is processed
+            lambda_worker(self.bucket, 'picture')
+
+            from dash_app.application import manifest_media
+            from dash_app.get_data import get_media_manifest
+            manifest = get_media_manifest(family, '2018-10-15')
+        self.assertEqual('2018-10-15', manifest['week_start'])
+        self.assertEqual(1, len(manifest['media']))
+        entry = manifest['media'][0]
+        self.assertEqual(('abc123.jpg', 'image/jpeg', len(jpeg.getvalue()),
+                          20, 40),
+                         tuple(entry[x] for x in ['media_name', 'content_type',
+                                                  'size', 'width', 'height']))
+        self.assertEqual('2018-10-19', entry['captured'][:10])
+        img = manifest_media(entry, 700)
+        self.assertEqual(('/media/abc123.jpg', '1400'), (img.src, img.height))
+
+        # concurrent writers do not drop each other's entries
+        s3 = FakeS3(latency_s=0.005)
+        threads = [threading.Thread(target=add_to_manifest, args=(
+            s3, self.bucket, family, '2018-10-17', name,
+            lambda x=name: media_entry(x, None, 1)))
+            for name in ['{}.mp4'.format(i) for i in range(6)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # one GET of the compacted manifest
+        with mock.patch.object(s3, 'list_objects_v2',
+                               side_effect=AssertionError('listed')):
+            manifest = get_manifest(s3, self.bucket, family, '2018-10-21')
+        self.assertIsNone(get_manifest(s3, self.bucket, family, '2018-10-01'))
+        self.assertEqual(['{}.mp4'.format(i) for i in range(6)],
+                         [x['media_name'] for x in manifest['media']])
+        self.assertEqual('video/mp4', manifest['media'][0]['content_type'])
+
+    def test_reconcile(self):
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        put_sdb_activities(self.sdb, activities, naps)
+        domain = shard_domain(activities[0].date)
+        before = dict(self.sdb.calls)
+
+        meals = [x for x in activities if x.activity == 'Meal']
+        others = [x for x in activities if x.activity != 'Meal']
+        # one meal fewer, one changed
+        fixed = others + [meals[0]._replace(result='Ate it all')] + \
+            meals[1:-1]
+        counts = reconcile_sdb_activities(self.sdb, fixed, naps)
+        self.assertEqual({'unchanged': len(fixed) + len(naps) - 1, 'put': 1,
+                          'deleted': 1}, counts)
+        calls = {x: y - before.get(x, 0) for x, y in self.sdb.calls.items()}
+        # one select (paged), one batch of each
+        self.assertEqual({'Select', 'BatchPutAttributes',
+                          'BatchDeleteAttributes'},
+                         {x for x, y in calls.items() if y})
+        self.assertEqual(1, calls['BatchPutAttributes'])
+        self.assertEqual(1, calls['BatchDeleteAttributes'])
+
+        stored = {x['Name']: x for x in select_all(
+            self.sdb, 'select * from `{}`'.format(domain))}
+        self.assertEqual(len(fixed) + len(naps), len(stored))
+        self.assertEqual(sorted(activity_item_names(fixed) + [
+            'Emilia-2018-09-21-NapTimes-000']), sorted(stored))
+        self.assertEqual(
+            {'result': 'Ate it all', 'ingest_mode': 'reprocess'},
+            {x['Name']: x['Value'] for x in stored[
+                'Emilia-2018-09-21-Meal-000']['Attributes']
+             if x['Name'] in ['result', 'ingest_mode']})
+
+        # nothing changed, nothing written
+        before = dict(self.sdb.calls)
+        counts = reconcile_sdb_activities(self.sdb, fixed, naps)
+        self.assertEqual(0, counts['put'] + counts['deleted'])
+        self.assertEqual(before['BatchPutAttributes'],
+                         self.sdb.calls['BatchPutAttributes'])
+
+    def test_shard_on_first_write(self):
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        sdb = FakeSimpleDB()
+        domain = shard_domain(activities[0].date)
+        # missing shards read as empty and are made by the first write
+        self.assertEqual([], select_all(
+            sdb, 'select * from `{}`'.format(domain)))
+        put_sdb_activities(sdb, activities, naps)
+        self.assertEqual(len(activities) + len(naps), len(select_all(
+            sdb, 'select * from `{}`'.format(domain))))
+
+        # items from before sharding are read until they are migrated
+        self.assertEqual([SDB_DOMAIN, domain],
+                         read_domains('2018-09-17', '2018-09-23'))
+        sdb.create_domain(DomainName=SDB_DOMAIN)
+        sdb.put_attributes(DomainName=SDB_DOMAIN,
+                           ItemName='Emilia-2017-05-01-Meal-000',
+                           Attributes=[{'Name': 'result', 'Value': 'All'}])
+        self.assertEqual(1, migrate_legacy(sdb, 'year'))
+        self.assertEqual([], select_all(
+            sdb, 'select * from `{}`'.format(SDB_DOMAIN)))
+        moved = select_all(sdb, 'select * from `{}`'.format(
+            shard_domain('2017-05-01', 'year')))
+        self.assertEqual([{'Name': 'result', 'Value': 'All'}],
+                         moved[0]['Attributes'])
+
+    def test_incremental_week(self):
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        put_sdb_activities(self.sdb, activities, naps)
+        with installed_fakes(self.s3, self.sdb):
+            from dash_app.get_data import get_week_data
+            week = get_week_data('2018-09-21')
+            mark = dateutil.parser.parse(week['HighWaterMark'])
+            # stamped before the mark, but stored after it was read
+            late = [activities[0]._replace(first_name='Mia')]
+            put_sdb_activities(self.sdb, late, [])
+            self.sdb.put_attributes(
+                DomainName=shard_domain(late[0].date),
+                ItemName=activity_item_names(late)[0],
+                Attributes=[{'Name': 'ingest_datetime', 'Replace': True,
+                             'Value': (mark - timedelta(seconds=60)
+                                       ).isoformat()}])
+            refreshed = get_week_data('2018-09-21', week)
+        self.assertEqual(len(week['Items']) + 1, len(refreshed['Items']))
+        self.assertIn(activity_item_names(late)[0],
+                      [x['Name'] for x in refreshed['Items']])
+
+    def test_reprocess_legacy_item(self):
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        # stored before sharding, then reprocessed into the shard
+        with mock.patch('sdb_modify_domain.SDB_SHARD_PERIOD', 'none'):
+            put_sdb_activities(self.sdb, activities, naps)
+        reconcile_sdb_activities(self.sdb, activities, naps)
+        self.assertEqual(len(activities) + len(naps), len(select_all(
+            self.sdb, 'select * from `{}`'.format(
+                shard_domain(activities[0].date)))))
+
+        with installed_fakes(self.s3, self.sdb):
+            from dash_app.get_data import get_week_data
+            from dash_app.history import get_history
+            week = get_week_data('2018-09-21')
+            history = get_history()
+        names = [x['Name'] for x in week['Items']]
+        self.assertEqual(len(activities) + len(naps), len(names))
+        self.assertEqual(sorted(set(names)), sorted(names))
+        # the shard copies, which were written by the reprocess
+        self.assertEqual({'reprocess'}, set(
+            y['Value'] for x in week['Items'] for y in x['Attributes']
+            if y['Name'] == 'ingest_mode'))
+        self.assertEqual(len(activities) + len(naps), len(history))
+
+    def test_recent_children(self):
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        put_sdb_activities(self.sdb, activities, naps, family='a@b.example')
+        days = (dt.now() - dt(2018, 9, 20)).days
+        with installed_fakes(self.s3, self.sdb):
+            from dash_app.history import recent_children
+            self.assertEqual(['Emilia'], recent_children('a@b.example', days))
+            self.assertEqual([], recent_children('c@d.example', days))
+            self.assertEqual([], recent_children('a@b.example', 30))
+
+    def test_cleanup_media(self):
+        domain = shard_domain('2018-08-01')
+
+        def put(name, first_name, result):
+            self.sdb.put_attributes(DomainName=domain, ItemName=name,
+                                    Attributes=[
+                {'Name': 'first_name', 'Value': first_name},
+                {'Name': 'activity', 'Value': 'Media'},
+                {'Name': 'result', 'Value': result}])
+        # stored before families, then again under the family's name
+        put('a.jpg-2018-08-01-Media-000', 'a.jpg', 'a.jpg')
+        put('parents@b.example/a.jpg-2018-08-01-Media-000', '', 'a.jpg')
+        # not reprocessed yet
+        put('b.jpg-2018-08-01-Media-000', 'b.jpg', 'b.jpg')
+
+        self.assertEqual({'deleted': 1, 'kept': 1},
+                         cleanup_media_items(self.sdb, [domain]))
+        stored = {x['Name']: x for x in select_all(
+            self.sdb, 'select * from `{}`'.format(domain))}
+        self.assertEqual(['b.jpg-2018-08-01-Media-000',
+                          'parents@b.example/a.jpg-2018-08-01-Media-000'],
+                         sorted(stored))
+        self.assertIn({'Name': 'ingest_mode', 'Value': 'reprocess'},
+                      stored['parents@b.example/a.jpg-2018-08-01-Media-000'][
+                          'Attributes'])
+
+    def test_resumed_download(self):
+        data = bytes(range(256)) * 4000
+        download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, download_dir)
+        with FakeKaymbuServer() as kaymbu, \
+                mock.patch.multiple(note_parse,
+                                    MEDIA_DOWNLOAD_DIR=download_dir,
+                                    MEDIA_RETRY_BASE_S=0.001):
+            kaymbu.add_media('page1', 'vid1', 'My Video.MP4', data)
+            url = kaymbu.url + '/download/moments?vid1'
+            # drops twice, then resumes where it stopped
+            kaymbu.cut_after['vid1'] = [300000, 200000]
+            content, name = download_media_file(url, 'vid1')
+            self.assertEqual(data, content)
+            self.assertEqual('My Video.MP4', name)
+            # at most the chunk being read is lost per drop
+            self.assertLessEqual(kaymbu.bytes_sent,
+                                 len(data) + 2 * note_parse.MEDIA_CHUNK_SIZE)
+            self.assertEqual(3, len(kaymbu.requests))
+
+            # a finished download is kept until discarded
+            self.assertEqual(data, download_media_file(url, 'vid1')[0])
+            self.assertEqual(3, len(kaymbu.requests))
+
+            with mock.patch.object(note_parse, 'MEDIA_TRIES', 2):
+                kaymbu.add_media('page1', 'vid2', 'b.MP4', data)
+                kaymbu.cut_after['vid2'] = [10, 10]
+                with self.assertRaises(note_parse.IncompleteDownload):
+                    download_media_file(
+                        kaymbu.url + '/download/moments?vid2', 'vid2')
+
+        self.assertEqual('IMG 1.jpg', media_file_name(
+            {'Content-Disposition': 'attachment; filename="IMG 1.jpg"'}))
+        self.assertEqual('x.jpg', media_file_name(
+            {'Content-Disposition': 'attachment; filename=../../x.jpg'}))
+        self.assertEqual('media.jpg', media_file_name(
+            {'Content-Type': 'image/jpeg'}))
+        self.assertIsNone(media_file_name({}))
+
+    def test_families(self):
+        payload = _load_email('test_message')
+        emails = {'a': make_note_email(payload, dt(2018, 8, 1), 'Emilia',
+                                       'Parents@A.example'),
+                  'b': make_note_email(payload, dt(2018, 8, 1), 'Emilia',
+                                       'parents@b.example'),
+                  'c': make_note_email(payload, dt(2018, 8, 1), 'Mia',
+                                       'parents@b.example')}
+        for key, body in emails.items():
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+        self.assertEqual('parents@a.example', email_family(emails['a']))
+        # a family with several addresses
+        addresses = family_addresses(
+            'Parents@A.example=Kusano, other@a.example=kusano')
+        self.assertEqual('kusano', email_family(emails['a'], addresses))
+        self.assertEqual('parents@b.example',
+                         email_family(emails['b'], addresses))
+
+        with FakeKaymbuServer() as kaymbu, \
+                installed_fakes(self.s3, self.sdb, kaymbu.url):
+            url = kaymbu.add_media('page1', 'abc123', 'IMG_1.jpg', b'jpeg')
+            self.s3.put_object(Bucket=self.bucket, Key='picture',
+                               Body=make_picture_email(url, dt(2018, 8, 1),
+                                                       'parents@b.example'))
+            counts = {x: len(sum(lambda_worker(self.bucket, x), []))
+                      for x in sorted(emails)}
+            media, _ = lambda_worker(self.bucket, 'picture')
+            from dash_app.get_data import get_week_data
+            weeks = {(x, y): get_week_data('2018-08-01', family=x,
+                                           first_name=y)['Items']
+                     for x in ['', 'parents@a.example', 'parents@b.example']
+                     for y in ['', 'Emilia', 'Mia']}
+
+        self.assertEqual('', media[0].first_name)
+        self.assertEqual(sum(counts.values()) + 1, len(weeks[('', '')]))
+        # same child name in two families, both kept
+        self.assertEqual(counts['a'], len(weeks[('parents@a.example', '')]))
+        self.assertEqual(counts['b'] + 1,
+                         len(weeks[('parents@b.example', 'Emilia')]))
+        self.assertEqual(counts['c'] + 1,
+                         len(weeks[('parents@b.example', 'Mia')]))
+        self.assertTrue(all(x['Name'].startswith('parents@a.example/Emilia-')
+                            for x in weeks[('parents@a.example', '')]))
+        self.assertIn('parents@b.example/abc123.jpg-2018-08-01-Media-000',
+                      [x['Name'] for x in weeks[('parents@b.example', '')]])
+
+    def test_async_worker(self):
+        def s3_event(key):
+            return json.dumps({'Records': [{'s3': {
+                'bucket': {'name': self.bucket},
+                'object': {'key': key.replace(' ', '+')}}}]})
+
+        sqs = FakeSQS()
+        queue_url = 'https://sqs.local/emails'
+        payload = _load_email('test_message')
+        days = [dt(2018, 8, x) for x in [1, 2, 3, 6, 7]]
+        for day in days:
+            key = 'note {}'.format(day.day)
+            self.s3.put_object(Bucket=self.bucket, Key=key,
+                               Body=make_note_email(payload, day))
+            sqs.send_message(QueueUrl=queue_url, MessageBody=s3_event(key))
+        sqs.send_message(QueueUrl=queue_url, MessageBody=s3_event('missing'))
+        sqs.send_message(QueueUrl=queue_url,
+                         MessageBody=json.dumps({'Event': 's3:TestEvent'}))
+        self.assertEqual([(self.bucket, 'note 1')],
+                         s3_event_records(s3_event('note 1')))
+
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        index_path = os.path.join(index_dir, 'notes.sqlite')
+        with FakeKaymbuServer() as kaymbu, \
+                installed_fakes(self.s3, self.sdb, kaymbu.url), \
+                mock.patch('lambda_function.NOTES_INDEX_PATH', index_path):
+            url = kaymbu.add_media('page1', 'abc123', 'IMG_1.jpg', b'jpeg')
+            self.s3.put_object(Bucket=self.bucket, Key='picture',
+                               Body=make_picture_email(url,
+                                                       dt(2018, 8, 3)))
+            sqs.send_message(QueueUrl=queue_url,
+                             MessageBody=s3_event('picture'))
+            loop = asyncio.new_event_loop()
+            try:
+                with mock.patch.object(sqs, 'receive_message',
+                                       wraps=sqs.receive_message) as receive:
+                    counts = loop.run_until_complete(run_worker(
+                        sqs_source(sqs, queue_url, drain=True), workers=3,
+                        limits={'sdb': 2, 'kaymbu': 1}))
+            finally:
+                loop.close()
+        # messages are only received for free workers
+        batches = [x[1]['MaxNumberOfMessages']
+                   for x in receive.call_args_list]
+        self.assertEqual(1, batches[0])
+        self.assertLessEqual(max(batches), 3)
+
+        self.assertEqual(6, counts['processed'])
+        self.assertEqual(1, counts['failed'])
+        # only the failed message is left to retry
+        self.assertEqual(1, sqs.pending(queue_url))
+        res = self.sdb.select(SelectExpression='select count(*) from `{}`'
+                              .format(shard_domain('2018-08-01')))
+        self.assertEqual(str(counts['activities']),
+                         res['Items'][0]['Attributes'][0]['Value'])
+        obj = self.s3.get_object(Bucket=self.bucket, Key='media/abc123.jpg')
+        self.assertEqual(b'jpeg', obj['Body'].read())
+        # every note email is indexed
+        self.assertEqual(len(days),
+                         len(search(open_index(index_path), 'please')))
+
+    def test_reprocess_prefix(self):
+        payload = _load_email('test_message')
+        keys = ['emails/{}'.format(x) for x in
+                ['0abc', '1', '1abc', '9z', 'Abc', 'a', 'zzz', '~x']]
+        for i, key in enumerate(keys):
+            self.s3.put_object(Bucket=self.bucket, Key=key,
+                               Body=make_note_email(payload,
+                                                    dt(2018, 8, 1 + i)))
+        self.s3.put_object(Bucket=self.bucket, Key='emails/bad', Body=b'')
+        self.s3.put_object(Bucket=self.bucket, Key='other/1', Body=b'')
+
+        found = list_keys(self.s3, self.bucket, 'emails/', workers=4)
+        self.assertEqual(sorted(keys + ['emails/bad']), found)
+        today = dt.utcnow().strftime('%Y-%m-%d')
+        self.assertEqual([], list_keys(self.s3, self.bucket, 'emails/',
+                                       start='2100-01-01'))
+        self.assertEqual(found, list_keys(self.s3, self.bucket, 'emails/',
+                                          start=today, end=today))
+
+        sdb_calls = dict(self.sdb.calls)
+        with installed_fakes(self.s3, self.sdb):
+            summary = reprocess_keys(self.bucket, found, workers=4,
+                                     dry_run=True)
+            self.assertEqual(len(keys), summary['processed'])
+            self.assertEqual(sdb_calls, self.sdb.calls)
+            summary = reprocess_keys(self.bucket, found, workers=4)
+        self.assertEqual(len(keys), summary['processed'])
+        self.assertEqual(['emails/bad'], [x for x, _ in summary['failures']])
+        res = self.sdb.select(SelectExpression='select count(*) from `{}` '
+                              'where ingest_mode = "reprocess"'
+                              .format(shard_domain('2018-08-01')))
+        self.assertEqual(str(summary['activities']),
+                         res['Items'][0]['Attributes'][0]['Value'])
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(100, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+
+
+    def test_parse_cache(self):
+        payload = _load_email('test_message')
+        self.s3.put_object(Bucket=self.bucket, Key='note',
+                           Body=make_note_email(payload, dt(2018, 8, 1)))
+        with FakeKaymbuServer() as kaymbu, \
+                installed_fakes(self.s3, self.sdb, kaymbu.url):
+            url = kaymbu.add_media('page1', 'abc123', 'IMG_1.jpg', b'jpeg')
+            self.s3.put_object(Bucket=self.bucket, Key='picture',
+                               Body=make_picture_email(url,
+                                                       dt(2018, 8, 1)))
+            note_out = lambda_worker(self.bucket, 'note')
+            picture_out = lambda_worker(self.bucket, 'picture')
+        self.assertIn(parse_cache.sidecar_key('note'),
+                      [x['Key'] for x in self.s3.list_objects_v2(
+                          Bucket=self.bucket, Prefix='parsed/')['Contents']])
+
+        def email_gets(key):
+            # reads of the email itself, not the cached parse
+            before = self.s3.calls['GetObject']
+            with installed_fakes(self.s3, self.sdb):
+                out = lambda_worker(self.bucket, key, reprocess=True)
+            parse_gets = 1 if self.s3.calls.get('HeadObject') else 0
+            self.s3.calls['HeadObject'] = 0
+            return out, self.s3.calls['GetObject'] - before - parse_gets
+
+        self.assertEqual((note_out, 0), email_gets('note'))
+        # the Kaymbu server is gone, so this only works from the cache
+        self.assertEqual(((list(picture_out[0]), []), 0),
+                         email_gets('picture'))
+
+        parse_cache.PARSER_VERSION += 1
+        try:
+            self.assertEqual((note_out, 1), email_gets('note'))
+        finally:
+            parse_cache.PARSER_VERSION -= 1
+        # new email under the same key
+        self.s3.put_object(Bucket=self.bucket, Key='note',
+                           Body=make_note_email(payload, dt(2018, 8, 2)))
+        out, gets = email_gets('note')
+        self.assertEqual('2018-08-02', out[0][0].date)
+        self.assertEqual(1, gets)
+
+        # the family is resolved again when the family addresses change
+        with mock.patch('lambda_function.FAMILY_ADDRESSES',
+                        'Parent@example.com=Kusano'):
+            self.assertEqual(1, email_gets('note')[1])
+            self.assertEqual(0, email_gets('note')[1])
+        self.assertEqual(len(out[0]) + len(out[1]), len(select_all(
+            self.sdb, 'select * from `{}` where `family` = "kusano"'.format(
+                shard_domain('2018-08-02')))))
+        self.assertEqual(1, email_gets('note')[1])
+
+
+class TestIngestArchive(TestCase):
+    def setUp(self):
+        with open('test_message', 'rb') as test_file:
+            self.note = test_file.read().replace(b'\r\n', b'\n')
+        self.other = b'From: someone@example.com\nSubject: hi\n\n' + \
+            b'From the desk of someone\n'
+        # mboxrd escapes body lines starting with From
+        mbox = b''
+        for raw in [self.note, self.other, self.note]:
+            body = raw.replace(b'\nFrom ', b'\n>From ')
+            mbox += b'From MAILER-DAEMON Mon Oct  1 00:00:00 2018\n' + \
+                body + b'\n'
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mbox_path = os.path.join(self.tmp_dir, 'mail.mbox')
+        with open(self.mbox_path, 'wb') as mbox_file:
+            mbox_file.write(mbox)
+        with gzip.open(self.mbox_path + '.gz', 'wb') as gz_file:
+            gz_file.write(mbox)
+        with zipfile.ZipFile(os.path.join(self.tmp_dir, 'mail.zip'),
+                             'w') as zip_file:
+            zip_file.writestr('takeout/mail.mbox', mbox)
+            zip_file.writestr('single.eml', self.note)
+        maildir = os.path.join(self.tmp_dir, 'Maildir')
+        for sub_dir in ['cur', 'new', 'tmp']:
+            os.makedirs(os.path.join(maildir, sub_dir))
+        with open(os.path.join(maildir, 'cur', '1:2,S'), 'wb') as msg_file:
+            msg_file.write(self.note)
+
+    def test_iter_messages(self):
+        messages = list(iter_archive_messages(self.mbox_path))
+        self.assertEqual(3, len(messages))
+        self.assertEqual(self.other + b'\n', messages[1][1])
+        self.assertEqual([True, False, True],
+                         [is_kaymbu_message(x) for _, x in messages])
+        self.assertEqual(
+            3, len(list(iter_archive_messages(self.mbox_path + '.gz'))))
+        self.assertEqual(4, len(list(iter_archive_messages(
+            os.path.join(self.tmp_dir, 'mail.zip')))))
+        self.assertEqual(1, len(list(iter_archive_messages(
+            os.path.join(self.tmp_dir, 'Maildir')))))
+        # size limit skips messages
+        self.assertEqual(1, len(list(iter_archive_messages(self.mbox_path,
+                                                           1000))))
+
+    def test_ingest(self):
+        counts = ingest_archive(self.mbox_path + '.gz', 'bucket',
+                                dry_run=True)
+        self.assertEqual({'seen': 3, 'kaymbu': 2, 'ingested': 2,
+                          'skipped': 0, 'failed': 0}, counts)
+
+        sdb = FakeSimpleDB()
+        sdb.create_domain(DomainName=shard_domain('2018-09-21'))
+        with installed_fakes(FakeS3(), sdb):
+            counts = ingest_archive(self.tmp_dir, 'bucket')
+        # mbox, mbox.gz, zip (mbox + single) and maildir
+        self.assertEqual(8, counts['kaymbu'])
+        self.assertEqual(8, counts['ingested'])
+        # the same note every time, so the items are overwritten
+        activities, naps = parse_gretchens_notes(_load_email('test_message'))
+        res = sdb.select(SelectExpression='select count(*) from `{}`'.format(
+            shard_domain('2018-09-21')))
+        self.assertEqual(str(len(activities) + len(naps)),
+                         res['Items'][0]['Attributes'][0]['Value'])